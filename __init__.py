@@ -6,7 +6,9 @@ from .party import *
 from .routing import *
 from .static_file import *
 from .currency import *
+from .country import *
 from .template import *
+from .email_queue import *
 
 
 def register():
@@ -26,7 +28,11 @@ def register():
         NereidStaticFolder,
         NereidStaticFile,
         Currency,
+        CurrencyRate,
+        Country,
+        Subdivision,
         ContextProcessors,
         Language,
+        EmailQueue,
         module='nereid', type_='model'
     )
@@ -0,0 +1,50 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.model import ModelView, ModelSQL
+from trytond.pool import Pool
+
+__all__ = ['Country', 'Subdivision']
+
+
+class Country(ModelSQL, ModelView):
+    "Countries are cached by the country lists of the websites"
+    __name__ = 'country.country'
+
+    @classmethod
+    def create(cls, vlist):
+        countries = super(Country, cls).create(vlist)
+        Pool().get('nereid.website').clear_country_caches()
+        return countries
+
+    @classmethod
+    def write(cls, countries, values):
+        rv = super(Country, cls).write(countries, values)
+        Pool().get('nereid.website').clear_country_caches()
+        return rv
+
+    @classmethod
+    def delete(cls, countries):
+        Pool().get('nereid.website').clear_country_caches()
+        return super(Country, cls).delete(countries)
+
+
+class Subdivision(ModelSQL, ModelView):
+    "Subdivisions are cached by the subdivision lists of the websites"
+    __name__ = 'country.subdivision'
+
+    @classmethod
+    def create(cls, vlist):
+        subdivisions = super(Subdivision, cls).create(vlist)
+        Pool().get('nereid.website').clear_country_caches()
+        return subdivisions
+
+    @classmethod
+    def write(cls, subdivisions, values):
+        rv = super(Subdivision, cls).write(subdivisions, values)
+        Pool().get('nereid.website').clear_country_caches()
+        return rv
+
+    @classmethod
+    def delete(cls, subdivisions):
+        Pool().get('nereid.website').clear_country_caches()
+        return super(Subdivision, cls).delete(subdivisions)
@@ -1,22 +1,56 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
 from nereid import request
 
-__all__ = ['Currency', 'Language']
+__all__ = ['Currency', 'CurrencyRate', 'Language']
+
+
+def clear_currencies_cache():
+    "Clear the cached currencies of the websites"
+    Pool().get('nereid.website')._currencies_cache.clear()
+
+
+def clear_languages_cache():
+    """
+    Clear the cached languages, and the website descriptors which hold the
+    code of their default language
+    """
+    WebSite = Pool().get('nereid.website')
+    WebSite._languages_cache.clear()
+    WebSite._descriptor_cache.clear()
 
 class Currency(ModelSQL, ModelView):
     '''Currency Manipulation for core.'''
     __name__ = 'currency.currency'
 
+    @classmethod
+    def create(cls, vlist):
+        currencies = super(Currency, cls).create(vlist)
+        clear_currencies_cache()
+        return currencies
+
+    @classmethod
+    def write(cls, currencies, values):
+        rv = super(Currency, cls).write(currencies, values)
+        clear_currencies_cache()
+        return rv
+
+    @classmethod
+    def delete(cls, currencies):
+        clear_currencies_cache()
+        return super(Currency, cls).delete(currencies)
+
     @classmethod
     def convert(cls, amount):
         """A helper method which converts the amount from the currency of the
         company which owns the current website to the currency of the current
         session.
         """
+        WebSite = Pool().get('nereid.website')
         return cls.compute(
-            request.nereid_website.company.currency,
+            cls(WebSite.get_descriptor().company_currency),
             amount,
             request.nereid_currency
         )
@@ -35,9 +69,48 @@ class Currency(ModelSQL, ModelView):
         }
 
 
+class CurrencyRate(ModelSQL, ModelView):
+    '''The rates are part of the cached currencies of the websites'''
+    __name__ = 'currency.currency.rate'
+
+    @classmethod
+    def create(cls, vlist):
+        rates = super(CurrencyRate, cls).create(vlist)
+        clear_currencies_cache()
+        return rates
+
+    @classmethod
+    def write(cls, rates, values):
+        rv = super(CurrencyRate, cls).write(rates, values)
+        clear_currencies_cache()
+        return rv
+
+    @classmethod
+    def delete(cls, rates):
+        clear_currencies_cache()
+        return super(CurrencyRate, cls).delete(rates)
+
+
 class Language(ModelSQL, ModelView):
     __name__ = "ir.lang"
 
     default_currency = fields.Many2One(
         'currency.currency', 'Default Currency'
     )
+
+    @classmethod
+    def create(cls, vlist):
+        languages = super(Language, cls).create(vlist)
+        clear_languages_cache()
+        return languages
+
+    @classmethod
+    def write(cls, languages, values):
+        rv = super(Language, cls).write(languages, values)
+        clear_languages_cache()
+        return rv
+
+    @classmethod
+    def delete(cls, languages):
+        clear_languages_cache()
+        return super(Language, cls).delete(languages)
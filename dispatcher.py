@@ -0,0 +1,162 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from copy import copy
+
+from werkzeug.routing import Map, MapAdapter, parse_rule
+
+__all__ = ['TrieMap']
+
+#: Converters whose values never span more than one path segment. Rules
+#: using any other converter are always matched with their regex.
+SEGMENT_CONVERTERS = frozenset([
+    'default', 'string', 'int', 'float', 'any', 'uuid'
+])
+
+
+def rule_segments(rule):
+    """
+    Returns the segments of the path of a werkzeug rule, where the literal
+    segments are strings and the dynamic segments are `None`. `None` is
+    returned instead if a value of the rule could span several segments.
+
+    :param rule: The werkzeug rule string
+    """
+    segments = []
+    stripped = rule.strip('/')
+    for part in (stripped.split('/') if stripped else []):
+        items = list(parse_rule(part))
+        if len(items) == 1 and items[0][0] is None:
+            segments.append(items[0][2])
+        elif all(
+                converter is None or converter in SEGMENT_CONVERTERS
+                for converter, arguments, variable in items):
+            segments.append(None)
+        else:
+            return None
+    return segments
+
+
+class _Node(object):
+    "A node of the rule trie"
+    __slots__ = ('literals', 'wildcard', 'rules')
+
+    def __init__(self):
+        self.literals = {}
+        self.wildcard = None
+        self.rules = []
+
+    def collect(self, segments, index, result):
+        """
+        Collect the rules under this node that could match the remaining
+        path segments
+        """
+        if index == len(segments):
+            result.extend(self.rules)
+            return
+        child = self.literals.get(segments[index])
+        if child is not None:
+            child.collect(segments, index + 1, result)
+        if self.wildcard is not None:
+            self.wildcard.collect(segments, index + 1, result)
+
+
+class _RuleSubset(object):
+    """
+    A view of a map which only exposes the given rules for matching. Every
+    other attribute is looked up on the map.
+    """
+
+    def __init__(self, map, rules):
+        self._map = map
+        self._rules = rules
+
+    def update(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._map, name)
+
+
+class TrieMap(Map):
+    """
+    A werkzeug map which indexes its rules in a trie by the literal
+    segments of their paths. Matching a path walks the trie, so that the
+    regex of a rule is only tried if its literal segments match the path.
+    The matching itself (including redirects and method checks) is done
+    by werkzeug on the remaining candidates.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._trie = None
+        self._fallback = []
+        super(TrieMap, self).__init__(*args, **kwargs)
+
+    def add(self, rulefactory):
+        super(TrieMap, self).add(rulefactory)
+        self._trie = None
+
+    def update(self):
+        super(TrieMap, self).update()
+        if self._trie is None:
+            self._build_trie()
+
+    def _build_trie(self):
+        "Build the trie from the rules in their matching order"
+        root, fallback = _Node(), []
+        for position, rule in enumerate(self._rules):
+            if rule.build_only:
+                continue
+            segments = rule_segments(rule.rule)
+            if segments is None:
+                fallback.append((position, rule))
+                continue
+            node = root
+            for segment in segments:
+                if segment is None:
+                    if node.wildcard is None:
+                        node.wildcard = _Node()
+                    node = node.wildcard
+                else:
+                    node = node.literals.setdefault(segment, _Node())
+            node.rules.append((position, rule))
+        self._trie, self._fallback = root, fallback
+
+    def candidate_rules(self, path_info):
+        """
+        Returns the rules that could match the given path in the order in
+        which they must be tried
+
+        :param path_info: The path to match
+        """
+        self.update()
+        if not isinstance(path_info, unicode):
+            path_info = path_info.decode(self.charset, self.encoding_errors)
+        stripped = path_info.strip('/')
+        segments = stripped.split('/') if stripped else []
+        result = list(self._fallback)
+        self._trie.collect(segments, 0, result)
+        result.sort(key=lambda item: item[0])
+        return [rule for position, rule in result]
+
+    def bind(self, *args, **kwargs):
+        adapter = super(TrieMap, self).bind(*args, **kwargs)
+        # werkzeug instantiates the adapter itself, so the class is swapped
+        # instead of duplicating the signature of the constructor
+        adapter.__class__ = TrieMapAdapter
+        return adapter
+
+
+class TrieMapAdapter(MapAdapter):
+    "Map adapter which only tries the candidate rules of a :class:`TrieMap`"
+
+    def match(self, path_info=None, method=None, return_rule=False,
+            query_args=None):
+        if path_info is None:
+            path_info = self.path_info
+        adapter = copy(self)
+        adapter.map = _RuleSubset(
+            self.map, self.map.candidate_rules(path_info)
+        )
+        return MapAdapter.match(
+            adapter, path_info, method, return_rule, query_args
+        )
@@ -0,0 +1,202 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Outbound email queue
+
+The emails of the handlers are not sent in the request. They are stored
+in the `nereid.email.queue` table in the transaction of the request, so
+nothing is sent if the request fails, and sent by the `Send Nereid Emails`
+scheduled action over a single session of the SMTP pool (see
+:mod:`trytond.modules.nereid.smtp_pool`).
+
+Every run of the scheduled action sends batches of messages until none is
+due or until it has been sending for `nereid_email_time_budget` seconds
+(50 by default, less than the interval of the scheduled action).
+
+A message which cannot be sent is tried again after a delay which doubles
+at every attempt, starting from `nereid_email_retry_delay` seconds (60 by
+default), until `nereid_email_max_attempts` attempts (5 by default) have
+failed::
+
+    [options]
+    nereid_email_time_budget = 50
+    nereid_email_retry_delay = 60
+    nereid_email_max_attempts = 5
+"""
+import datetime
+import logging
+import smtplib
+import time
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+
+from .smtp_pool import send_batch
+
+__all__ = ['EmailQueue']
+
+logger = logging.getLogger('nereid.email_queue')
+
+#: The states of the queued messages
+STATES = [
+    ('outbox', 'Outbox'),
+    ('sent', 'Sent'),
+    ('failed', 'Failed'),
+]
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class EmailQueue(ModelSQL, ModelView):
+    "Nereid Email Queue"
+    __name__ = 'nereid.email.queue'
+    _rec_name = 'to_addrs'
+
+    from_addr = fields.Char('From', required=True, readonly=True)
+    #: The recipients separated by commas
+    to_addrs = fields.Char('To', required=True, readonly=True)
+    msg = fields.Text('Message', required=True, readonly=True)
+    state = fields.Selection(
+        STATES, 'State', required=True, readonly=True, select=True
+    )
+    attempts = fields.Integer('Attempts', readonly=True)
+    #: The message is not sent before this time
+    next_attempt = fields.DateTime('Next Attempt', readonly=True, select=True)
+    sent_date = fields.DateTime('Sent Date', readonly=True)
+    last_error = fields.Text('Last Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(EmailQueue, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @staticmethod
+    def default_state():
+        return 'outbox'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def queue_mail(cls, from_addr, to_addrs, msg):
+        """
+        Queue a message to be sent by :meth:`send_all`
+
+        :param from_addr: The sender address
+        :param to_addrs: A list of recipient addresses
+        :param msg: The message as a string
+        :return: The queued message
+        """
+        message, = cls.create([{
+            'from_addr': from_addr,
+            'to_addrs': ','.join(to_addrs),
+            'msg': msg,
+            'next_attempt': datetime.datetime.now(),
+        }])
+        return message
+
+    @staticmethod
+    def get_retry_delay(attempts):
+        """
+        Returns the delay before the next attempt after the given number
+        of failed attempts
+
+        :param attempts: The number of failed attempts
+        """
+        delay = int(CONFIG.get('nereid_email_retry_delay') or 60)
+        return datetime.timedelta(seconds=delay * 2 ** (attempts - 1))
+
+    @classmethod
+    def send_all(cls, batch_size=100, time_budget=None):
+        """
+        Send the queued messages which are due, in batches sent over a
+        single session of the SMTP pool each, until no message is due or
+        the time budget is spent. Called by the scheduled action.
+
+        The transaction is committed before every new batch, so the
+        messages already sent are not sent again if a later batch fails.
+
+        :param batch_size: The maximum number of messages in a batch
+        :param time_budget: The number of seconds after which no new batch
+                            is started, defaults to
+                            `nereid_email_time_budget`. At least one batch
+                            is sent.
+        """
+        if time_budget is None:
+            time_budget = float(
+                CONFIG.get('nereid_email_time_budget') or 50
+            )
+        deadline = time.time() + time_budget
+        while cls.send_batch(batch_size) == batch_size and \
+                time.time() < deadline:
+            Transaction().cursor.commit()
+
+    @classmethod
+    def send_batch(cls, batch_size=100):
+        """
+        Send a batch of the queued messages which are due in a single
+        session of the SMTP pool. The messages which are sent or fail are
+        not due anymore.
+
+        :param batch_size: The maximum number of messages sent
+        :return: The number of messages of the batch
+        """
+        messages = cls.search([
+            ('state', '=', 'outbox'),
+            ('next_attempt', '<=', datetime.datetime.now()),
+        ], order=[('next_attempt', 'ASC'), ('id', 'ASC')], limit=batch_size)
+        if not messages:
+            return 0
+
+        failures = dict(send_batch([
+            (m.from_addr, m.to_addrs.split(','), _encode(m.msg))
+            for m in messages
+        ]))
+
+        sent = {}
+        for index, message in enumerate(messages):
+            if index in failures:
+                logger.warning('Could not send email %d: %s' % (
+                    message.id, failures[index]
+                ))
+                message.defer(failures[index])
+            else:
+                sent.setdefault((message.attempts or 0) + 1, []).append(
+                    message
+                )
+        now = datetime.datetime.now()
+        for attempts, sent_messages in sent.iteritems():
+            cls.write(sent_messages, {
+                'state': 'sent',
+                'sent_date': now,
+                'attempts': attempts,
+            })
+        return len(messages)
+
+    def defer(self, error):
+        """
+        Record a failed attempt and schedule the next one, or mark the
+        message as failed if it was the last attempt or if the recipients
+        were refused
+
+        :param error: The exception raised by the attempt
+        """
+        attempts = (self.attempts or 0) + 1
+        values = {
+            'attempts': attempts,
+            'last_error': unicode(error),
+        }
+        max_attempts = int(CONFIG.get('nereid_email_max_attempts') or 5)
+        if attempts >= max_attempts or \
+                isinstance(error, smtplib.SMTPRecipientsRefused):
+            values['state'] = 'failed'
+        else:
+            values['next_attempt'] = datetime.datetime.now() + \
+                self.get_retry_delay(attempts)
+        self.write([self], values)
@@ -0,0 +1,250 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Request phase timing
+
+Records how long each phase of a request takes and how many SQL queries
+it runs. Instrumentation is disabled unless the `INSTRUMENTATION` setting
+of the application is set. When enabled:
+
+* every response gets a `Server-Timing` header with its phases,
+* the durations are aggregated per endpoint and phase in histograms,
+  see :func:`get_stats`,
+* requests slower than `SLOW_REQUEST_THRESHOLD` seconds are dumped as
+  JSON files into `SLOW_REQUEST_DIR`, if both settings are set.
+
+Handlers mark their phases with :func:`phase`::
+
+    with phase('validate'):
+        form.validate()
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+from flask.signals import signals_available
+from nereid.globals import request, current_app
+from nereid.signals import request_started, request_finished, \
+    request_tearing_down
+from trytond.transaction import Transaction
+
+__all__ = ['phase', 'get_stats', 'reset_stats']
+
+#: The upper bounds (in milliseconds) of the buckets of the histograms
+BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_stats = {}
+_stats_lock = Lock()
+
+
+class Histogram(object):
+    "Histogram of the durations and query counts of a phase"
+    __slots__ = ('count', 'total', 'maximum', 'queries', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.queries = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, duration, queries):
+        """
+        Add a measure to the histogram
+
+        :param duration: Duration in milliseconds
+        :param queries: Number of SQL queries
+        """
+        self.count += 1
+        self.total += duration
+        self.maximum = max(self.maximum, duration)
+        self.queries += queries
+        for index, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                break
+        else:
+            index = len(BUCKETS)
+        self.buckets[index] += 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total_ms': round(self.total, 3),
+            'mean_ms': round(self.total / self.count, 3),
+            'max_ms': round(self.maximum, 3),
+            'queries': self.queries,
+            'buckets': dict(
+                (str(bound), count) for bound, count in zip(
+                    BUCKETS + ('inf',), self.buckets
+                )
+            ),
+        }
+
+
+class RequestProfile(object):
+    "The phases measured during a request"
+    __slots__ = ('started', 'phases', 'queries', 'cursor')
+
+    def __init__(self, cursor):
+        self.started = time.time()
+        self.phases = []
+        self.queries = 0
+        self.cursor = cursor
+
+
+def _get_profile():
+    """
+    Returns the profile of the current request or None if the request is
+    not instrumented
+    """
+    if not request:
+        return None
+    return getattr(request, 'nereid_profile', None)
+
+
+@contextmanager
+def phase(name):
+    """
+    Measure the time taken and the SQL queries run by the block as the
+    phase `name` of the current request. Does nothing if the request is
+    not instrumented.
+
+    :param name: Name of the phase, a token as used in `Server-Timing`
+    """
+    profile = _get_profile()
+    if profile is None:
+        yield
+        return
+    started, queries = time.time(), profile.queries
+    try:
+        yield
+    finally:
+        profile.phases.append((
+            name, (time.time() - started) * 1000,
+            profile.queries - queries
+        ))
+
+
+def get_stats():
+    """
+    Returns the histograms of this process as a dictionary of endpoints,
+    each being a dictionary of the histograms of its phases
+    """
+    rv = {}
+    with _stats_lock:
+        for (endpoint, name), histogram in _stats.iteritems():
+            rv.setdefault(endpoint, {})[name] = histogram.to_dict()
+    return rv
+
+
+def reset_stats():
+    "Reset the histograms of this process"
+    with _stats_lock:
+        _stats.clear()
+
+
+def _count_queries(profile, execute):
+    "Wraps the execute method of a cursor to count the queries"
+    def wrapper(*args, **kwargs):
+        profile.queries += 1
+        return execute(*args, **kwargs)
+    return wrapper
+
+
+def start_profile(app, **extra):
+    """
+    Start the profile of a request if instrumentation is enabled. Connected
+    to the `request_started` signal.
+    """
+    if not app.config.get('INSTRUMENTATION'):
+        return
+    cursor = Transaction().cursor
+    profile = RequestProfile(cursor)
+    # Instance attributes take precedence over the method of the class, so
+    # removing the attribute at the end of the request restores it
+    cursor.execute = _count_queries(profile, cursor.execute)
+    request.nereid_profile = profile
+
+
+def _stop_counting(profile):
+    if profile.cursor is not None:
+        profile.cursor.__dict__.pop('execute', None)
+        profile.cursor = None
+
+
+def finish_profile(app, response, **extra):
+    """
+    Add the `Server-Timing` header to the response and record the phases
+    of the request. Connected to the `request_finished` signal.
+    """
+    profile = _get_profile()
+    if profile is None:
+        return
+    _stop_counting(profile)
+
+    total = (time.time() - profile.started) * 1000
+    phases = profile.phases + [('total', total, profile.queries)]
+    response.headers['Server-Timing'] = ', '.join(
+        '%s;dur=%.3f;desc="%d queries"' % (name, duration, queries)
+        for name, duration, queries in phases
+    )
+
+    endpoint = request.url_rule.endpoint if request.url_rule else None
+    with _stats_lock:
+        for name, duration, queries in phases:
+            histogram = _stats.get((endpoint, name))
+            if histogram is None:
+                histogram = _stats[(endpoint, name)] = Histogram()
+            histogram.add(duration, queries)
+
+    threshold = app.config.get('SLOW_REQUEST_THRESHOLD')
+    directory = app.config.get('SLOW_REQUEST_DIR')
+    if threshold is not None and directory and total >= threshold * 1000:
+        dump_profile(directory, endpoint, phases)
+
+
+def dump_profile(directory, endpoint, phases):
+    """
+    Write the profile of the current request to a JSON file in `directory`
+
+    :param directory: The directory where the profiles are written
+    :param endpoint: The endpoint of the request
+    :param phases: A list of (name, duration, queries) tuples
+    """
+    filename = os.path.join(
+        directory, 'slow-%.6f-%d.json' % (time.time(), os.getpid())
+    )
+    try:
+        with open(filename, 'w') as profile_file:
+            json.dump({
+                'endpoint': endpoint,
+                'method': request.method,
+                'url': request.url,
+                'phases': [{
+                    'name': name,
+                    'duration_ms': round(duration, 3),
+                    'queries': queries,
+                } for name, duration, queries in phases],
+            }, profile_file, indent=2)
+    except (IOError, OSError), exc:
+        current_app.logger.warning(
+            "Could not dump the slow request profile: %s" % exc
+        )
+
+
+def discard_profile(app, **extra):
+    """
+    Stop counting the queries of a request which failed before it finished.
+    Connected to the `request_tearing_down` signal.
+    """
+    profile = _get_profile()
+    if profile is not None:
+        _stop_counting(profile)
+
+
+if signals_available:
+    request_started.connect(start_profile)
+    request_finished.connect(finish_profile)
+    request_tearing_down.connect(discard_profile)
@@ -0,0 +1,134 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import time
+import uuid
+from functools import wraps
+
+from nereid.globals import request, session, current_app
+from trytond.cache import Cache
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['cache_guest_response', 'purge_surrogate_keys', 'surrogate_key']
+
+#: The cached responses. Each entry is a tuple of the expiry time, the
+#: surrogate tokens the entry was cached with, and the response
+_responses = Cache('nereid.page_cache.responses', context=False)
+
+#: The current token of every surrogate key. Purging a key replaces its
+#: token, which makes every response cached with the old token stale.
+_surrogate_tokens = Cache('nereid.page_cache.surrogate_keys', context=False)
+
+
+def surrogate_key(model, record_id):
+    """
+    Returns the surrogate key of a record, which is purged when the record
+    is written
+
+    :param model: The name of the model of the record
+    :param record_id: The id of the record
+    """
+    return '%s,%d' % (model, record_id)
+
+
+def get_surrogate_tokens(keys):
+    """
+    Returns the current tokens of the given surrogate keys, creating the
+    tokens which do not exist yet
+    """
+    tokens = []
+    for key in keys:
+        token = _surrogate_tokens.get(key)
+        if token is None:
+            token = uuid.uuid4().hex
+            _surrogate_tokens.set(key, token)
+        tokens.append(token)
+    return tuple(tokens)
+
+
+def purge_surrogate_keys(keys):
+    """
+    Purge the cached responses which depend on any of the given surrogate
+    keys. The other processes drop all their tokens when the cache is
+    reset through Tryton.
+
+    :param keys: An iterable of surrogate keys, usually the keys of the
+                 records written (see :func:`surrogate_key`)
+    """
+    for key in keys:
+        _surrogate_tokens.set(key, uuid.uuid4().hex)
+    Cache.reset(
+        Transaction().cursor.database_name, _surrogate_tokens._name
+    )
+
+
+def cache_guest_response(*surrogate_keys):
+    """
+    Cache the full response of a handler for guest users if the URL rule
+    of the request has a cache timeout. The response is cached per
+    website, language, currency and URL, and only for GET and HEAD
+    requests which have no flashed messages to show.
+
+    The cached response is purged when its website record, or any of the
+    `surrogate_keys`, is purged with :func:`purge_surrogate_keys`. The keys
+    are strings, or functions called with the URL arguments of the handler
+    which return the keys of the records the response depends on::
+
+        @classmethod
+        @cache_guest_response(
+            lambda product: [surrogate_key('product.product', product)]
+        )
+        def render(cls, product):
+            ...
+
+    :param surrogate_keys: Keys of the records the response depends on, or
+                           functions returning them
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            URLRule = Pool().get('nereid.url_rule')
+            WebSite = Pool().get('nereid.website')
+
+            if request.method not in ('GET', 'HEAD') or \
+                    not request.is_guest_user or session.get('_flashes'):
+                return function(*args, **kwargs)
+            website = WebSite.get_descriptor()
+            timeout = URLRule.get_cache_timeout(
+                website.url_map, request.url_rule
+            )
+            if not timeout:
+                return function(*args, **kwargs)
+
+            key = (
+                website.id,
+                Transaction().language,
+                request.nereid_currency.id,
+                request.url,
+            )
+            keys = [surrogate_key(WebSite.__name__, website.id)]
+            for surrogate in surrogate_keys:
+                if callable(surrogate):
+                    keys.extend(surrogate(**kwargs))
+                else:
+                    keys.append(surrogate)
+            tokens = get_surrogate_tokens(keys)
+            entry = _responses.get(key)
+            if entry is not None:
+                expires_at, entry_tokens, (data, status, headers) = entry
+                if expires_at > time.time() and entry_tokens == tokens:
+                    return current_app.response_class(
+                        data, status=status, headers=headers
+                    )
+
+            response = current_app.make_response(function(*args, **kwargs))
+            if response.status_code == 200 and \
+                    not response.direct_passthrough:
+                _responses.set(key, (
+                    time.time() + timeout, tokens,
+                    (response.data, response.status_code,
+                        list(response.headers))
+                ))
+            return response
+        return wrapper
+    return decorator
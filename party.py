@@ -1,16 +1,14 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import datetime
+import hashlib
+import logging
 import random
 import string
 import urllib
 
-try:
-    import hashlib
-except ImportError:
-    hashlib = None
-    import sha
-
 import pytz
+from flask.signals import signals_available
 from wtforms import Form, TextField, IntegerField, SelectField, validators, \
     PasswordField
 from wtfrecaptcha.fields import RecaptchaField
@@ -19,20 +17,27 @@ from werkzeug import redirect, abort
 from nereid import request, url_for, render_template, login_required, flash, \
     jsonify
 from nereid.globals import session, current_app
-from nereid.signals import registration
+from nereid.signals import registration, request_started
 from nereid.templating import render_email
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pool import Pool
 from trytond.pyson import Eval, Bool, Not
 from trytond.transaction import Transaction
 from trytond.config import CONFIG
-from trytond.tools import get_smtp_server
+from trytond.cache import Cache
 
 from .i18n import _, get_translations
+from .tools import clean_record_cache
+from .instrumentation import phase
+from .rate_limit import rate_limited
+from .password import hash_password, verify_password, needs_rehash, \
+    PasswordPoolBusy
 
 __all__ = ['Address', 'Party', 'NereidUser',
            'ContactMechanism', 'Permission', 'UserPermission']
 
+logger = logging.getLogger('nereid.party')
+
 
 class RegistrationForm(Form):
     "Simple Registration form"
@@ -229,12 +234,13 @@ class NereidUser(ModelSQL, ModelView):
     #: The email of the user is also the login name/username of the user
     email = fields.Char("e-Mail", select=1)
 
-    #: The password is the user password + the salt, which is
-    #: then hashed together
-    password = fields.Sha('Password')
+    #: The hash of the password, prefixed by the name of the scheme used
+    #: to make it (see :mod:`trytond.modules.nereid.password`)
+    password = fields.Char('Password')
 
-    #: The salt which was used to make the hash is separately
-    #: stored. Needed for 
+    #: The salt of the SHA-1 hashes of the earlier versions, which did not
+    #: store the salt in the password. Cleared when the password is
+    #: hashed again.
     salt = fields.Char('Salt', size=8)
 
     #: A unique activation code required to match the user's request
@@ -257,18 +263,113 @@ class NereidUser(ModelSQL, ModelView):
     permissions = fields.Many2Many('nereid.permission-nereid.user',
         'nereid_user', 'permission', 'Permissions')
 
+    _permissions_cache = Cache('nereid.user.permissions', context=False)
+    _permissions_mask_cache = Cache(
+        'nereid.user.permissions_mask', context=False
+    )
+
     def get_permissions(self):
         """
-        Returns all the permissions as a list of names
+        Returns all the permissions as a frozenset of values
+
+        The permissions of each user are cached until permissions or the
+        permissions of users change.
+        """
+        permissions = self._permissions_cache.get(self.id)
+        if permissions is None:
+            permissions = frozenset([p.value for p in self.permissions])
+            self._permissions_cache.set(self.id, permissions)
+        return permissions
+
+    def get_permissions_mask(self):
+        """
+        Returns the permissions of the user as a bitmask (see
+        :meth:`Permission.get_bits`)
+        """
+        mask = self._permissions_mask_cache.get(self.id)
+        if mask is None:
+            bits = Pool().get('nereid.permission').get_bits()
+            mask = 0
+            for value in self.get_permissions():
+                mask |= bits[value]
+            self._permissions_mask_cache.set(self.id, mask)
+        return mask
+
+    @classmethod
+    def clear_permissions_cache(cls):
+        "Clear the cached permissions of the users"
+        cls._permissions_cache.clear()
+        cls._permissions_mask_cache.clear()
+
+    #: The fields kept in the snapshots of the users
+    SNAPSHOT_FIELDS = ('display_name', 'email', 'party', 'company', 'timezone')
+
+    _snapshot_cache = Cache('nereid.user.snapshot', context=False)
+
+    @classmethod
+    def get_snapshot(cls, user_id):
+        """
+        Returns a dictionary of the values of the :attr:`SNAPSHOT_FIELDS`
+        of the user (the ids for the many2one fields), or None if the user
+        does not exist. The snapshots are cached until these fields of the
+        users change. The permissions are cached separately by
+        :meth:`get_permissions`.
+
+        :param user_id: The id of the user
+        """
+        snapshot = cls._snapshot_cache.get(user_id)
+        if snapshot is None:
+            users = cls.search([('id', '=', user_id)])
+            if not users:
+                return None
+            user, = users
+            snapshot = {
+                'display_name': user.display_name,
+                'email': user.email,
+                'party': user.party.id,
+                'company': user.company.id,
+                'timezone': user.timezone,
+            }
+            cls._snapshot_cache.set(user_id, snapshot)
+        return snapshot
+
+    @classmethod
+    def from_snapshot(cls, user_id):
+        """
+        Returns the user with the values of its snapshot in the read
+        caches, as if they had been read from the database. The values are
+        not set on the record, so :meth:`save` does not write them back.
+        The values already read in the transaction are kept, and the other
+        fields are read from the database only when they are used.
+
+        :param user_id: The id of the user
         """
-        # TODO: Cache this value for each user to avoid hitting the database
-        # everytime.
-        return frozenset([p.value for p in self.permissions])
+        user = cls(user_id)
+        snapshot = cls.get_snapshot(user_id)
+        if snapshot is None:
+            return user
+        read_cache = user._cache.setdefault(user_id, {})
+        local_cache = user._local_cache.setdefault(user_id, {})
+        for name, value in snapshot.iteritems():
+            field = cls._fields[name]
+            if field._type == 'many2one':
+                # The many2one fields are only read from the local cache,
+                # as records
+                if name not in local_cache:
+                    local_cache[name] = field.get_target()(value)
+            elif name not in read_cache:
+                read_cache[name] = value
+        return user
 
     def has_permissions(self, perm_all=None, perm_any=None):
         """Check if the user has all required permissions in perm_all and
         has any permission from perm_any for access
 
+        The permissions are compared as bitmasks (see
+        :meth:`Permission.compile_masks`). The masks are cached when the
+        arguments are hashable, so pass frozensets or tuples for the
+        checks which are repeated.
+
         :param perm_all: A set/frozenset of all permission values/keywords.
         :param perm_any: A set/frozenset of any permission values/keywords.
 
@@ -277,15 +378,16 @@ class NereidUser(ModelSQL, ModelView):
         if not perm_all and not perm_any:
             # Access allowed if no permission is required
             return True
-        if not isinstance(perm_all, (set, frozenset)):
-            perm_all = frozenset(perm_all if perm_all else [])
-        if not isinstance(perm_any, (set, frozenset)):
-            perm_any = frozenset(perm_any if perm_any else [])
-        current_user_permissions = self.get_permissions()
+        Permission = Pool().get('nereid.permission')
+        mask_all, mask_any = Permission.compile_masks(perm_all, perm_any)
+        if mask_all is None:
+            # A required permission does not exist
+            return False
+        mask = self.get_permissions_mask()
 
-        if perm_all and not perm_all.issubset(current_user_permissions):
+        if mask & mask_all != mask_all:
             return False
-        if perm_any and not perm_any.intersection(current_user_permissions):
+        if mask_any is not None and not mask & mask_any:
             return False
         return True
 
@@ -343,37 +445,54 @@ class NereidUser(ModelSQL, ModelView):
         return registration_form
 
     @classmethod
+    @rate_limited('registration')
     def registration(cls):
         """
         Invokes registration of an user
         """
         Party = Pool().get('party.party')
+        WebSite = Pool().get('nereid.website')
 
         registration_form = cls.get_registration_form()
 
-        if request.method == 'POST' and registration_form.validate():
-            existing = cls.search([
-                ('email', '=', request.form['email']),
-                ('company', '=', request.nereid_website.company.id),
-                ])
+        with phase('validate'):
+            valid = request.method == 'POST' and registration_form.validate()
+
+        if valid:
+            company = WebSite.get_descriptor().company
+            with phase('search'):
+                existing = cls.search([
+                    ('email', '=', request.form['email']),
+                    ('company', '=', company),
+                    ])
             if existing:
                 flash(_('A registration already exists with this email. '
                     'Please contact customer care')
                 )
             else:
-                party = Party(name=registration_form.name.data)
-                party.save()
-                nereid_user = cls(**{
-                    'party': party.id,
-                    'display_name': registration_form.name.data,
-                    'email': registration_form.email.data,
-                    'password': registration_form.password.data,
-                    'company': request.nereid_website.company.id,
-                    })
-                nereid_user.save()
-                nereid_user.create_act_code()
-                registration.send(nereid_user)
-                nereid_user.send_activation_email()
+                with phase('create'):
+                    party = Party(name=registration_form.name.data)
+                    party.save()
+                    nereid_user = cls(**{
+                        'party': party.id,
+                        'display_name': registration_form.name.data,
+                        'email': registration_form.email.data,
+                        'password': registration_form.password.data,
+                        'company': company,
+                        })
+                    try:
+                        nereid_user.save()
+                    except PasswordPoolBusy:
+                        Party.delete([party])
+                        flash(_("We are receiving too many requests right "
+                            "now. Please try again in a moment"))
+                        return render_template(
+                            'registration.jinja', form=registration_form
+                        )
+                    nereid_user.create_act_code()
+                    registration.send(nereid_user)
+                with phase('email'):
+                    nereid_user.send_activation_email()
                 flash(
                     _('Registration Complete. Check your email for activation')
                 )
@@ -381,11 +500,15 @@ class NereidUser(ModelSQL, ModelView):
                     request.args.get('next', url_for('nereid.website.home'))
                 )
 
-        return render_template('registration.jinja', form=registration_form)
+        with phase('render'):
+            return render_template(
+                'registration.jinja', form=registration_form
+            )
 
     def send_activation_email(self):
         """
-        Send an activation email to the user
+        Queue an activation email to the user. It is sent in the background
+        by the email queue.
 
         :param nereid_user: The browse record of the user
         """
@@ -395,11 +518,9 @@ class NereidUser(ModelSQL, ModelView):
             html_template = 'emails/activation-html.jinja',
             nereid_user = self
         )
-        server = get_smtp_server()
-        server.sendmail(
+        Pool().get('nereid.email.queue').queue_mail(
             CONFIG['smtp_from'], [self.email], email_message.as_string()
         )
-        server.quit()
 
     @classmethod
     @login_required
@@ -414,11 +535,28 @@ class NereidUser(ModelSQL, ModelView):
         form = ChangePasswordForm(request.form)
 
         if request.method == 'POST' and form.validate():
-            if request.nereid_user.match_password(form.old_password.data):
-                cls.write(
-                    [request.nereid_user],
-                    {'password': form.password.data}
+            try:
+                matched = request.nereid_user.match_password(
+                    form.old_password.data
+                )
+            except PasswordPoolBusy:
+                flash(_("We are receiving too many requests right now. "
+                    "Please try again in a moment"))
+                return render_template(
+                    'change-password.jinja', change_password_form=form
                 )
+            if matched:
+                try:
+                    cls.write(
+                        [request.nereid_user],
+                        {'password': form.password.data}
+                    )
+                except PasswordPoolBusy:
+                    flash(_("We are receiving too many requests right now. "
+                        "Please try again in a moment"))
+                    return render_template(
+                        'change-password.jinja', change_password_form=form
+                    )
                 flash(
                     _('Your password has been successfully changed! '
                     'Please login again')
@@ -456,10 +594,17 @@ class NereidUser(ModelSQL, ModelView):
                 current_app.logger.debug('New password not allowed in session')
                 abort(403)
 
-            cls.write(
-                [request.nereid_user],
-                {'password': form.password.data}
-            )
+            try:
+                cls.write(
+                    [request.nereid_user],
+                    {'password': form.password.data}
+                )
+            except PasswordPoolBusy:
+                flash(_("We are receiving too many requests right now. "
+                    "Please try again in a moment"))
+                return render_template(
+                    'new-password.jinja', password_form=form
+                )
             session.pop('allow_new_password')
             flash(_('Your password has been successfully changed! '
                 'Please login again')
@@ -513,6 +658,7 @@ class NereidUser(ModelSQL, ModelView):
         return self.write([self], {'activation_code': act_code})
 
     @classmethod
+    @rate_limited('reset_account')
     def reset_account(cls):
         """
         Reset the password for the user.
@@ -522,29 +668,36 @@ class NereidUser(ModelSQL, ModelView):
             code and sends the link to the email of the user. If the user uses
             the link, he can change his password.
         """
+        WebSite = Pool().get('nereid.website')
+
         if request.method == 'POST':
-            user_ids = cls.search([
-                ('email', '=', request.form['email']),
-                ('company', '=', request.nereid_website.company.id),
-                ])
+            with phase('search'):
+                user_ids = cls.search([
+                    ('email', '=', request.form['email']),
+                    ('company', '=', WebSite.get_descriptor().company),
+                    ])
 
             if not user_ids or not request.form['email']:
                 flash(_('Invalid email address'))
-                return render_template('reset-password.jinja')
+                with phase('render'):
+                    return render_template('reset-password.jinja')
 
             nereid_user, = user_ids
 
             nereid_user.create_act_code("reset")
-            nereid_user.send_reset_email()
+            with phase('email'):
+                nereid_user.send_reset_email()
             flash(_('An email has been sent to your account for resetting'
                 ' your credentials'))
             return redirect(url_for('nereid.website.login'))
 
-        return render_template('reset-password.jinja')
+        with phase('render'):
+            return render_template('reset-password.jinja')
 
     def send_reset_email(self):
         """
-        Send an account reset email to the user
+        Queue an account reset email to the user. It is sent in the
+        background by the email queue.
 
         :param nereid_user: The browse record of the user
         """
@@ -554,11 +707,9 @@ class NereidUser(ModelSQL, ModelView):
             html_template = 'emails/reset-html.jinja',
             nereid_user = self
         )
-        server = get_smtp_server()
-        server.sendmail(
+        Pool().get('nereid.email.queue').queue_mail(
             CONFIG['smtp_from'], [self.email], email_message.as_string()
         )
-        server.quit()
 
     def match_password(self, password):
         """
@@ -566,70 +717,125 @@ class NereidUser(ModelSQL, ModelView):
 
         :param password: The password of the user (string or unicode)
         :return: True or False
+        :raises PasswordPoolBusy: If the password cannot be verified now
+                                  because the worker pool is full
         """
-        password += self.salt or ''
-        if isinstance(password, unicode):
-            password = password.encode('utf-8')
-        if hashlib:
-            digest = hashlib.sha1(password).hexdigest()
-        else:
-            digest = sha.new(password).hexdigest()
-        return (digest == self.password)
+        return verify_password(password, self.password, self.salt)
+
+    @classmethod
+    def get_credentials(cls, email, company):
+        """
+        Returns the id, password hash, salt and activation code of the
+        users with the email in the company. This is a single query served
+        by the index on (email, company), without loading the records.
+
+        :param email: email of the user
+        :param company: id of the company
+        :return: A list of (id, password, salt, activation_code) tuples
+        """
+        cursor = Transaction().cursor
+        cursor.execute(
+            'SELECT id, password, salt, activation_code '
+            'FROM "' + cls._table + '" '
+            'WHERE email = %s AND company = %s', (email, int(company))
+        )
+        return cursor.fetchall()
 
     @classmethod
-    def authenticate(cls, email, password):
+    def authenticate(cls, email, password, company=None):
         """Assert credentials and if correct return the
         browse record of the user
 
+        The request is only used to flash messages, so this can be called
+        without one when the company is given.
+
         :param email: email of the user
         :param password: password of the user
+        :param company: id of the company of the user. Defaults to the
+                        company of the website of the current request.
         :return:
             Browse Record: Successful Login
             None: User cannot be found or wrong password
-            False: Account is inactive
+            False: Account is inactive, or the password cannot be verified
+                now because the server is busy
         """
+        WebSite = Pool().get('nereid.website')
 
-        users = cls.search([
-            ('email', '=', request.form['email']),
-            ('company', '=', request.nereid_website.company.id),
-        ])
+        if company is None:
+            company = WebSite.get_descriptor().company
+        users = cls.get_credentials(email, company)
 
         if not users:
-            current_app.logger.debug("No user with email %s" % email)
+            logger.debug("No user with email %s" % email)
             return None
 
         if len(users) > 1:
-            current_app.logger.debug('%s has too many accounts' % email)
+            logger.debug('%s has too many accounts' % email)
             return None
 
-        user, = users
-        if user.activation_code and len(user.activation_code) == 16:
+        (user_id, hashed, salt, activation_code), = users
+        if activation_code and len(activation_code) == 16:
             # A new account with activation pending
-            current_app.logger.debug('%s not activated' % email)
-            flash(_("Your account has not been activated yet!"))
+            logger.debug('%s not activated' % email)
+            if request:
+                flash(_("Your account has not been activated yet!"))
             return False # False so to avoid `invalid credentials` flash
 
-        if user.match_password(password):
-            # Reset any reset activation code that might be there since its a 
-            # successful login with the old password
-            if user.activation_code:
-                cls.write([user], {'activation_code': None})
-            return user
+        try:
+            matched = verify_password(password, hashed, salt)
+        except PasswordPoolBusy:
+            logger.warning(
+                'Too many logins waiting, %s must try again' % email
+            )
+            if request:
+                flash(_("We are receiving too many logins right now. "
+                    "Please try again in a moment"))
+            return False
 
-        return None
+        if not matched:
+            return None
+
+        # Reset any reset activation code that might be there since its a
+        # successful login with the old password, and upgrade the hash to
+        # the current scheme and cost, in a single UPDATE
+        columns, params = [], []
+        if activation_code:
+            columns.append('activation_code = %s')
+            params.append(None)
+        if needs_rehash(hashed):
+            try:
+                rehashed = hash_password(password, wait=False)
+            except PasswordPoolBusy:
+                # The login must not wait for the busy pool, the hash is
+                # upgraded on a later login
+                rehashed = None
+            if rehashed:
+                columns.extend(['password = %s', 'salt = %s'])
+                params.extend([rehashed, None])
+        if columns:
+            columns.extend(['write_uid = %s', 'write_date = %s'])
+            params.extend([Transaction().user, datetime.datetime.now()])
+            Transaction().cursor.execute(
+                'UPDATE "' + cls._table + '" '
+                'SET ' + ', '.join(columns) + ' WHERE id = %s',
+                params + [user_id]
+            )
+            clean_record_cache(cls, [user_id])
+        return cls(user_id)
 
     @staticmethod
     def _convert_values(values):
         """
         A helper method which looks if the password is specified in the values.
-        If it is, then the salt is also made and added
+        If it is, then it is replaced by its hash
+
+        :raises PasswordPoolBusy: If the password cannot be hashed now
 
         :param values: A dictionary of field: value pairs
         """
         if 'password' in values and values['password']:
-            values['salt'] = ''.join(random.sample(
-                string.ascii_letters + string.digits, 8))
-            values['password'] += values['salt']
+            values['password'] = hash_password(values['password'])
+            values['salt'] = None
 
         return values
 
@@ -641,16 +847,31 @@ class NereidUser(ModelSQL, ModelView):
         :param vlist: List of dictionary of Values
         """
         vlist = [cls._convert_values(vals.copy()) for vals in vlist]
-        return super(NereidUser, cls).create(vlist)
+        users = super(NereidUser, cls).create(vlist)
+        # Some databases reuse the ids of the users of rolled back
+        # transactions
+        cls._snapshot_cache.clear()
+        return users
 
     @classmethod
     def write(cls, nereid_users, values):
         """
         Update salt before saving
         """
-        return super(NereidUser, cls).write(
+        rv = super(NereidUser, cls).write(
             nereid_users, cls._convert_values(values)
         )
+        if 'permissions' in values:
+            cls.clear_permissions_cache()
+        if any(name in values for name in cls.SNAPSHOT_FIELDS):
+            cls._snapshot_cache.clear()
+        return rv
+
+    @classmethod
+    def delete(cls, nereid_users):
+        cls.clear_permissions_cache()
+        cls._snapshot_cache.clear()
+        return super(NereidUser, cls).delete(nereid_users)
 
     @staticmethod
     def get_gravatar_url(email, **kwargs):
@@ -833,6 +1054,90 @@ class Permission(ModelSQL, ModelView):
                 'Permissions must be unique by value'),
             ]
 
+    _bits_cache = Cache('nereid.permission.bits', context=False)
+    _masks_cache = Cache('nereid.permission.masks', context=False)
+
+    @classmethod
+    def create(cls, vlist):
+        permissions = super(Permission, cls).create(vlist)
+        cls.clear_masks_cache()
+        return permissions
+
+    @classmethod
+    def write(cls, permissions, values):
+        rv = super(Permission, cls).write(permissions, values)
+        if 'value' in values:
+            cls.clear_masks_cache()
+            Pool().get('nereid.user').clear_permissions_cache()
+        return rv
+
+    @classmethod
+    def delete(cls, permissions):
+        # The permissions of the users are deleted by the database (CASCADE)
+        cls.clear_masks_cache()
+        Pool().get('nereid.user').clear_permissions_cache()
+        return super(Permission, cls).delete(permissions)
+
+    @classmethod
+    def clear_masks_cache(cls):
+        "Clear the cached bits and masks of the permissions"
+        cls._bits_cache.clear()
+        cls._masks_cache.clear()
+
+    @classmethod
+    def get_bits(cls):
+        """
+        Returns a dictionary of the bit of each permission value. The bit
+        of a permission is its rank in the permissions ordered by id, so
+        the masks are as small as the number of permissions. A new
+        permission takes the next bit, and the bits only shift when a
+        permission is deleted, which clears the cached masks.
+        """
+        bits = cls._bits_cache.get('bits')
+        if bits is None:
+            cursor = Transaction().cursor
+            cursor.execute(
+                'SELECT value FROM "' + cls._table + '" ORDER BY id'
+            )
+            bits = dict(
+                (value, 1 << rank)
+                for rank, (value,) in enumerate(cursor.fetchall())
+            )
+            cls._bits_cache.set('bits', bits)
+        return bits
+
+    @classmethod
+    def compile_masks(cls, perm_all=None, perm_any=None):
+        """
+        Returns a tuple of the bitmasks of the permission values in
+        `perm_all` and `perm_any`. The first mask is None if one of the
+        values of `perm_all` is not a permission (it can never be
+        satisfied), and the second is None if `perm_any` is empty.
+
+        The masks are cached by the arguments when they are hashable, so a
+        decorator passing the same frozenset compiles it only once.
+
+        :param perm_all: An iterable of permission values
+        :param perm_any: An iterable of permission values
+        """
+        key = (perm_all, perm_any)
+        masks = cls._masks_cache.get(key)
+        if masks is None:
+            bits = cls.get_bits()
+            mask_all = 0
+            for value in perm_all or []:
+                if value not in bits:
+                    mask_all = None
+                    break
+                mask_all |= bits[value]
+            mask_any = None
+            if perm_any:
+                mask_any = 0
+                for value in perm_any:
+                    mask_any |= bits.get(value, 0)
+            masks = (mask_all, mask_any)
+            cls._masks_cache.set(key, masks)
+        return masks
 
 
 class UserPermission(ModelSQL):
@@ -843,3 +1148,40 @@ class UserPermission(ModelSQL):
         ondelete='CASCADE', select=True, required=True)
     nereid_user = fields.Many2One('nereid.user', 'User',
         ondelete='CASCADE', select=True, required=True)
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(UserPermission, cls).create(vlist)
+        Pool().get('nereid.user').clear_permissions_cache()
+        return records
+
+    @classmethod
+    def write(cls, records, values):
+        rv = super(UserPermission, cls).write(records, values)
+        Pool().get('nereid.user').clear_permissions_cache()
+        return rv
+
+    @classmethod
+    def delete(cls, records):
+        Pool().get('nereid.user').clear_permissions_cache()
+        return super(UserPermission, cls).delete(records)
+
+
+def load_user_snapshot(app, **extra):
+    """
+    Set the user of the request from its cached snapshot instead of
+    browsing the user and the website on first use. Connected to the
+    `request_started` signal.
+    """
+    NereidUser = Pool().get('nereid.user')
+    WebSite = Pool().get('nereid.website')
+
+    if 'user' in session:
+        user_id = session['user']
+    else:
+        user_id = WebSite.get_descriptor().guest_user
+    request.nereid_user = NereidUser.from_snapshot(user_id)
+
+
+if signals_available:
+    request_started.connect(load_user_snapshot)
@@ -0,0 +1,423 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Password hashing
+
+Passwords are stored as ``<scheme>$<cost>$<salt>$<hash>`` where `scheme`
+is the name of a :class:`PasswordScheme` registered with
+:func:`register_scheme`. New passwords are hashed with the scheme set by
+the `nereid_password_scheme` option of the Tryton configuration
+(`pbkdf2_sha256` by default), at the cost set by the
+`nereid_password_cost_<scheme>` option::
+
+    [options]
+    nereid_password_scheme = pbkdf2_sha256
+    nereid_password_cost_pbkdf2_sha256 = 100000
+
+Hashes without a scheme are the SHA-1 of the password and the salt (kept
+in a separate field) used by the earlier versions of nereid.
+
+The hashing can be moved out of the request threads into a pool of
+`nereid_password_workers` processes. At most `nereid_password_queue`
+passwords (four per worker by default) may then wait to be verified;
+:func:`verify_password` raises :exc:`PasswordPoolBusy` beyond that instead
+of queuing more work, so that a burst of logins does not starve the other
+requests. It is also raised when a worker does not answer within
+`nereid_password_timeout` seconds (10 by default).
+
+The workers are forked by :func:`start_worker_pool`, which must be called
+when the server starts, before the database connections and the threads
+are created, so that the workers do not inherit them::
+
+    from trytond.modules.nereid.password import start_worker_pool
+
+    start_worker_pool()
+    app.initialise()
+
+The passwords are hashed in the calling thread if the pool is not started.
+
+Run this module to measure the number of logins per second a worker can
+handle for each scheme and cost::
+
+    python -m trytond.modules.nereid.password pbkdf2_sha256:10000 ...
+"""
+import atexit
+import binascii
+import hashlib
+import hmac
+import logging
+import os
+import sys
+import time
+from multiprocessing import Pool, TimeoutError
+from threading import Lock, BoundedSemaphore
+
+from trytond.config import CONFIG
+
+__all__ = [
+    'PasswordScheme', 'register_scheme', 'hash_password', 'verify_password',
+    'needs_rehash', 'PasswordPoolBusy', 'start_worker_pool',
+    'stop_worker_pool',
+]
+
+logger = logging.getLogger('nereid.password')
+
+#: The registered schemes by name
+SCHEMES = {}
+
+#: The scheme used to hash new passwords if none is configured
+DEFAULT_SCHEME = 'pbkdf2_sha256'
+
+
+class PasswordScheme(object):
+    """
+    A password hashing scheme. Subclasses define the name, the default
+    cost and the :meth:`digest` of a password.
+    """
+    name = None
+    default_cost = 1
+
+    def get_cost(self):
+        "Returns the configured cost of the scheme"
+        return int(
+            CONFIG.get('nereid_password_cost_%s' % self.name)
+            or self.default_cost
+        )
+
+    def digest(self, password, salt, cost):
+        """
+        Returns the hex digest of the password
+
+        :param password: The password as a byte string
+        :param salt: The salt as a byte string
+        :param cost: The cost factor of the scheme
+        """
+        raise NotImplementedError
+
+    def hash(self, password, cost=None):
+        """
+        Returns the password hashed with a new salt in the storage format
+
+        :param password: The password (string or unicode)
+        :param cost: The cost factor, defaults to the configured one
+        """
+        if cost is None:
+            cost = self.get_cost()
+        salt = binascii.hexlify(os.urandom(8))
+        return '%s$%d$%s$%s' % (
+            self.name, cost, salt, self.digest(_encode(password), salt, cost)
+        )
+
+    def verify(self, password, hashed):
+        """
+        Checks if the password matches the hash
+
+        :param password: The password (string or unicode)
+        :param hashed: The hash in the storage format
+        """
+        name, cost, salt, digest = _encode(hashed).split('$')
+        return _compare(
+            self.digest(_encode(password), salt, int(cost)), digest
+        )
+
+    def needs_rehash(self, hashed):
+        "Checks if the hash was made with a cost other than the current one"
+        return int(hashed.split('$')[1]) != self.get_cost()
+
+
+class SHA1(PasswordScheme):
+    "The SHA-1 of the password and the salt. Only kept for old passwords."
+    name = 'sha1'
+
+    def digest(self, password, salt, cost):
+        return hashlib.sha1(password + salt).hexdigest()
+
+
+class PBKDF2SHA256(PasswordScheme):
+    "PBKDF2 with HMAC-SHA256, the cost being the number of iterations"
+    name = 'pbkdf2_sha256'
+    default_cost = 100000
+
+    def digest(self, password, salt, cost):
+        return binascii.hexlify(pbkdf2_hmac('sha256', password, salt, cost))
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+_TRANS_5C = ''.join(chr(x ^ 0x5C) for x in xrange(256))
+_TRANS_36 = ''.join(chr(x ^ 0x36) for x in xrange(256))
+
+
+def _pbkdf2_hmac(hash_name, password, salt, iterations):
+    """
+    PBKDF2 with HMAC producing a key of the size of the digest, for the
+    Pythons without :func:`hashlib.pbkdf2_hmac` (before 2.7.8)
+    """
+    inner = hashlib.new(hash_name)
+    outer = hashlib.new(hash_name)
+    block_size = inner.block_size
+    if len(password) > block_size:
+        password = hashlib.new(hash_name, password).digest()
+    password = password + '\x00' * (block_size - len(password))
+    inner.update(password.translate(_TRANS_36))
+    outer.update(password.translate(_TRANS_5C))
+
+    def prf(message):
+        inner_copy, outer_copy = inner.copy(), outer.copy()
+        inner_copy.update(message)
+        outer_copy.update(inner_copy.digest())
+        return outer_copy.digest()
+
+    previous = prf(salt + '\x00\x00\x00\x01')
+    key = int(binascii.hexlify(previous), 16)
+    for _ in xrange(iterations - 1):
+        previous = prf(previous)
+        key ^= int(binascii.hexlify(previous), 16)
+    return binascii.unhexlify('%0*x' % (inner.digest_size * 2, key))
+
+
+def _compare_digest(a, b):
+    """
+    Compare the strings in a time which does not depend on where they
+    differ, for the Pythons without :func:`hmac.compare_digest` (before
+    2.7.7)
+    """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+pbkdf2_hmac = getattr(hashlib, 'pbkdf2_hmac', _pbkdf2_hmac)
+compare_digest = getattr(hmac, 'compare_digest', _compare_digest)
+
+
+def _compare(a, b):
+    "Compare the digests in constant time"
+    return compare_digest(_encode(a), _encode(b))
+
+
+def register_scheme(scheme):
+    """
+    Register a password scheme
+
+    :param scheme: An instance of :class:`PasswordScheme`
+    """
+    SCHEMES[scheme.name] = scheme
+
+
+register_scheme(SHA1())
+register_scheme(PBKDF2SHA256())
+
+
+class PasswordPoolBusy(Exception):
+    "Raised when too many passwords are already waiting to be verified"
+
+
+class _WorkerPool(object):
+    """
+    A pool of processes hashing the passwords, with a bounded number of
+    pending tasks and a timeout on each of them
+    """
+
+    def __init__(self, processes, queue_size, timeout):
+        self.pool = Pool(processes)
+        self.slots = BoundedSemaphore(queue_size)
+        self.timeout = timeout
+
+    def run(self, function, args, wait):
+        """
+        Run the function in a worker and return its result
+
+        :param wait: Wait for a free slot if the queue is full instead of
+                     raising :exc:`PasswordPoolBusy`
+        :raises PasswordPoolBusy: If there is no free slot and `wait` is
+                                  False, or if the worker does not answer
+                                  in time
+        """
+        if not self.slots.acquire(wait):
+            raise PasswordPoolBusy()
+        try:
+            return self.pool.apply_async(function, args).get(self.timeout)
+        except TimeoutError:
+            raise PasswordPoolBusy()
+        finally:
+            self.slots.release()
+
+    def close(self):
+        "Terminate the workers, if they are not terminated yet"
+        if self.pool is None:
+            return
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+
+_worker_pool = None
+_worker_pool_lock = Lock()
+_warned_not_started = False
+
+
+def start_worker_pool():
+    """
+    Fork the `nereid_password_workers` processes hashing the passwords, if
+    any are configured and they are not started yet. Call it when the
+    server starts, before any database connection or thread exists.
+
+    :return: The worker pool, or None if no worker is configured
+    """
+    global _worker_pool
+    processes = int(CONFIG.get('nereid_password_workers') or 0)
+    if not processes:
+        return None
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = _WorkerPool(
+                processes,
+                int(CONFIG.get('nereid_password_queue') or processes * 4),
+                float(CONFIG.get('nereid_password_timeout') or 10),
+            )
+            atexit.register(_worker_pool.close)
+    return _worker_pool
+
+
+def stop_worker_pool():
+    "Terminate the worker processes started by :func:`start_worker_pool`"
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is not None:
+            _worker_pool.close()
+            _worker_pool = None
+
+
+def _get_worker_pool():
+    """
+    Returns the worker pool, or None if the passwords are hashed in the
+    calling thread. The pool is never started here: forking from a
+    request thread would copy its database connections and the locks
+    held by the other threads into the workers.
+    """
+    global _warned_not_started
+    if _worker_pool is None and not _warned_not_started and \
+            CONFIG.get('nereid_password_workers'):
+        _warned_not_started = True
+        logger.warning(
+            'nereid_password_workers is set but start_worker_pool() was '
+            'not called, passwords are hashed in the request threads'
+        )
+    return _worker_pool
+
+
+def _run(function, args, wait):
+    "Run the function in the worker pool if there is one"
+    pool = _get_worker_pool()
+    if pool is None:
+        return function(*args)
+    return pool.run(function, args, wait)
+
+
+def get_scheme(name=None):
+    """
+    Returns the scheme with the given name, or the configured one
+
+    :param name: Name of the scheme
+    """
+    return SCHEMES[
+        name or CONFIG.get('nereid_password_scheme') or DEFAULT_SCHEME
+    ]
+
+
+def _hash_password(name, cost, password):
+    return SCHEMES[name].hash(password, cost)
+
+
+def hash_password(password, wait=True):
+    """
+    Returns the password hashed with the configured scheme
+
+    :param password: The password (string or unicode)
+    :param wait: Wait for the worker pool if too many passwords are waiting
+                 instead of raising :exc:`PasswordPoolBusy`
+    :raises PasswordPoolBusy: If the pool is busy and `wait` is False, or
+                              if the worker does not answer in time
+    """
+    scheme = get_scheme()
+    return _run(
+        _hash_password, (scheme.name, scheme.get_cost(), password), wait
+    )
+
+
+def verify_password(password, hashed, salt=None):
+    """
+    Checks if the password matches the hash
+
+    :param password: The password (string or unicode)
+    :param hashed: The stored hash
+    :param salt: The salt of the hashes of the earlier versions, which do
+                 not have a scheme
+    :raises PasswordPoolBusy: If too many passwords are waiting to be
+                              verified by the worker pool
+    """
+    return _run(_verify_password, (password, hashed, salt), False)
+
+
+def _verify_password(password, hashed, salt):
+    if not hashed:
+        return False
+    if '$' not in hashed:
+        return _compare(
+            SHA1().digest(_encode(password), _encode(salt or ''), 1), hashed
+        )
+    name = hashed.split('$', 1)[0]
+    if name not in SCHEMES:
+        return False
+    return SCHEMES[name].verify(password, hashed)
+
+
+def needs_rehash(hashed):
+    """
+    Checks if the hash must be replaced because it was not made with the
+    configured scheme and cost
+
+    :param hashed: The stored hash
+    """
+    if not hashed or '$' not in hashed:
+        return True
+    scheme = get_scheme()
+    if hashed.split('$', 1)[0] != scheme.name:
+        return True
+    return scheme.needs_rehash(hashed)
+
+
+def benchmark(name, cost, duration=1.0):
+    """
+    Returns the number of passwords a single worker can verify per second
+    with the given scheme and cost
+
+    :param name: Name of the scheme
+    :param cost: The cost factor
+    :param duration: The minimum duration of the measure in seconds
+    """
+    scheme = SCHEMES[name]
+    hashed = scheme.hash('password', cost)
+    count, started = 0, time.time()
+    while True:
+        scheme.verify('password', hashed)
+        count += 1
+        elapsed = time.time() - started
+        if elapsed >= duration:
+            return count / elapsed
+
+
+if __name__ == '__main__':
+    for argument in sys.argv[1:] or ['sha1:1', 'pbkdf2_sha256:100000']:
+        name, cost = argument.split(':')
+        print '%-16s cost %-8s %10.1f logins/s per worker' % (
+            name, cost, benchmark(name, int(cost))
+        )
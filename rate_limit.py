@@ -0,0 +1,272 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Rate limiting
+
+Throttles the expensive handlers (login, account reset, registration)
+before they do any database, hashing or SMTP work. Every POST to a
+handler decorated with :func:`rate_limited` is counted in a sliding
+window per client IP and per email address, separately for each website.
+Rate limiting is disabled unless the `RATE_LIMITS` setting of the
+application gives the limits of the scopes as a `(limit, window)` tuple,
+the window being in seconds::
+
+    RATE_LIMITS = {
+        'login': (10, 60),
+        'reset_account': (3, 3600),
+        'registration': (5, 3600),
+    }
+
+A client over the limit is locked out for `RATE_LIMIT_LOCKOUT` seconds if
+the setting is given, and until the window allows it again otherwise.
+Rejected requests are answered with a `429` and a `Retry-After` header.
+
+The counters are kept in the memory of the process by default. Set
+`RATE_LIMIT_BACKEND` to an instance of :class:`RateLimitBackend` to share
+them between processes, for example a :class:`MemcacheBackend`.
+"""
+import hashlib
+import time
+from collections import deque
+from functools import wraps
+from threading import Lock
+
+from nereid.globals import request, current_app
+from nereid.helpers import get_website_from_host
+
+from .i18n import _
+
+__all__ = [
+    'rate_limited', 'RateLimitBackend', 'MemoryBackend', 'MemcacheBackend',
+]
+
+
+class RateLimitBackend(object):
+    """
+    Stores the hits of the rate limited keys. Subclasses must be safe to
+    use from several threads.
+    """
+
+    def hit(self, key, limit, window):
+        """
+        Record a hit on the key unless it is over the limit
+
+        :param key: The key as a string
+        :param limit: The number of hits allowed in the window
+        :param window: The duration of the window in seconds
+        :return: 0 if the hit is allowed, or the number of seconds after
+                 which it would be
+        """
+        raise NotImplementedError
+
+    def lock(self, key, duration):
+        """
+        Reject the hits on the key for the given number of seconds
+
+        :param key: The key as a string
+        :param duration: The duration of the lockout in seconds
+        """
+        raise NotImplementedError
+
+
+class MemoryBackend(RateLimitBackend):
+    """
+    Keeps the time of the hits of each key in the memory of the process.
+    The keys which have not been hit for a while are dropped once there
+    are more than `max_keys` of them, and then the least recently hit
+    keys if there are still too many, so that a client hitting a new key
+    on every request cannot grow the memory without bound.
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self.hits = {}
+        self.locks = {}
+        self.mutex = Lock()
+
+    def hit(self, key, limit, window):
+        now = time.time()
+        with self.mutex:
+            locked_until = self.locks.get(key)
+            if locked_until is not None:
+                if locked_until > now:
+                    return locked_until - now
+                del self.locks[key]
+
+            hits = self.hits.get(key)
+            if hits is None:
+                if len(self.hits) >= self.max_keys:
+                    self._purge(now - window)
+                    self._evict()
+                hits = self.hits[key] = deque(maxlen=limit)
+            while hits and hits[0] <= now - window:
+                hits.popleft()
+            if len(hits) >= limit:
+                return hits[0] + window - now
+            hits.append(now)
+            return 0
+
+    def lock(self, key, duration):
+        with self.mutex:
+            self.locks[key] = time.time() + duration
+
+    def _purge(self, expired):
+        "Drop the keys which were not hit since `expired`"
+        for key, hits in self.hits.items():
+            if not hits or hits[-1] <= expired:
+                del self.hits[key]
+        now = time.time()
+        for key, locked_until in self.locks.items():
+            if locked_until <= now:
+                del self.locks[key]
+
+    def _evict(self):
+        """
+        Drop the least recently hit keys (and the locks ending first) down
+        to 90% of `max_keys`, so that the eviction is not repeated on
+        every new key
+        """
+        keep = self.max_keys * 9 // 10
+        if len(self.hits) >= self.max_keys:
+            by_last_hit = sorted(
+                self.hits, key=lambda k: self.hits[k][-1] if self.hits[k]
+                else 0
+            )
+            for key in by_last_hit[:len(self.hits) - keep]:
+                del self.hits[key]
+        if len(self.locks) >= self.max_keys:
+            by_end = sorted(self.locks, key=self.locks.get)
+            for key in by_end[:len(self.locks) - keep]:
+                del self.locks[key]
+
+
+class MemcacheBackend(RateLimitBackend):
+    """
+    Shares the counters through a memcached client (anything with the
+    `get`, `set`, `add` and `incr` methods of python-memcached). The sliding
+    window is approximated from the counts of the current and the
+    previous fixed windows.
+
+    :param client: The memcached client
+    :param prefix: A prefix for the keys
+    """
+
+    def __init__(self, client, prefix='nereid-rate-limit:'):
+        self.client = client
+        self.prefix = prefix
+
+    def hit(self, key, limit, window):
+        now = time.time()
+        key = self.prefix + key
+        locked_until = self.client.get(key + ':lock')
+        if locked_until is not None and float(locked_until) > now:
+            return float(locked_until) - now
+
+        current = int(now // window)
+        previous_count = int(self.client.get('%s:%d' % (key, current - 1))
+            or 0)
+        current_key = '%s:%d' % (key, current)
+        current_count = int(self.client.get(current_key) or 0)
+        elapsed = (now % window) / window
+        if previous_count * (1 - elapsed) + current_count >= limit:
+            return (1 - elapsed) * window
+        if not self.client.add(current_key, 1, time=window * 2):
+            self.client.incr(current_key)
+        return 0
+
+    def lock(self, key, duration):
+        self.client.set(
+            self.prefix + key + ':lock', time.time() + duration,
+            time=int(duration) + 1
+        )
+
+
+_backend_lock = Lock()
+
+
+def get_backend(app):
+    "Returns the backend of the application"
+    backend = app.config.get('RATE_LIMIT_BACKEND')
+    if backend is not None:
+        return backend
+    backend = app.extensions.get('nereid_rate_limit')
+    if backend is None:
+        with _backend_lock:
+            backend = app.extensions.setdefault(
+                'nereid_rate_limit', MemoryBackend()
+            )
+    return backend
+
+
+def get_keys(scope):
+    """
+    Returns the keys the current request is counted against in the scope:
+    the client IP and the email address posted, if any. The email address
+    is not validated yet, so it is hashed to keep the keys short and free
+    of the characters memcached rejects.
+    """
+    prefix = '%s:%s:' % (get_website_from_host(request.host), scope)
+    keys = [prefix + 'ip:%s' % request.remote_addr]
+    email = request.form.get('email')
+    if email:
+        keys.append(prefix + 'email:%s' % hashlib.sha1(
+            email.strip().lower().encode('utf-8')).hexdigest())
+    return keys
+
+
+def check_rate_limit(scope):
+    """
+    Count the current request in the scope
+
+    :param scope: The name of the scope in the `RATE_LIMITS` setting
+    :return: 0 if the request is allowed, or the number of seconds after
+             which it would be
+    """
+    limits = current_app.config.get('RATE_LIMITS') or {}
+    if scope not in limits:
+        return 0
+    limit, window = limits[scope]
+    lockout = current_app.config.get('RATE_LIMIT_LOCKOUT')
+    backend = get_backend(current_app)
+    retry_after = 0
+    for key in get_keys(scope):
+        wait = backend.hit(key, limit, window)
+        if wait and lockout:
+            backend.lock(key, lockout)
+            wait = max(wait, lockout)
+        retry_after = max(retry_after, wait)
+    return retry_after
+
+
+def rate_limited(scope):
+    """
+    Reject the POST requests to the handler over the limits of the scope
+    with a `429 Too Many Requests` response::
+
+        @classmethod
+        @rate_limited('login')
+        def login(cls):
+            ...
+
+    :param scope: The name of the scope in the `RATE_LIMITS` setting
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if request.method == 'POST':
+                retry_after = check_rate_limit(scope)
+                if retry_after:
+                    current_app.logger.warning(
+                        'Rate limit of %s exceeded by %s' % (
+                            scope, request.remote_addr
+                        )
+                    )
+                    return current_app.response_class(
+                        unicode(_("Too many attempts. Please try again "
+                            "later")),
+                        status='429 TOO MANY REQUESTS',
+                        headers=[('Retry-After', str(int(retry_after) + 1))],
+                    )
+            return function(*args, **kwargs)
+        return wrapper
+    return decorator
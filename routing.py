@@ -1,25 +1,50 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import hashlib
+import json
+import time
 from ast import literal_eval
+from threading import Lock
 
 import pytz
 from werkzeug import abort, redirect
+from werkzeug.routing import Map
+from flask.signals import signals_available
 from wtforms import Form, TextField, PasswordField, validators
 
-from nereid import jsonify, flash, render_template, url_for, cache
-from nereid.globals import session, request
-from nereid.helpers import login_required, key_from_list, get_flashed_messages
-from nereid.signals import login, failed_login, logout
+from nereid import jsonify, flash, render_template, url_for
+from nereid.globals import session, request, current_app
+from nereid.helpers import login_required, get_flashed_messages, \
+    get_website_from_host, permissions_required
+from nereid.signals import login, failed_login, logout, request_started, \
+    request_tearing_down
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.backend import TableHandler
 from trytond.transaction import Transaction
 from trytond.pool import Pool
+from trytond.tools import reduce_ids
+from trytond.cache import Cache
 
 from .i18n import _
+from .tools import clean_record_cache, gzip_compress
+from .dispatcher import TrieMap
+from .instrumentation import phase, get_stats
+from .rate_limit import rate_limited
+from .page_cache import cache_guest_response, purge_surrogate_keys, \
+    surrogate_key
 
 __all__ = ['URLMap', 'WebSite', 'URLRule', 'URLRuleDefaults',
            'WebsiteCountry', 'WebsiteCurrency']
 
+#: The boolean fields of :class:`URLRule` and the HTTP method each enables
+HTTP_METHOD_FIELDS = (
+    ('http_method_get', 'GET'),
+    ('http_method_post', 'POST'),
+    ('http_method_put', 'PUT'),
+    ('http_method_delete', 'DELETE'),
+    ('http_method_patch', 'PATCH'),
+)
+
 
 class URLMap(ModelSQL, ModelView):
     """
@@ -43,6 +68,14 @@ class URLMap(ModelSQL, ModelView):
     :param strict_slashes: Boolean field if / in url map is taken seriously
     :param unique_urls: Enable `redirect_defaults` in the URL Map and
                         redirects the defaults to the URL 
+
+    Compiled Rules:
+    ~~~~~~~~~~~~~~~
+    :param revision: Incremented whenever a rule, a rule default or the
+                     map itself is written
+    :param rules_snapshot: JSON snapshot of the rule arguments
+    :param snapshot_revision: The revision at which the snapshot was
+                              compiled
     """
     __name__ = "nereid.url_map"
 
@@ -62,26 +95,311 @@ class URLMap(ModelSQL, ModelView):
     unique_urls = fields.Boolean('Unique URLs')
     active = fields.Boolean('Active')
 
+    revision = fields.Integer('Revision', readonly=True)
+    rules_snapshot = fields.Text('Compiled Rules', readonly=True)
+    snapshot_revision = fields.Integer('Snapshot Revision', readonly=True)
+
     @staticmethod
     def default_active():
         "By default URL is active"
         return True
 
+    @staticmethod
+    def default_revision():
+        return 1
+
     @staticmethod
     def default_charset():
         "By default characterset is utf-8"
         return 'utf-8'
 
-    def get_rules_arguments(self):
+    @classmethod
+    def write(cls, url_maps, values):
+        """
+        Bump the revision of the maps so that the compiled rules are
+        rebuilt on the next load
+        """
+        rv = super(URLMap, cls).write(url_maps, values)
+        cls.bump_revision(url_maps)
+        return rv
+
+    @classmethod
+    def bump_revision(cls, url_maps):
+        """
+        Increment the revision of the given URL maps, which outdates their
+        snapshot. The update is done in SQL so that it does not recurse into
+        :meth:`write`, and nothing is compiled here: the rules are created
+        one at a time when the module data is loaded, so the snapshot is
+        compiled once, by the first :meth:`get_rules_arguments` after the
+        change.
+
+        :param url_maps: URL map records or ids. False values are ignored
+        """
+        cursor = Transaction().cursor
+        ids = list(set(int(m) for m in url_maps if m))
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('id', sub_ids)
+            cursor.execute(
+                'UPDATE "' + cls._table + '" '
+                'SET revision = COALESCE(revision, 0) + 1 '
+                'WHERE ' + red_sql, red_ids
+            )
+        clean_record_cache(cls, ids)
+
+    def compile_rules_arguments(self):
         """
         Constructs a list of dictionary of arguments needed
         for URL Rule construction. A wrapper around the 
-            URL RULE get_rule_arguments
+            URL RULE get_rules_arguments
+        """
+        URLRule = Pool().get('nereid.url_rule')
+        # Searched rather than read from the rules field, which may have
+        # been cached before the rules were changed
+        rules = URLRule.search([('url_map', '=', self.id)])
+        return URLRule.get_rules_arguments([r.id for r in rules])
+
+    def get_rules_arguments(self):
+        """
+        Returns the list of rule arguments from the compiled snapshot of
+        the map. If the snapshot is missing or outdated, the rules are
+        compiled and the snapshot is stored by :meth:`store_snapshot`.
+        """
+        revision = self.revision or 0
+        _loaded_revisions[(Transaction().cursor.database_name, self.id)] = \
+            revision
+        if self.rules_snapshot and self.snapshot_revision == revision:
+            return json.loads(self.rules_snapshot)
+        rules_arguments = self.compile_rules_arguments()
+        self.store_snapshot(rules_arguments, revision)
+        return rules_arguments
+
+    def store_snapshot(self, rules_arguments, revision):
+        """
+        Store the snapshot of the rules compiled at the given revision, in
+        a transaction of its own: this is called when the application
+        loads, in a transaction which is never committed. The snapshot is
+        not stored if the map changed since, and as it is only a cache, it
+        is not stored either if the update fails because of a concurrent
+        change of the map.
+
+        An in-memory SQLite database has a single connection, so there is
+        no other transaction to store the snapshot in.
+        """
+        if Transaction().cursor.database_name == ':memory:':
+            return
+        with Transaction().new_cursor() as transaction:
+            cursor = transaction.cursor
+            try:
+                cursor.execute(
+                    'UPDATE "' + self._table + '" '
+                    'SET rules_snapshot = %s, snapshot_revision = %s '
+                    'WHERE id = %s AND revision = %s',
+                    (json.dumps(rules_arguments), revision, self.id, revision)
+                )
+                cursor.commit()
+            except Exception:
+                cursor.rollback()
+
+    @classmethod
+    def get_revisions(cls):
+        """
+        Returns a dictionary of the id of every URL map to its revision
+        """
+        cursor = Transaction().cursor
+        cursor.execute('SELECT id, revision FROM "' + cls._table + '"')
+        return dict(
+            (map_id, revision or 0) for map_id, revision in cursor.fetchall()
+        )
+
+    @staticmethod
+    def get_map_class(app):
+        """
+        Returns the werkzeug map class to use for the application. The
+        :class:`~trytond.modules.nereid.dispatcher.TrieMap` is used if
+        `URL_TRIE_DISPATCHER` is set in the configuration of the app.
+        """
+        if app.config.get('URL_TRIE_DISPATCHER'):
+            return TrieMap
+        return Map
+
+    def build_map(self, app):
+        """
+        Build a werkzeug map of the rules for the nereid application in
+        the same way as the application does when it is initialised, and
+        register the view functions of the endpoints.
+
+        :param app: The nereid application
         """
-        rule_args = [ ]
-        for rule in self.rules:
-            rule_args.append(rule.get_rule_arguments())
-        return rule_args
+        url_map = self.get_map_class(app)()
+        url_map.add(
+            app.url_rule_class(
+                app.static_url_path + '/<path:filename>', endpoint='static'
+            )
+        )
+        for url in self.get_rules_arguments():
+            rule = app.url_rule_class(url.pop('rule'), **url)
+            rule.provide_automatic_options = True
+            url_map.add(rule)
+            if (not url['build_only']) and not(url['redirect_to']):
+                app.view_functions[url['endpoint']] = app.get_method(
+                    url['endpoint']
+                )
+        return url_map
+
+
+#: Revision of the URL maps last loaded in this process, by database
+_loaded_revisions = {}
+_refresh_lock = Lock()
+
+
+def refresh_url_maps(app, **extra):
+    """
+    Rebuild the werkzeug map of the websites whose URL map has changed since
+    it was loaded by this process. This is connected to the request_started
+    signal, and the revisions are checked at most once every
+    `URL_MAP_CHECK_INTERVAL` seconds (30 by default, `None` disables the
+    check). The new map is used from the next request on.
+
+    Only the revisions and the stored snapshots of the rules are read, so
+    the request transaction never locks or writes the maps (an outdated
+    snapshot is stored in a transaction of its own, see
+    :meth:`URLMap.store_snapshot`).
+    """
+    interval = app.config.get('URL_MAP_CHECK_INTERVAL', 30)
+    if interval is None or not getattr(app, 'websites', None):
+        return
+    state = app.extensions.setdefault('nereid.url_map', {
+        'checked_at': 0,
+        'revisions': None,
+    })
+    if time.time() - state['checked_at'] < interval:
+        return
+    if not _refresh_lock.acquire(False):
+        # Another thread is already checking
+        return
+    try:
+        state['checked_at'] = time.time()
+        database_name = Transaction().cursor.database_name
+        URLMap = Pool().get('nereid.url_map')
+
+        if state['revisions'] is None:
+            state['revisions'] = dict(
+                (map_id, revision)
+                for (dbname, map_id), revision in _loaded_revisions.items()
+                if dbname == database_name
+            )
+        revisions = URLMap.get_revisions()
+        changed = [
+            map_id for map_id, revision in revisions.items()
+            if state['revisions'].get(map_id) not in (None, revision)
+        ]
+        if not changed:
+            return
+        _rebuild_url_maps(app, changed)
+        for map_id in changed:
+            state['revisions'][map_id] = \
+                _loaded_revisions[(database_name, map_id)]
+    finally:
+        _refresh_lock.release()
+
+
+def _rebuild_url_maps(app, url_map_ids):
+    """
+    Build the werkzeug maps of the given URL maps and use them for the
+    websites of the application which use these URL maps
+    """
+    URLMap = Pool().get('nereid.url_map')
+    Website = Pool().get('nereid.website')
+    websites = Website.search([('url_map', 'in', url_map_ids)])
+    for url_map in URLMap.browse(url_map_ids):
+        werkzeug_map = url_map.build_map(app)
+        for website in websites:
+            if website.url_map == url_map and website.name in app.websites:
+                app.websites[website.name]['url_map'] = werkzeug_map
+
+
+def install_map_class(app, **extra):
+    """
+    Replace the maps loaded by the application, which are always werkzeug
+    maps, by maps of the class returned by :meth:`URLMap.get_map_class`.
+    This is how the trie dispatcher is enabled. It is connected to the
+    request_started signal and builds the maps once, on the first request,
+    from the stored snapshots of the rules whatever the
+    `URL_MAP_CHECK_INTERVAL`.
+    """
+    websites = getattr(app, 'websites', None)
+    if not websites:
+        return
+    map_class = Pool().get('nereid.url_map').get_map_class(app)
+    if all(type(w['url_map']) is map_class for w in websites.itervalues()):
+        return
+    with _refresh_lock:
+        Website = Pool().get('nereid.website')
+        outdated = Website.search([('name', 'in', [
+            name for name, w in websites.iteritems()
+            if type(w['url_map']) is not map_class
+        ])])
+        if outdated:
+            _rebuild_url_maps(
+                app, list(set(w.url_map.id for w in outdated))
+            )
+
+
+def clean_caches(app, **extra):
+    """
+    Drop the Tryton caches which were reset by other processes. This is
+    what the Tryton server does before every request and is a no-op
+    unless `multi_server` is set in the Tryton configuration.
+    """
+    Cache.clean(app.database_name)
+
+
+def reset_caches(app, **extra):
+    """
+    Notify the other processes of the Tryton caches reset while handling
+    the request. The request is torn down after the transaction is
+    committed.
+    """
+    Cache.resets(app.database_name)
+
+
+def load_website(app, **extra):
+    """
+    Set the website, language and currency of the request from the cached
+    website descriptor and languages, instead of searching and browsing
+    them on first use. Connected to the `request_started` signal.
+
+    The language is left to nereid if it is not an active language, so
+    that the user is told about it.
+    """
+    WebSite = Pool().get('nereid.website')
+    Language = Pool().get('ir.lang')
+    Currency = Pool().get('currency.currency')
+
+    descriptor = WebSite.get_descriptor()
+    request.nereid_website = WebSite.from_descriptor(descriptor)
+
+    code = (request.view_args or {}).get(
+        'language', descriptor.default_language_code
+    )
+    if code not in WebSite.get_languages():
+        return
+    language_id, currency_id = WebSite.get_languages()[code]
+    language = Language(language_id)
+    language._cache.setdefault(language_id, {}).setdefault('code', code)
+    request.nereid_language = language
+    request.nereid_currency = Currency(
+        currency_id or descriptor.company_currency
+    )
+
+
+if signals_available:
+    request_started.connect(clean_caches)
+    request_started.connect(load_website)
+    request_started.connect(install_map_class)
+    request_started.connect(refresh_url_maps)
+    request_tearing_down.connect(reset_caches)
 
 
 class LoginForm(Form):
@@ -90,6 +408,31 @@ class LoginForm(Form):
     password = PasswordField(_('Password'), [validators.Required()])
 
 
+class WebsiteDescriptor(object):
+    """
+    An immutable, process local snapshot of the settings of a website that
+    handlers need on most requests. Related records are represented by
+    their ids, so reading them does not hit the ORM.
+
+    Descriptors are built by :meth:`WebSite.get_descriptor`.
+    """
+    __slots__ = (
+        'id', 'name', 'url_map', 'company', 'company_currency',
+        'default_language', 'default_language_code', 'application_user',
+        'guest_user', 'timezone', 'countries', 'currencies',
+    )
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Website descriptors are immutable")
+
+    def __repr__(self):
+        return '<WebsiteDescriptor %s (%d)>' % (self.name, self.id)
+
+
 class WebSite(ModelSQL, ModelView):
     """
     One of the most powerful features of Nereid is the ability to 
@@ -151,6 +494,17 @@ class WebSite(ModelSQL, ModelView):
         [(x, x) for x in pytz.common_timezones], 'Timezone', translate=False
     )
 
+    _descriptor_cache = Cache('nereid.website.descriptor', context=False)
+    _currencies_cache = Cache('nereid.website.get_currencies', context=False)
+    _country_list_cache = Cache('nereid.website.country_list', context=False)
+    _subdivision_list_cache = Cache(
+        'nereid.website.subdivision_list', context=False
+    )
+    _subdivisions_bundle_cache = Cache(
+        'nereid.website.subdivisions_bundle', context=False
+    )
+    _languages_cache = Cache('nereid.website.languages', context=False)
+
     @staticmethod
     def default_timezone():
         return 'UTC'
@@ -167,46 +521,312 @@ class WebSite(ModelSQL, ModelView):
              'Another site with the same name already exists!')
         ]
 
+    @classmethod
+    def create(cls, vlist):
+        websites = super(WebSite, cls).create(vlist)
+        cls._descriptor_cache.clear()
+        cls._currencies_cache.clear()
+        cls.clear_country_caches()
+        return websites
+
+    @classmethod
+    def write(cls, websites, values):
+        rv = super(WebSite, cls).write(websites, values)
+        cls._descriptor_cache.clear()
+        cls._currencies_cache.clear()
+        cls.clear_country_caches()
+        purge_surrogate_keys(
+            [surrogate_key(cls.__name__, w.id) for w in websites]
+        )
+        return rv
+
+    @classmethod
+    def delete(cls, websites):
+        cls._descriptor_cache.clear()
+        cls._currencies_cache.clear()
+        cls.clear_country_caches()
+        return super(WebSite, cls).delete(websites)
+
+    @classmethod
+    def get_descriptor(cls, name=None):
+        """
+        Returns the :class:`WebsiteDescriptor` of a website. The descriptor
+        is built once and cached until the website, its countries or its
+        currencies change.
+
+        :param name: Name of the website. Defaults to the website of the
+                     current request.
+        """
+        if name is None:
+            name = get_website_from_host(request.host)
+        descriptor = cls._descriptor_cache.get(name)
+        if descriptor is None:
+            websites = cls.search([('name', '=', name)])
+            if not websites:
+                raise RuntimeError("Website with Name %s not found" % name)
+            website = websites[0]
+            descriptor = WebsiteDescriptor(
+                id=website.id,
+                name=website.name,
+                url_map=website.url_map.id,
+                company=website.company.id,
+                company_currency=website.company.currency.id,
+                default_language=website.default_language.id,
+                default_language_code=website.default_language.code,
+                application_user=website.application_user.id,
+                guest_user=website.guest_user.id,
+                timezone=website.timezone,
+                countries=frozenset(c.id for c in website.countries),
+                currencies=tuple(c.id for c in website.currencies),
+            )
+            cls._descriptor_cache.set(name, descriptor)
+        return descriptor
+
+    @classmethod
+    def from_descriptor(cls, descriptor):
+        """
+        Returns the website of the descriptor with the values of the
+        descriptor in the read caches, as if they had been read from the
+        database (see :meth:`NereidUser.from_snapshot`). The company
+        currency and the code of the default language are filled in the
+        same way, so the request does not read them either.
+
+        :param descriptor: A :class:`WebsiteDescriptor`
+        """
+        pool = Pool()
+        URLMap = pool.get('nereid.url_map')
+        Company = pool.get('company.company')
+        Currency = pool.get('currency.currency')
+        Language = pool.get('ir.lang')
+        User = pool.get('res.user')
+        NereidUser = pool.get('nereid.user')
+        Country = pool.get('country.country')
+
+        company = Company(descriptor.company)
+        company._local_cache.setdefault(company.id, {}).setdefault(
+            'currency', Currency(descriptor.company_currency)
+        )
+        language = Language(descriptor.default_language)
+        language._cache.setdefault(language.id, {}).setdefault(
+            'code', descriptor.default_language_code
+        )
+
+        website = cls(descriptor.id)
+        read_cache = website._cache.setdefault(website.id, {})
+        read_cache.setdefault('name', descriptor.name)
+        read_cache.setdefault('timezone', descriptor.timezone)
+        # The relations are only read from the local cache, as records
+        local_cache = website._local_cache.setdefault(website.id, {})
+        for name, value in (
+                ('url_map', URLMap(descriptor.url_map)),
+                ('company', company),
+                ('default_language', language),
+                ('application_user', User(descriptor.application_user)),
+                ('guest_user', NereidUser(descriptor.guest_user)),
+                ('countries', tuple(
+                    Country(c) for c in sorted(descriptor.countries)
+                )),
+                ('currencies', tuple(
+                    Currency(c) for c in descriptor.currencies
+                )),
+                ):
+            local_cache.setdefault(name, value)
+        return website
+
+    @classmethod
+    def get_languages(cls):
+        """
+        Returns a dictionary of the code of every active language to the
+        tuple of its id and the id of its default currency (None if it has
+        none). Cached until a language changes.
+        """
+        languages = cls._languages_cache.get(None)
+        if languages is None:
+            Language = Pool().get('ir.lang')
+            languages = dict(
+                (l.code, (l.id, l.default_currency and l.default_currency.id))
+                for l in Language.search([])
+            )
+            cls._languages_cache.set(None, languages)
+        return languages
+
+    @classmethod
+    def clear_country_caches(cls):
+        """
+        Clear the cached countries and subdivisions of the websites. Called
+        when countries, subdivisions or the countries of a website change.
+        """
+        cls._descriptor_cache.clear()
+        cls._country_list_cache.clear()
+        cls._subdivision_list_cache.clear()
+        cls._subdivisions_bundle_cache.clear()
+
+    @staticmethod
+    def cached_json_response(cache, key, build):
+        """
+        Returns a JSON response of the result of `build`, which is called
+        only if `cache` has no entry for `key`. The response has a strong
+        ETag (the hash of the payload) and is public, so that clients and
+        proxies can revalidate it with If-None-Match.
+
+        The lifetime of the response can be configured with the
+        `REFERENCE_DATA_MAX_AGE` setting of the application (in seconds).
+
+        :param cache: The Tryton cache holding the (etag, payload) tuples
+        :param key: The key of the payload in the cache
+        :param build: Callable returning the data to serialize
+        """
+        entry = cache.get(key)
+        if entry is None:
+            payload = json.dumps(build(), separators=(',', ':'))
+            entry = (hashlib.sha1(payload).hexdigest(), payload)
+            cache.set(key, entry)
+        etag, payload = entry
+
+        response = current_app.response_class(
+            payload, mimetype='application/json'
+        )
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get(
+            'REFERENCE_DATA_MAX_AGE', 24 * 60 * 60
+        )
+        return response.make_conditional(request)
+
     @classmethod
     def country_list(cls):
         """
         Return the list of countries in JSON
         """
-        return jsonify(result = [
-            {'key': c.id, 'value': c.name} \
-                for c in request.nereid_website.countries
-            ])
+        website = cls.get_descriptor()
+        return cls.cached_json_response(
+            cls._country_list_cache,
+            (website.id, Transaction().language),
+            lambda: {'result': [
+                {'key': c.id, 'value': c.name}
+                for c in cls(website.id).countries
+            ]}
+        )
 
-    @staticmethod
-    def subdivision_list():
+    @classmethod
+    def subdivision_list(cls):
         """
         Return the list of states for given country
         """
         country = int(request.args.get('country', 0))
-        if country not in [c.id for c in request.nereid_website.countries]:
+        if country not in cls.get_descriptor().countries:
             abort(404)
 
-        Subdivision = Pool().get('country.subdivision')
-        subdivisions = Subdivision.search([('country', '=', country)])
-        return jsonify(
-            result = [{
+        def build():
+            Subdivision = Pool().get('country.subdivision')
+            subdivisions = Subdivision.search([('country', '=', country)])
+            return {'result': [{
                 'id': s.id,
                 'name': s.name,
                 'code': s.code,
                 } for s in subdivisions
-            ]
+            ]}
+
+        return cls.cached_json_response(
+            cls._subdivision_list_cache,
+            (country, Transaction().language), build
+        )
+
+    @classmethod
+    def get_subdivisions_bundle(cls, name=None):
+        """
+        Returns the subdivisions of all the countries of a website as a
+        tuple of the version, the JSON payload and the gzip compressed
+        payload. The payload maps the id of each country to a list of the
+        `[id, code, name]` of its subdivisions::
+
+            {"version": "...", "countries": {"12": [[4, "AL-05", "..."]]}}
+
+        The bundle is built once per website and language, and is rebuilt
+        only when the countries or subdivisions change.
+
+        :param name: Name of the website. Defaults to the website of the
+                     current request.
+        """
+        website = cls.get_descriptor(name)
+        key = (website.id, Transaction().language)
+        bundle = cls._subdivisions_bundle_cache.get(key)
+        if bundle is not None:
+            return bundle
+
+        Subdivision = Pool().get('country.subdivision')
+        country_ids = sorted(website.countries)
+        countries = dict((str(id), []) for id in country_ids)
+        for subdivision in Subdivision.search(
+                [('country', 'in', country_ids)],
+                order=[('country', 'ASC'), ('name', 'ASC')]):
+            countries[str(subdivision.country.id)].append(
+                [subdivision.id, subdivision.code, subdivision.name]
+            )
+        countries = json.dumps(
+            countries, separators=(',', ':'), sort_keys=True
+        )
+        version = hashlib.sha1(countries).hexdigest()[:16]
+        payload = '{"version":"%s","countries":%s}' % (version, countries)
+
+        bundle = (version, payload, gzip_compress(payload))
+        cls._subdivisions_bundle_cache.set(key, bundle)
+        return bundle
+
+    @classmethod
+    def subdivisions_bundle_url(cls, **kwargs):
+        """
+        Returns the URL of the subdivisions bundle of the current website.
+        The URL changes whenever the content of the bundle changes, so the
+        bundle can be cached by the browser forever.
+        """
+        version, payload, compressed = cls.get_subdivisions_bundle()
+        return url_for(
+            'nereid.website.subdivisions_bundle', version=version, **kwargs
         )
 
+    @classmethod
+    def subdivisions_bundle(cls, version):
+        """
+        Returns the subdivisions of all the countries of the website in a
+        single JSON file (see :meth:`get_subdivisions_bundle`). The gzip
+        compressed payload is sent to the clients which accept it.
+
+        A request for an outdated version is redirected to the current one.
+        Use :meth:`subdivisions_bundle_url` to get the URL of the bundle.
+
+        :param version: Version of the bundle, part of the URL
+        """
+        current_version, payload, compressed = \
+            cls.get_subdivisions_bundle()
+        if version != current_version:
+            return redirect(cls.subdivisions_bundle_url())
+
+        if 'gzip' in request.accept_encodings:
+            response = current_app.response_class(
+                compressed, mimetype='application/json'
+            )
+            response.content_encoding = 'gzip'
+            # The encoded body is another representation of the bundle
+            response.set_etag(current_version + '-gz')
+        else:
+            response = current_app.response_class(
+                payload, mimetype='application/json'
+            )
+            response.set_etag(current_version)
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 60 * 60
+        response.headers['Cache-Control'] += ', immutable'
+        return response.make_conditional(request)
+
     def get_urls(self, name):
         """
         Return complete list of URLs
         """
         URLMap = Pool().get('nereid.url_map')
-        websites = self.search([('name', '=', name)])
-        if not websites:
-            raise RuntimeError("Website with Name %s not found" % name)
-
-        return URLMap.get_rules_arguments(websites[0].url_map.id)
+        url_map = URLMap(self.get_descriptor(name).url_map)
+        return url_map.get_rules_arguments()
 
     def stats(self, **arguments):
         """
@@ -216,11 +836,13 @@ class WebSite(ModelSQL, ModelView):
             % (request, arguments, request.environ)
 
     @classmethod
+    @cache_guest_response()
     def home(cls):
         "A dummy home method which just renders home.jinja"
         return render_template('home.jinja')
 
     @classmethod
+    @rate_limited('login')
     def login(cls):
         """
         Simple login based on the email and password
@@ -232,11 +854,15 @@ class WebSite(ModelSQL, ModelView):
         if not request.is_guest_user and request.args.get('next'):
             return redirect(request.args['next'])
 
-        if request.method == 'POST' and login_form.validate():
+        with phase('validate'):
+            valid = request.method == 'POST' and login_form.validate()
+
+        if valid:
             NereidUser = Pool().get('nereid.user')
-            result = NereidUser.authenticate(
-                login_form.email.data, login_form.password.data
-            )
+            with phase('authenticate'):
+                result = NereidUser.authenticate(
+                    login_form.email.data, login_form.password.data
+                )
             # Result can be the following:
             # 1 - Browse record of User (successful login)
             # 2 - None - Login failure without message
@@ -247,6 +873,8 @@ class WebSite(ModelSQL, ModelView):
                 flash(_("You are now logged in. Welcome %(name)s",
                     name=result.display_name))
                 session['user'] = result.id
+                # The user of the request was set when the request started
+                request.nereid_user = result
                 login.send()
                 if request.is_xhr:
                     return 'OK'
@@ -264,12 +892,19 @@ class WebSite(ModelSQL, ModelView):
             if request.is_xhr:
                 return 'NOK'
 
-        return render_template('login.jinja', login_form=login_form)
+        with phase('render'):
+            return render_template('login.jinja', login_form=login_form)
 
     @classmethod
     def logout(cls):
         "Log the user out"
+        NereidUser = Pool().get('nereid.user')
+
         session.pop('user', None)
+        # The user of the request was set when the request started
+        request.nereid_user = NereidUser.from_snapshot(
+            cls.get_descriptor().guest_user
+        )
         logout.send()
         flash(
             _('You have been logged out successfully. Thanks for visiting us')
@@ -292,30 +927,37 @@ class WebSite(ModelSQL, ModelView):
     @classmethod
     @login_required
     def account(cls):
-        return render_template('account.jinja', **cls.account_context())
+        with phase('context'):
+            context = cls.account_context()
+        with phase('render'):
+            return render_template('account.jinja', **context)
 
     def get_currencies(self):
         """Returns available currencies for current site
 
-        .. note::
-            A special method is required so that the fetch can be speeded up, 
-            by pushing the categories to the central cache which cannot be 
-            done directly on a browse node.
-        """
-        cache_key = key_from_list([
-            Transaction().cursor.dbname,
-            Transaction().user,
-            'nereid.website.get_currencies',
-            ])
-        # The website is automatically appended to the cache prefix
-        rv = cache.get(cache_key)
+        The currencies are cached per website, language and date (and
+        shared by all users), with the digits, rounding and rate of each
+        currency at that date. The cache is cleared when the website, its
+        currencies or the currency rates are modified.
+        """
+        Date = Pool().get('ir.date')
+        transaction = Transaction()
+        key = (
+            self.id, transaction.language,
+            transaction.context.get('date') or Date.today(),
+        )
+        rv = self._currencies_cache.get(key)
         if rv is None:
             rv = [{
                 'id': c.id,
                 'name': c.name,
                 'symbol': c.symbol,
+                'code': c.code,
+                'digits': c.digits,
+                'rounding': c.rounding,
+                'rate': c.rate,
                 } for c in self.currencies]
-            cache.set(cache_key, rv, 60*60)
+            self._currencies_cache.set(key, rv)
         return rv
 
     @staticmethod
@@ -342,8 +984,30 @@ class WebSite(ModelSQL, ModelView):
     def user_status(cls):
         """
         Returns a JSON of the user_status
+
+        The status is built from the session and the cached snapshot of the
+        user (see :meth:`NereidUser.get_snapshot`), so that polling it does
+        not query the database. The response has an ETag: a client sending
+        it back in `If-None-Match` gets a `304 Not Modified` if the status
+        did not change.
         """
-        return jsonify(status=cls._user_status())
+        with phase('status'):
+            status = cls._user_status()
+        response = jsonify(status=status)
+        response.add_etag()
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
+
+    @classmethod
+    @login_required
+    @permissions_required(['nereid.instrumentation'])
+    def instrumentation_stats(cls):
+        """
+        Returns the request timing histograms of this process in JSON (see
+        :mod:`trytond.modules.nereid.instrumentation`). Requires the
+        `nereid.instrumentation` permission.
+        """
+        return jsonify(stats=get_stats())
 
 
 
@@ -389,6 +1053,9 @@ class URLRule(ModelSQL, ModelView):
             be done
     :param sequence: Numeric sequence of the URL Map.
     :param url_map: Relation field for url_rule o2m
+    :param cache_timeout: Number of seconds for which the responses to
+            guest users are cached, if the handler supports it. See
+            :func:`~trytond.modules.nereid.page_cache.cache_guest_response`
     """
     __name__ = "nereid.url_rule"
     _rec_name = 'rule'
@@ -409,6 +1076,14 @@ class URLRule(ModelSQL, ModelView):
     redirect_to = fields.Char('Redirect To')
     sequence = fields.Integer('Sequence', required=True,)
     url_map = fields.Many2One('nereid.url_map', 'URL Map')
+    cache_timeout = fields.Integer(
+        'Guest Cache Timeout',
+        help="Seconds for which responses to guest users are cached. "
+        "Leave empty to disable caching"
+    )
+
+    _cache_timeout_cache = Cache('nereid.url_rule.cache_timeout',
+        context=False)
 
     @classmethod
     def __setup__(cls):
@@ -423,24 +1098,68 @@ class URLRule(ModelSQL, ModelView):
     def default_http_method_get():
         return True
 
+    @classmethod
+    def create(cls, vlist):
+        rules = super(URLRule, cls).create(vlist)
+        Pool().get('nereid.url_map').bump_revision(
+            [r.url_map for r in rules]
+        )
+        cls._cache_timeout_cache.clear()
+        return rules
+
+    @classmethod
+    def write(cls, rules, values):
+        url_maps = [r.url_map for r in rules]
+        rv = super(URLRule, cls).write(rules, values)
+        Pool().get('nereid.url_map').bump_revision(
+            url_maps + [values.get('url_map')]
+        )
+        cls._cache_timeout_cache.clear()
+        return rv
+
+    @classmethod
+    def delete(cls, rules):
+        url_maps = [r.url_map for r in rules]
+        rv = super(URLRule, cls).delete(rules)
+        Pool().get('nereid.url_map').bump_revision(url_maps)
+        cls._cache_timeout_cache.clear()
+        return rv
+
+    @classmethod
+    def get_cache_timeout(cls, url_map_id, rule):
+        """
+        Returns the guest cache timeout of the URL rule which matched the
+        request, or None if responses must not be cached.
+
+        :param url_map_id: ID of the URL map of the website
+        :param rule: The werkzeug rule which matched the request
+        """
+        timeouts = cls._cache_timeout_cache.get(url_map_id)
+        if timeouts is None:
+            cursor = Transaction().cursor
+            cursor.execute(
+                'SELECT rule, endpoint, cache_timeout '
+                'FROM "' + cls._table + '" '
+                'WHERE url_map = %s AND active = %s AND cache_timeout > 0',
+                (url_map_id, True)
+            )
+            timeouts = dict(
+                ((rule_, endpoint), timeout)
+                for rule_, endpoint, timeout in cursor.fetchall()
+            )
+            cls._cache_timeout_cache.set(url_map_id, timeouts)
+        return timeouts.get((rule.rule, rule.endpoint))
+
     def get_http_methods(self):
         """
         Returns an iterable of HTTP methods that the URL has to support.
 
         .. versionadded: 2.4.0.6
         """
-        methods = []
-        if self.http_method_get:
-            methods.append('GET')
-        if self.http_method_post:
-            methods.append('POST')
-        if self.http_method_put:
-            methods.append('PUT')
-        if self.http_method_delete:
-            methods.append('DELETE')
-        if self.http_method_patch:
-            methods.append('PATCH')
-        return methods
+        return [
+            method for field, method in HTTP_METHOD_FIELDS
+            if getattr(self, field)
+        ]
 
     def get_rule_arguments(self):
         """
@@ -458,6 +1177,54 @@ class URLRule(ModelSQL, ModelView):
                 'redirect_to': self.redirect_to or None,
             }
 
+    @classmethod
+    def get_rules_arguments(cls, rule_ids):
+        """
+        Return the arguments of the given rules in the same format (and
+        order) as :meth:`get_rule_arguments`. The rules and their defaults
+        are read with one query each instead of browsing every rule.
+
+        :param rule_ids: List of ids of the rules
+        """
+        cursor = Transaction().cursor
+        URLRuleDefaults = Pool().get('nereid.url_rule_defaults')
+
+        rows = {}
+        defaults = dict((rule_id, {}) for rule_id in rule_ids)
+        for i in range(0, len(rule_ids), cursor.IN_MAX):
+            sub_ids = rule_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('id', sub_ids)
+            cursor.execute(
+                'SELECT id, rule, endpoint, only_for_genaration, '
+                    'redirect_to, ' +
+                    ', '.join(f for f, _ in HTTP_METHOD_FIELDS) + ' '
+                'FROM "' + cls._table + '" '
+                'WHERE ' + red_sql, red_ids
+            )
+            for row in cursor.dictfetchall():
+                rows[row['id']] = row
+
+            red_sql, red_ids = reduce_ids('rule', sub_ids)
+            cursor.execute(
+                'SELECT rule, key, value '
+                'FROM "' + URLRuleDefaults._table + '" '
+                'WHERE ' + red_sql, red_ids
+            )
+            for rule_id, key, value in cursor.fetchall():
+                defaults[rule_id][key] = value
+
+        return [{
+                'rule': rows[rule_id]['rule'],
+                'endpoint': rows[rule_id]['endpoint'],
+                'methods': [
+                    method for field, method in HTTP_METHOD_FIELDS
+                    if rows[rule_id][field]
+                ],
+                'build_only': bool(rows[rule_id]['only_for_genaration']),
+                'defaults': defaults[rule_id],
+                'redirect_to': rows[rule_id]['redirect_to'] or None,
+            } for rule_id in rule_ids if rule_id in rows]
+
 
 class URLRuleDefaults(ModelSQL, ModelView):
     """
@@ -475,6 +1242,31 @@ class URLRuleDefaults(ModelSQL, ModelView):
     rule = fields.Many2One('nereid.url_rule', 'Rule', required=True, 
         select=True)
 
+    @classmethod
+    def create(cls, vlist):
+        defaults = super(URLRuleDefaults, cls).create(vlist)
+        Pool().get('nereid.url_map').bump_revision(
+            [d.rule.url_map for d in defaults]
+        )
+        return defaults
+
+    @classmethod
+    def write(cls, defaults, values):
+        URLRule = Pool().get('nereid.url_rule')
+        url_maps = [d.rule.url_map for d in defaults]
+        rv = super(URLRuleDefaults, cls).write(defaults, values)
+        if values.get('rule'):
+            url_maps.append(URLRule(values['rule']).url_map)
+        Pool().get('nereid.url_map').bump_revision(url_maps)
+        return rv
+
+    @classmethod
+    def delete(cls, defaults):
+        url_maps = [d.rule.url_map for d in defaults]
+        rv = super(URLRuleDefaults, cls).delete(defaults)
+        Pool().get('nereid.url_map').bump_revision(url_maps)
+        return rv
+
 
 class WebsiteCountry(ModelSQL):
     "Website Country Relations"
@@ -483,6 +1275,23 @@ class WebsiteCountry(ModelSQL):
     website = fields.Many2One('nereid.website', 'Website')
     country = fields.Many2One('country.country', 'Country')
 
+    @classmethod
+    def create(cls, vlist):
+        records = super(WebsiteCountry, cls).create(vlist)
+        Pool().get('nereid.website').clear_country_caches()
+        return records
+
+    @classmethod
+    def write(cls, records, values):
+        rv = super(WebsiteCountry, cls).write(records, values)
+        Pool().get('nereid.website').clear_country_caches()
+        return rv
+
+    @classmethod
+    def delete(cls, records):
+        Pool().get('nereid.website').clear_country_caches()
+        return super(WebsiteCountry, cls).delete(records)
+
 
 class WebsiteCurrency(ModelSQL):
     "Currencies to be made available on website"
@@ -495,3 +1304,27 @@ class WebsiteCurrency(ModelSQL):
     currency = fields.Many2One(
         'currency.currency', 'Currency',
         ondelete='CASCADE', select=1, required=True)
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(WebsiteCurrency, cls).create(vlist)
+        cls.clear_website_caches()
+        return records
+
+    @classmethod
+    def write(cls, records, values):
+        rv = super(WebsiteCurrency, cls).write(records, values)
+        cls.clear_website_caches()
+        return rv
+
+    @classmethod
+    def delete(cls, records):
+        cls.clear_website_caches()
+        return super(WebsiteCurrency, cls).delete(records)
+
+    @staticmethod
+    def clear_website_caches():
+        "Clear the caches of the websites which depend on their currencies"
+        WebSite = Pool().get('nereid.website')
+        WebSite._descriptor_cache.clear()
+        WebSite._currencies_cache.clear()
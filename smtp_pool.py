@@ -0,0 +1,259 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+SMTP connection pool
+
+Keeps the SMTP connections opened with :func:`get_smtp_server` to reuse
+them for the next messages instead of paying the TCP, TLS and login
+handshakes for every message. A connection which has been idle for more
+than `nereid_smtp_idle_timeout` seconds (30 by default) is closed, one
+idle for more than a few seconds is checked with a `NOOP` before being
+reused, and at most `nereid_smtp_pool_size` idle connections (2 by
+default) are kept::
+
+    [options]
+    nereid_smtp_pool_size = 2
+    nereid_smtp_idle_timeout = 30
+
+Many messages are sent over a single session with :func:`send_batch`::
+
+    failures = send_batch([
+        render_email(from_addr, user.email, subject, ...)
+        for user in users
+    ])
+"""
+import smtplib
+import socket
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+from trytond.config import CONFIG
+from trytond.tools import get_smtp_server
+
+__all__ = ['SMTPPool', 'get_pool', 'send_batch']
+
+#: The errors after which a connection cannot be used anymore
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, socket.error)
+
+#: Idle connections are checked with a NOOP after this many seconds
+HEALTH_CHECK_INTERVAL = 5
+
+
+class SMTPPool(object):
+    """
+    A pool of SMTP connections to the server of the configuration
+
+    :param size: The maximum number of idle connections kept
+    :param idle_timeout: The number of seconds after which an idle
+                         connection is closed
+    :param factory: A callable returning a new connection, defaults to
+                    :func:`get_smtp_server`
+    """
+
+    def __init__(self, size=2, idle_timeout=30, factory=None):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.factory = factory or get_smtp_server
+        #: The idle connections by configuration, as lists of
+        #: (connection, time of release) tuples
+        self.idle = {}
+        self.lock = Lock()
+        self.handshakes = 0
+        self.messages = 0
+        self.failures = 0
+        self.sending_time = 0.0
+
+    @staticmethod
+    def get_key():
+        "Returns the SMTP configuration the connections are opened with"
+        return tuple(CONFIG.get(key) for key in (
+            'smtp_server', 'smtp_port', 'smtp_ssl', 'smtp_tls', 'smtp_user',
+        ))
+
+    def acquire(self):
+        """
+        Returns an idle connection which is still usable, or a new one
+        """
+        key = self.get_key()
+        while True:
+            with self.lock:
+                connections = self.idle.get(key)
+                if not connections:
+                    break
+                server, released = connections.pop()
+            idle = time.time() - released
+            if idle > self.idle_timeout:
+                self._quit(server)
+                continue
+            if idle > HEALTH_CHECK_INTERVAL:
+                try:
+                    if server.noop()[0] != 250:
+                        raise smtplib.SMTPServerDisconnected()
+                except CONNECTION_ERRORS + (smtplib.SMTPException,):
+                    self._quit(server)
+                    continue
+            return server
+        server = self.factory()
+        with self.lock:
+            self.handshakes += 1
+        return server
+
+    def release(self, server):
+        """
+        Return a connection to the pool, or close it if the pool is full
+
+        :param server: A connection returned by :meth:`acquire`
+        """
+        key = self.get_key()
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.size:
+                connections.append((server, time.time()))
+                return
+        self._quit(server)
+
+    @contextmanager
+    def connection(self):
+        """
+        A context manager giving a connection of the pool. The connection
+        is returned to the pool unless it failed::
+
+            with pool.connection() as server:
+                server.sendmail(from_addr, to_addrs, msg)
+        """
+        server = self.acquire()
+        try:
+            yield server
+        except CONNECTION_ERRORS:
+            self._quit(server)
+            raise
+        except Exception:
+            self.release(server)
+            raise
+        else:
+            self.release(server)
+
+    def sendmail(self, server, from_addr, to_addrs, msg):
+        "Send a message with the connection and record it in the metrics"
+        started = time.time()
+        try:
+            server.sendmail(from_addr, to_addrs, msg)
+        except Exception:
+            with self.lock:
+                self.failures += 1
+            raise
+        finally:
+            elapsed = time.time() - started
+            with self.lock:
+                self.sending_time += elapsed
+        with self.lock:
+            self.messages += 1
+
+    def send_batch(self, messages):
+        """
+        Send the messages over a single session, connecting again if the
+        connection is lost
+
+        :param messages: A list of :class:`email.message.Message` (as
+                         returned by `render_email`) or of (from_addr,
+                         to_addrs, msg) tuples
+        :return: A list of (index, exception) tuples for the messages which
+                 could not be sent
+        """
+        messages = list(messages)
+        failures = []
+        server = None
+        try:
+            for index, message in enumerate(messages):
+                if not isinstance(message, tuple):
+                    message = (
+                        message['From'],
+                        [a.strip() for a in message['To'].split(',')],
+                        message.as_string(),
+                    )
+                if server is None:
+                    try:
+                        server = self.acquire()
+                    except CONNECTION_ERRORS + (smtplib.SMTPException,), exc:
+                        # The server cannot be reached, do not try again
+                        # for every message
+                        failures.extend(
+                            (i, exc) for i in range(index, len(messages))
+                        )
+                        break
+                try:
+                    self.sendmail(server, *message)
+                except CONNECTION_ERRORS, exc:
+                    failures.append((index, exc))
+                    self._quit(server)
+                    server = None
+                except smtplib.SMTPException, exc:
+                    failures.append((index, exc))
+        finally:
+            if server is not None:
+                self.release(server)
+        return failures
+
+    def get_metrics(self):
+        """
+        Returns the number of handshakes, messages sent and failures since
+        the pool was created, and the rate of the messages sent per second
+        of sending time
+        """
+        with self.lock:
+            return {
+                'handshakes': self.handshakes,
+                'messages': self.messages,
+                'failures': self.failures,
+                'messages_per_second': (
+                    self.messages / self.sending_time
+                    if self.sending_time else 0.0
+                ),
+                'idle': sum(len(c) for c in self.idle.itervalues()),
+            }
+
+    def close(self):
+        "Close the idle connections"
+        with self.lock:
+            connections = [
+                server for c in self.idle.itervalues() for server, _ in c
+            ]
+            self.idle.clear()
+        for server in connections:
+            self._quit(server)
+
+    @staticmethod
+    def _quit(server):
+        try:
+            server.quit()
+        except CONNECTION_ERRORS + (smtplib.SMTPException,):
+            try:
+                server.close()
+            except CONNECTION_ERRORS:
+                pass
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_pool():
+    "Returns the SMTP pool of the process"
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = SMTPPool(
+                    int(CONFIG.get('nereid_smtp_pool_size') or 2),
+                    int(CONFIG.get('nereid_smtp_idle_timeout') or 30),
+                )
+    return _pool
+
+
+def send_batch(messages):
+    """
+    Send the messages over a single session of the pool of the process.
+    See :meth:`SMTPPool.send_batch`.
+    """
+    return get_pool().send_batch(messages)
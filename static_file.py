@@ -1,19 +1,158 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import hashlib
+import mimetypes
 import os
+import shutil
+import tempfile
 import urllib
+from datetime import datetime
 
 from nereid.helpers import slugify, send_file, url_for
-from nereid.globals import _request_ctx_stack
-from werkzeug import abort
+from nereid.globals import _request_ctx_stack, request, current_app
+from werkzeug import abort, redirect
+from werkzeug.http import is_resource_modified, parse_range_header, \
+    unquote_etag
 
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.config import CONFIG
 from trytond.transaction import Transaction
 from trytond.pyson import Eval, Not, Equal
+from trytond.pool import Pool
+from trytond.cache import Cache
 
 __all__ = ['NereidStaticFolder', 'NereidStaticFile']
 
+#: Number of characters of the content hash in the fingerprinted URLs
+FINGERPRINT_LENGTH = 12
+
+#: Max age of the fingerprinted URLs, which never change (one year)
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+
+#: Size of the chunks the files are read and written in
+CHUNK_SIZE = 65536
+
+#: Permissions of the written files, which the web server must be able to
+#: read when they are sent with X-Sendfile
+FILE_MODE = 0644
+
+
+def read_file_range(path, start, stop, chunk_size=CHUNK_SIZE):
+    "Yields the bytes of the file from start to stop (excluded) in chunks"
+    with open(path, 'rb') as file_reader:
+        file_reader.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = file_reader.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _iter_chunks(value, chunk_size):
+    """
+    Yields the content of a file-like object or of a string or buffer in
+    chunks, without copying the string or buffer
+    """
+    if hasattr(value, 'read'):
+        for chunk in iter(lambda: value.read(chunk_size), ''):
+            yield chunk
+    else:
+        for offset in xrange(0, len(value), chunk_size):
+            yield buffer(value, offset, chunk_size)
+
+
+def _iter_file(file_reader, chunk_size):
+    "Yields the content of the file-like object in chunks, then closes it"
+    try:
+        for chunk in _iter_chunks(file_reader, chunk_size):
+            yield chunk
+    finally:
+        file_reader.close()
+
+
+def _replace_file(path, fill):
+    """
+    Creates a temporary file next to `path`, calls `fill` with its path and
+    renames it to `path`, so that readers see either the old or the new
+    file but never a partial one. The directory is created if needed.
+    """
+    directory, name = os.path.split(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, temp_path = tempfile.mkstemp(
+        prefix='.%s.' % name, suffix='.tmp', dir=directory
+    )
+    os.close(fd)
+    try:
+        rv = fill(temp_path)
+        os.chmod(temp_path, FILE_MODE)
+        os.rename(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return rv
+
+
+def write_file(path, value, chunk_size=CHUNK_SIZE):
+    """
+    Atomically writes the value to the file in chunks
+
+    :param path: The path of the file
+    :param value: A string, a buffer or a file-like object
+    :return: The SHA-1 hex digest of the content written
+    """
+    def fill(temp_path):
+        digest = hashlib.sha1()
+        with open(temp_path, 'wb') as file_writer:
+            for chunk in _iter_chunks(value, chunk_size):
+                digest.update(chunk)
+                file_writer.write(chunk)
+        return digest.hexdigest()
+    return _replace_file(path, fill)
+
+
+def link_file(source, path):
+    """
+    Atomically makes the file at `path` a hard link to `source`, or a copy
+    of it if the file system does not support hard links between them
+    """
+    def fill(temp_path):
+        os.remove(temp_path)
+        try:
+            os.link(source, temp_path)
+        except (OSError, AttributeError):
+            shutil.copyfile(source, temp_path)
+    _replace_file(path, fill)
+
+
+class StaticFileEntry(object):
+    """
+    An immutable entry of the index of the static files, which holds what
+    is needed to serve a file without the ORM. The modification time, the
+    size and the ETag are None for the remote files and the missing local
+    files. `max_age` is the one of the folder of the file.
+    `content_hash` is the one stored on the file, if any.
+
+    Entries are built by :meth:`NereidStaticFile.get_index_entry`.
+    """
+    __slots__ = (
+        'id', 'type', 'path', 'mtime', 'size', 'etag', 'max_age',
+        'content_hash',
+    )
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Static file entries are immutable")
+
+    def __repr__(self):
+        return '<StaticFileEntry %s (%d)>' % (self.path, self.id)
+
 
 class NereidStaticFolder(ModelSQL, ModelView):
     "Static folder for Nereid"
@@ -26,6 +165,16 @@ class NereidStaticFolder(ModelSQL, ModelView):
     )
     description = fields.Char('Description', select=1)
     files = fields.One2Many('nereid.static.file', 'folder', 'Files')
+    max_age = fields.Integer(
+        'Max Age', required=True,
+        help='Number of seconds browsers and proxies may cache the files '
+            'of the folder'
+    )
+    fingerprint_urls = fields.Boolean(
+        'Fingerprinted URLs',
+        help='The URLs of the files embed a hash of their content, so they '
+            'can be cached forever and change when the file changes'
+    )
 
     @classmethod
     def __setup__(cls):
@@ -44,6 +193,10 @@ class NereidStaticFolder(ModelSQL, ModelView):
             'folder_cannot_change': "Folder name cannot be changed"
         })
 
+    @staticmethod
+    def default_max_age():
+        return 60 * 60 * 12
+
     def on_change_with_folder_name(self):
         """
         Fills the name field with a slugified name
@@ -74,7 +227,20 @@ class NereidStaticFolder(ModelSQL, ModelView):
         if vals.get('folder_name'):
             # TODO: Support this feature in future versions
             cls.raise_user_error('folder_cannot_change')
-        return super(NereidStaticFolder, cls).write(folders, vals)
+        rv = super(NereidStaticFolder, cls).write(folders, vals)
+        Pool().get('nereid.static.file').clear_index()
+        return rv
+
+    @classmethod
+    def create(cls, vlist):
+        folders = super(NereidStaticFolder, cls).create(vlist)
+        Pool().get('nereid.static.file').clear_index()
+        return folders
+
+    @classmethod
+    def delete(cls, folders):
+        Pool().get('nereid.static.file').clear_index()
+        return super(NereidStaticFolder, cls).delete(folders)
 
 
 class NereidStaticFile(ModelSQL, ModelView):
@@ -108,6 +274,9 @@ class NereidStaticFile(ModelSQL, ModelView):
     #: Full path to the file in the filesystem
     file_path = fields.Function(fields.Char('File Path'), 'get_file_path')
 
+    #: SHA-1 of the content of the file, set when the file is written
+    content_hash = fields.Char('Content Hash', readonly=True)
+
     #: URL that can be used to idenfity the resource. Note that the value
     #: of this field is available only when called within a request context.
     #: In other words the URL is valid only when called in a nereid request. 
@@ -133,6 +302,124 @@ class NereidStaticFile(ModelSQL, ModelView):
     def default_type():
         return 'local'
 
+    #: The index of the files by (folder name, file name). The entries are
+    #: :class:`StaticFileEntry` or False for the files which do not exist.
+    _index_cache = Cache(
+        'nereid.static.file.index', size_limit=int(
+            CONFIG.get('nereid_static_file_index_size') or 10000
+        ), context=False
+    )
+
+    @classmethod
+    def create(cls, vlist):
+        files = super(NereidStaticFile, cls).create(vlist)
+        cls.clear_index()
+        return files
+
+    @classmethod
+    def write(cls, files, values):
+        rv = super(NereidStaticFile, cls).write(files, values)
+        cls.clear_index()
+        return rv
+
+    @classmethod
+    def delete(cls, files):
+        cls.clear_index()
+        return super(NereidStaticFile, cls).delete(files)
+
+    @classmethod
+    def clear_index(cls):
+        "Clear the index of the static files"
+        cls._index_cache.clear()
+
+    @classmethod
+    def _make_entry(cls, file_id, file_type, folder_name, name, remote_path,
+            max_age, content_hash):
+        """
+        Returns the :class:`StaticFileEntry` of a file from its values
+        """
+        mtime = size = etag = None
+        if file_type == 'remote':
+            path = remote_path
+        else:
+            path = os.path.abspath(os.path.join(
+                cls.get_nereid_base_path(), folder_name, name
+            ))
+            try:
+                stat = os.stat(path)
+            except OSError:
+                pass
+            else:
+                mtime, size = stat.st_mtime, stat.st_size
+                etag = '%x-%x' % (int(mtime), size)
+                if content_hash:
+                    etag += '-' + content_hash[:16]
+        return StaticFileEntry(
+            id=file_id, type=file_type or 'local', path=path, mtime=mtime,
+            size=size, etag=etag, max_age=max_age, content_hash=content_hash,
+        )
+
+    @classmethod
+    def _select_entries(cls, where='', params=()):
+        """
+        Returns the entries of the files matching the SQL condition as a
+        dictionary by (folder name, file name)
+        """
+        Folder = Pool().get('nereid.static.folder')
+        cursor = Transaction().cursor
+        cursor.execute(
+            'SELECT f.id, f.type, d.folder_name, f.name, f.remote_path, '
+                'd.max_age, f.content_hash '
+            'FROM "' + cls._table + '" AS f '
+            'JOIN "' + Folder._table + '" AS d ON (f.folder = d.id)' +
+            where, params
+        )
+        return dict(
+            ((row[2], row[3]), cls._make_entry(*row))
+            for row in cursor.fetchall()
+        )
+
+    @classmethod
+    def get_index_entry(cls, folder, name):
+        """
+        Returns the :class:`StaticFileEntry` of the file from the index, or
+        None if there is no such file. Entries missing from the index are
+        loaded with a single query.
+
+        :param folder: folder_name of the folder
+        :param name: name of the file
+        """
+        entry = cls._index_cache.get((folder, name))
+        if entry is None:
+            return cls.reload_index_entry(folder, name)
+        return entry or None
+
+    @classmethod
+    def reload_index_entry(cls, folder, name):
+        """
+        Loads the :class:`StaticFileEntry` of the file from the database
+        again, replacing the one in the index, which may have been filled
+        by a request reading the file before a change was committed.
+        Returns None if there is no such file.
+
+        :param folder: folder_name of the folder
+        :param name: name of the file
+        """
+        key = (folder, name)
+        entry = cls._select_entries(
+            ' WHERE d.folder_name = %s AND f.name = %s', key
+        ).get(key, False)
+        cls._index_cache.set(key, entry)
+        return entry or None
+
+    @classmethod
+    def preload_index(cls):
+        """
+        Fill the index with all the static files in a single query
+        """
+        for key, entry in cls._select_entries().iteritems():
+            cls._index_cache.set(key, entry)
+
     def get_url(self, name):
         """Return the url if within an active request context or return
         False values
@@ -141,6 +428,12 @@ class NereidStaticFile(ModelSQL, ModelView):
             return None
 
         if self.type == 'local':
+            if self.folder.fingerprint_urls and self.content_hash:
+                return url_for(
+                    'nereid.static.file.send_static_file',
+                    folder=self.folder.folder_name, name=self.name,
+                    fingerprint=self.content_hash[:FINGERPRINT_LENGTH]
+                )
             return url_for(
                 'nereid.static.file.send_static_file',
                 folder=self.folder.folder_name, name=self.name
@@ -165,43 +458,65 @@ class NereidStaticFile(ModelSQL, ModelView):
 
     def _set_file_binary(self, value):
         """
-        Setter for static file that stores file in file system
+        Setter for static file that stores file in file system. The file is
+        written in chunks to a temporary file which is then renamed, so
+        that it is never read partially written.
 
-        :param value: The value to set
+        :param value: The value to set, a buffer or a file-like object
+        :return: The SHA-1 hex digest of the content for the local files
         """
         if self.type == 'local':
-            file_binary = buffer(value)
-            # If the folder does not exist, create it recursively
-            directory = os.path.dirname(self.file_path)
-            if not os.path.isdir(directory):
-                os.makedirs(directory)
-            with open(self.file_path, 'wb') as file_writer:
-                file_writer.write(file_binary)
+            return write_file(self.file_path, value)
 
     @classmethod
     def set_file_binary(cls, files, name, value):
         """
-        Setter for the functional binary field.
+        Setter for the functional binary field. The value is written once,
+        the other files are hard links to (or copies of) the first one.
 
         :param files: Records
         :param name: Ignored
-        :param value: The file buffer
+        :param value: The file buffer or a file-like object
         """
-        for static_file in files:
-            static_file._set_file_binary(value)
+        local_files = [f for f in files if f.type == 'local']
+        if not local_files:
+            return
+        first = local_files[0]
+        content_hash = first._set_file_binary(value)
+        for static_file in local_files[1:]:
+            link_file(first.file_path, static_file.file_path)
+        cls.write(local_files, {'content_hash': content_hash})
 
     def get_file_binary(self, name):
         '''
-        Getter for the binary_file field. This fetches the file from the
-        file system, coverts it to buffer and returns it.
+        Getter for the binary_file field. This reads the whole file in
+        memory, closing it before returning, so the consumers which only
+        send or copy the content should use :meth:`iter_file_binary`
+        instead. Remote files are read from their URL, without a temporary
+        file.
 
         :param name: Field name
         :return: File buffer
         '''
-        location = self.file_path if self.type == 'local' \
-            else urllib.urlretrieve(self.remote_path)[0]
-        with open(location, 'rb') as file_reader:
-            return buffer(file_reader.read())
+        return buffer(''.join(self.iter_file_binary()))
+
+    def iter_file_binary(self, chunk_size=CHUNK_SIZE):
+        """
+        Returns an iterator over the content of the file in chunks, for the
+        consumers which stream it instead of holding it in memory. Remote
+        files are read from their URL as they are downloaded.
+
+        The file is opened here, so the iterator can be consumed after the
+        transaction is over (as a response body), and closed when the
+        iterator is exhausted or closed.
+
+        :param chunk_size: The size of the chunks
+        """
+        if self.type == 'local':
+            file_reader = open(self.file_path, 'rb')
+        else:
+            file_reader = urllib.urlopen(self.remote_path)
+        return _iter_file(file_reader, chunk_size)
 
     def get_file_path(self, name):
         """
@@ -228,22 +543,124 @@ class NereidStaticFile(ModelSQL, ModelView):
         return True
 
     @classmethod
-    def send_static_file(cls, folder, name):
+    def send_static_file(cls, folder, name, fingerprint=None):
         """
         Invokes the send_file method in nereid.helpers to send a file as the
         response to the request. The file is sent in a way which is as
         efficient as possible. For example nereid will use the X-Send_file
         header to make nginx send the file if possible.
 
+        The ETag of the file is computed once from its modification time,
+        size and stored content hash, without reading the file, and kept in
+        the index. Conditional requests (If-None-Match, If-Modified-Since)
+        are answered with a 304 without opening the file, and a single byte
+        range with a 206. The Cache-Control header comes from the `max_age`
+        of the folder. Remote files are streamed from their URL.
+
+        Fingerprinted URLs (see :meth:`get_url`) are sent with an immutable
+        Cache-Control. A fingerprint which is not the one of the indexed
+        content reloads the entry from the database, in case the index is
+        stale, and then redirects to the current URL of the file. The file
+        is sent without the immutable Cache-Control, instead of redirecting,
+        if that URL is the one requested.
+
         :param folder: folder_name of the folder
         :param name: name of the file
+        :param fingerprint: The start of the content hash of the file, if
+                            the URL is fingerprinted
         """
-        #TODO: Separate this search and find into separate cached method
-
-        files = cls.search([
-            ('folder.folder_name', '=', folder),
-            ('name', '=', name)
-            ])
-        if not files:
+        entry = cls.get_index_entry(folder, name)
+        if entry is None:
             abort(404)
-        return send_file(files[0].file_path)
+        if fingerprint is not None and \
+                not cls._match_fingerprint(entry, fingerprint):
+            entry = cls.reload_index_entry(folder, name)
+            if entry is None:
+                abort(404)
+            if not cls._match_fingerprint(entry, fingerprint):
+                url = cls(entry.id).url
+                if url != request.path:
+                    return redirect(url)
+                fingerprint = None
+        if entry.type == 'remote':
+            return cls._send_remote(entry)
+        if entry.etag is None:
+            return send_file(entry.path)
+
+        last_modified = datetime.utcfromtimestamp(int(entry.mtime))
+        if not is_resource_modified(
+                request.environ, entry.etag, last_modified=last_modified):
+            response = current_app.response_class(status=304)
+        else:
+            response = cls._send_entry(entry)
+        response.set_etag(entry.etag)
+        response.last_modified = last_modified
+        response.headers['Accept-Ranges'] = 'bytes'
+        if fingerprint is not None:
+            response.headers['Cache-Control'] = \
+                'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+        elif entry.max_age:
+            response.headers['Cache-Control'] = \
+                'public, max-age=%d' % entry.max_age
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    @classmethod
+    def _send_remote(cls, entry):
+        """
+        Returns the response streaming the remote file of the entry from
+        its URL, without holding it in memory
+        """
+        return current_app.response_class(
+            cls(entry.id).iter_file_binary(),
+            mimetype=mimetypes.guess_type(entry.path)[0] or
+                'application/octet-stream',
+            direct_passthrough=True,
+        )
+
+    @staticmethod
+    def _match_fingerprint(entry, fingerprint):
+        "Returns True if the fingerprint is the one of the entry content"
+        return bool(entry.content_hash) and \
+            entry.content_hash[:FINGERPRINT_LENGTH] == fingerprint
+
+    @staticmethod
+    def _send_entry(entry):
+        """
+        Returns the response sending the file of the entry, or the range of
+        it asked in the `Range` header of the request. Only a single byte
+        range is served: other ranges are ignored, as well as any range if
+        the `If-Range` header does not match the ETag, or if the file is
+        sent by the web server (X-Sendfile), which handles ranges itself.
+        """
+        if_range = request.headers.get('If-Range')
+        try:
+            requested = parse_range_header(request.headers.get('Range'))
+        except ValueError:
+            requested = None
+        if requested is None or requested.units != 'bytes' or \
+                len(requested.ranges) != 1 or current_app.use_x_sendfile or (
+                if_range and unquote_etag(if_range)[0] != entry.etag):
+            response = send_file(entry.path, add_etags=False)
+            response.headers.pop('Expires', None)
+            return response
+
+        rng = requested.range_for_length(entry.size)
+        if rng is None:
+            response = current_app.response_class(status=416)
+            response.headers['Content-Range'] = 'bytes */%d' % entry.size
+            return response
+
+        start, stop = rng
+        response = current_app.response_class(
+            read_file_range(entry.path, start, stop), status=206,
+            mimetype=mimetypes.guess_type(entry.path)[0] or
+                'application/octet-stream',
+            direct_passthrough=True,
+        )
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            start, stop - 1, entry.size
+        )
+        response.content_length = stop - start
+        return response
@@ -11,11 +11,22 @@ import unittest
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import test_view, test_depends
+from trytond.config import CONFIG
 from test_auth import TestAuth
 from test_address import TestAddress
 from test_i18n import TestI18N
 from test_static_file import TestStaticFile
 from test_currency import TestCurrency
+from test_routing import TestRouting
+from test_dispatcher import TestDispatcher
+from test_instrumentation import TestInstrumentation
+from test_password import TestPassword
+from test_rate_limit import TestRateLimit
+from test_email_queue import TestEmailQueue
+from test_smtp_pool import TestSMTPPool
+
+# Keep the hashing of the passwords of the test users fast
+CONFIG['nereid_password_cost_pbkdf2_sha256'] = 1000
 
 
 class TestNereid(unittest.TestCase):
@@ -57,6 +68,27 @@ def suite():
     test_suite.addTests(
         unittest.TestLoader().loadTestsFromTestCase(TestCurrency)
     )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestRouting)
+    )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestDispatcher)
+    )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestInstrumentation)
+    )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestPassword)
+    )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestRateLimit)
+    )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestEmailQueue)
+    )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestSMTPPool)
+    )
     return test_suite
 
 if __name__ == '__main__':
@@ -1,7 +1,9 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import gzip
 import json
 import unittest
+from StringIO import StringIO
 
 import pycountry
 from mock import patch
@@ -330,6 +332,104 @@ class TestAddress(NereidTestCase):
                     len(json.loads(response.data)['result']), 0
                 )
 
+    def test_0060_conditional_country_lists(self):
+        """
+        The country and subdivision lists must have an ETag, reply with a
+        304 if it matches and change when the data changes
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            # Set in :meth:`setup_defaults`
+            country = self.available_countries[1]
+            subdivisions_url = '/en_US/subdivisions?country=%d' % country
+
+            with app.test_client() as c:
+                for url in ('/en_US/countries', subdivisions_url):
+                    response = c.get(url)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertTrue(response.cache_control.public)
+                    etag, weak = response.get_etag()
+                    self.assertFalse(weak)
+
+                    response = c.get(
+                        url, headers=[('If-None-Match', '"%s"' % etag)]
+                    )
+                    self.assertEqual(response.status_code, 304)
+
+                self.subdivision_obj.write(
+                    list(country.subdivisions)[:1], {'code': 'XX-99'}
+                )
+                response = c.get(
+                    subdivisions_url,
+                    headers=[('If-None-Match', '"%s"' % etag)]
+                )
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue('XX-99' in response.data)
+
+                response = c.get('/en_US/subdivisions?country=0')
+                self.assertEqual(response.status_code, 404)
+
+    def test_0070_subdivisions_bundle(self):
+        """
+        The subdivisions of all the countries of the website must be served
+        in a single versioned file, compressed if the client accepts gzip
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_request_context('/en_US/'):
+                url = self.nereid_website_obj.subdivisions_bundle_url()
+
+            with app.test_client() as c:
+                response = c.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(
+                    'immutable' in response.headers['Cache-Control']
+                )
+                bundle = json.loads(response.data)
+                etag = response.headers['ETag']
+                self.assertEqual(
+                    sorted(bundle['countries']),
+                    sorted(str(c.id) for c in self.available_countries)
+                )
+                country = self.available_countries[1]
+                self.assertEqual(
+                    len(bundle['countries'][str(country.id)]),
+                    len(country.subdivisions)
+                )
+
+                response = c.get(
+                    url, headers=[('Accept-Encoding', 'gzip, deflate')]
+                )
+                self.assertEqual(response.content_encoding, 'gzip')
+                self.assertNotEqual(response.headers['ETag'], etag)
+                self.assertEqual(
+                    json.loads(
+                        gzip.GzipFile(fileobj=StringIO(response.data)).read()
+                    ), bundle
+                )
+                self.assertEqual(
+                    c.get(url, headers=[
+                        ('Accept-Encoding', 'gzip'),
+                        ('If-None-Match', response.headers['ETag']),
+                    ]).status_code, 304
+                )
+                self.assertEqual(
+                    c.get(url, headers=[
+                        ('Accept-Encoding', 'gzip'), ('If-None-Match', etag),
+                    ]).status_code, 200
+                )
+
+                self.subdivision_obj.write(
+                    list(country.subdivisions)[:1], {'code': 'XX-99'}
+                )
+                response = c.get(url)
+                self.assertEqual(response.status_code, 302)
+                self.assertNotEqual(response.location, url)
+
 
 def suite():
     "Nereid test suite"
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import hashlib
+import json
 import unittest
 
 from mock import patch
@@ -12,6 +14,11 @@ from trytond.config import CONFIG
 from nereid.testing import NereidTestCase
 from nereid import permissions_required
 from werkzeug.exceptions import Forbidden
+from trytond.modules.nereid import party as party_module
+from trytond.modules.nereid.instrumentation import get_stats
+from trytond.modules.nereid.password import PasswordPoolBusy
+from trytond.modules.nereid.smtp_pool import get_pool
+from trytond.modules.nereid.tools import clean_record_cache
 
 CONFIG['smtp_from'] = 'from@xyz.com'
 
@@ -39,6 +46,8 @@ class TestAuth(NereidTestCase):
         self.mocked_smtp_instance = self.PatchedSMTP.return_value
 
     def tearDown(self):
+        # Drop the patched connections kept by the pool
+        get_pool().close()
         # Unpatch SMTP Lib
         self.smtplib_patcher.stop()
 
@@ -134,6 +143,11 @@ class TestAuth(NereidTestCase):
                 response = c.post('/en_US/registration', data=data)
                 self.assertEqual(response.status_code, 302)
 
+                # The activation email is queued, not sent in the request
+                self.assertEqual(
+                    self.mocked_smtp_instance.sendmail.call_count, 0
+                )
+                POOL.get('nereid.email.queue').send_all()
                 self.assertEqual(
                     self.mocked_smtp_instance.sendmail.call_count, 1
                 )
@@ -656,6 +670,404 @@ class TestAuth(NereidTestCase):
                 perm_any = [p3.value, p4.value]
             ))
 
+    def test_0110_permissions_cache(self):
+        """
+        The permissions of the users must be cached until they change
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            p1, p2 = self.nereid_permission_obj.create([
+                {'name': 'p1', 'value': 'nereid.perm1'},
+                {'name': 'p2', 'value': 'nereid.perm2'},
+            ])
+            self.nereid_user_obj.write(
+                [self.guest_user], {'permissions': [('add', [p1])]}
+            )
+            user = self.nereid_user_obj(self.guest_user.id)
+            permissions = user.get_permissions()
+            self.assertEqual(permissions, frozenset(['nereid.perm1']))
+            self.assertTrue(user.get_permissions() is permissions)
+
+            self.nereid_user_obj.write(
+                [self.guest_user], {'permissions': [('add', [p2])]}
+            )
+            self.assertEqual(
+                self.nereid_user_obj(self.guest_user.id).get_permissions(),
+                frozenset(['nereid.perm1', 'nereid.perm2'])
+            )
+
+            self.nereid_permission_obj.write([p2], {'value': 'nereid.perm3'})
+            self.assertTrue(
+                self.nereid_user_obj(self.guest_user.id).has_permissions(
+                    ['nereid.perm3']
+                )
+            )
+
+            self.nereid_permission_obj.delete([p1])
+            self.assertEqual(
+                self.nereid_user_obj(self.guest_user.id).get_permissions(),
+                frozenset(['nereid.perm3'])
+            )
+
+    def test_0120_permission_masks(self):
+        """
+        The permissions must be compiled to bitmasks given by their rank
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            p1, p2 = self.nereid_permission_obj.create([
+                {'name': 'p1', 'value': 'nereid.perm1'},
+                {'name': 'p2', 'value': 'nereid.perm2'},
+            ])
+            permissions = self.nereid_permission_obj.search(
+                [], order=[('id', 'ASC')]
+            )
+            bits = self.nereid_permission_obj.get_bits()
+            self.assertEqual(
+                bits, dict(
+                    (p.value, 1 << rank) for rank, p in enumerate(permissions)
+                )
+            )
+            self.assertEqual(
+                self.nereid_permission_obj.compile_masks(
+                    frozenset(['nereid.perm1', 'nereid.perm2'])
+                ),
+                (bits['nereid.perm1'] | bits['nereid.perm2'], None)
+            )
+            self.assertEqual(
+                self.nereid_permission_obj.compile_masks(
+                    ['nereid.perm1', 'nereid.unknown'],
+                    ['nereid.unknown'],
+                ),
+                (None, 0)
+            )
+
+            self.nereid_user_obj.write(
+                [self.guest_user], {'permissions': [('add', [p2])]}
+            )
+            user = self.nereid_user_obj(self.guest_user.id)
+            self.assertEqual(
+                user.get_permissions_mask(), bits['nereid.perm2']
+            )
+            self.assertTrue(user.has_permissions(
+                perm_any=frozenset(['nereid.perm1', 'nereid.perm2'])
+            ))
+            self.assertFalse(user.has_permissions(
+                perm_any=frozenset(['nereid.perm1', 'nereid.unknown'])
+            ))
+
+            p3, = self.nereid_permission_obj.create([
+                {'name': 'p3', 'value': 'nereid.perm3'},
+            ])
+            self.nereid_user_obj.write(
+                [self.guest_user], {'permissions': [('add', [p3])]}
+            )
+            self.assertTrue(
+                self.nereid_user_obj(self.guest_user.id).has_permissions(
+                    frozenset(['nereid.perm2', 'nereid.perm3'])
+                )
+            )
+
+            # The bits shift when a permission is deleted
+            self.nereid_permission_obj.delete([p1])
+            user = self.nereid_user_obj(self.guest_user.id)
+            self.assertTrue(user.has_permissions(
+                frozenset(['nereid.perm2', 'nereid.perm3'])
+            ))
+            self.assertFalse(user.has_permissions(
+                frozenset(['nereid.perm1'])
+            ))
+            self.assertTrue(user.get_permissions_mask() < 1 << len(
+                self.nereid_permission_obj.search([])
+            ))
+
+    def test_0130_rehash_password(self):
+        """
+        The hash of the password must be upgraded to the current scheme
+        and cost on login
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            party, = self.party_obj.create([{'name': 'Registered user'}])
+            user, = self.nereid_user_obj.create([{
+                'party': party,
+                'display_name': 'Registered User',
+                'email': 'email@example.com',
+                'password': 'password',
+                'company': self.company,
+            }])
+            # Store the hash of the earlier versions
+            cursor = Transaction().cursor
+            cursor.execute(
+                'UPDATE "' + self.nereid_user_obj._table + '" '
+                'SET password = %s, salt = %s WHERE id = %s', (
+                    hashlib.sha1('password' + 'abcd1234').hexdigest(),
+                    'abcd1234', user.id
+                )
+            )
+
+            # The login does not wait for a busy pool to rehash
+            with patch.object(
+                    party_module, 'hash_password',
+                    side_effect=PasswordPoolBusy):
+                with app.test_client() as c:
+                    response = c.post('/en_US/login', data={
+                        'email': 'email@example.com',
+                        'password': 'password',
+                    })
+                    self.assertEqual(response.status_code, 302)
+            user = self.nereid_user_obj(user.id)
+            self.assertEqual(user.salt, 'abcd1234')
+
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(response.status_code, 302)
+
+            user = self.nereid_user_obj(user.id)
+            self.assertTrue(user.password.startswith('pbkdf2_sha256$'))
+            self.assertEqual(user.salt, None)
+            self.assertTrue(user.match_password('password'))
+
+    def test_0140_login_busy(self):
+        """
+        The login, change of password and registration must fail with a
+        message when the password workers are busy
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            party, = self.party_obj.create([{'name': 'Registered user'}])
+            self.nereid_user_obj.create([{
+                'party': party,
+                'display_name': 'Registered User',
+                'email': 'email@example.com',
+                'password': 'password',
+                'company': self.company,
+            }])
+
+            with patch.object(
+                    party_module, 'verify_password',
+                    side_effect=PasswordPoolBusy):
+                with app.test_client() as c:
+                    response = c.post('/en_US/login', data={
+                        'email': 'email@example.com',
+                        'password': 'password',
+                    })
+                    self.assertEqual(response.status_code, 200)
+                    self.assertTrue('try again' in response.data)
+                    self.assertFalse(
+                        'Invalid login credentials' in response.data
+                    )
+
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(response.status_code, 302)
+                with patch.object(
+                        party_module, 'hash_password',
+                        side_effect=PasswordPoolBusy):
+                    response = c.post('/en_US/change-password', data={
+                        'old_password': 'password',
+                        'password': 'new-password',
+                        'confirm': 'new-password',
+                    })
+                    self.assertEqual(response.status_code, 200)
+                    self.assertTrue('try again' in response.data)
+
+            parties = self.party_obj.search([], count=True)
+            with patch.object(
+                    party_module, 'hash_password',
+                    side_effect=PasswordPoolBusy):
+                with app.test_client() as c:
+                    response = c.post('/en_US/registration', data={
+                        'name': 'New User',
+                        'email': 'new@example.com',
+                        'password': 'password',
+                        'confirm': 'password',
+                    })
+                    self.assertEqual(response.status_code, 200)
+                    self.assertTrue('try again' in response.data)
+            self.assertEqual(self.party_obj.search([], count=True), parties)
+            self.assertFalse(self.nereid_user_obj.search([
+                ('email', '=', 'new@example.com'),
+            ]))
+
+    def test_0150_authenticate_without_request(self):
+        """
+        Users must be authenticated by email and company without a request,
+        and the activation code of a reset must be cleared on login
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            party, = self.party_obj.create([{'name': 'Registered user'}])
+            user, = self.nereid_user_obj.create([{
+                'party': party,
+                'display_name': 'Registered User',
+                'email': 'email@example.com',
+                'password': 'password',
+                'company': self.company,
+                'activation_code': 'reset-code',
+            }])
+
+            self.assertEqual(
+                self.nereid_user_obj.authenticate(
+                    'email@example.com', 'wrong', self.company.id
+                ), None
+            )
+            self.assertEqual(
+                self.nereid_user_obj.authenticate(
+                    'other@example.com', 'password', self.company.id
+                ), None
+            )
+            self.assertEqual(
+                self.nereid_user_obj(user.id).activation_code, 'reset-code'
+            )
+
+            result = self.nereid_user_obj.authenticate(
+                'email@example.com', 'password', self.company.id
+            )
+            self.assertEqual(result, user)
+            self.assertEqual(result.activation_code, None)
+
+            # A pending activation must not log in
+            self.nereid_user_obj.write(
+                [user], {'activation_code': 'a' * 16}
+            )
+            self.assertEqual(
+                self.nereid_user_obj.authenticate(
+                    'email@example.com', 'password', self.company.id
+                ), False
+            )
+
+    def test_0160_user_snapshot(self):
+        """
+        The user of the request must be loaded from its cached snapshot,
+        which must be refreshed when the user is modified
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            party, = self.party_obj.create([{'name': 'Registered user'}])
+            user, = self.nereid_user_obj.create([{
+                'party': party,
+                'display_name': 'Registered User',
+                'email': 'email@example.com',
+                'password': 'password',
+                'company': self.company,
+            }])
+
+            snapshot = self.nereid_user_obj.get_snapshot(user.id)
+            self.assertEqual(snapshot['display_name'], 'Registered User')
+            self.assertEqual(snapshot['party'], party.id)
+            self.assertEqual(self.nereid_user_obj.get_snapshot(-1), None)
+
+            record = self.nereid_user_obj.from_snapshot(user.id)
+            self.assertEqual(record, user)
+            self.assertEqual(record.party, party)
+            self.assertEqual(record.display_name, 'Registered User')
+            # The other fields are still read on use
+            self.assertTrue(record.password)
+
+            with app.test_client() as c:
+                response = c.get('/en_US/me')
+                self.assertEqual(response.status_code, 302)
+
+                c.post('/en_US/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+
+                # Changed behind the back of the cache
+                cursor = Transaction().cursor
+                cursor.execute(
+                    'UPDATE "' + self.nereid_user_obj._table + '" '
+                    'SET display_name = %s WHERE id = %s',
+                    ('Stale Name', user.id)
+                )
+                # As in the new transaction of the next request
+                clean_record_cache(self.nereid_user_obj, [user.id])
+                response = c.get('/en_US/me')
+                self.assertEqual(response.data, 'Registered User')
+
+                self.nereid_user_obj.write(
+                    [user], {'display_name': 'New Name'}
+                )
+                response = c.get('/en_US/me')
+                self.assertEqual(response.data, 'New Name')
+
+            # Only the fields which are set are saved
+            record = self.nereid_user_obj.from_snapshot(user.id)
+            self.nereid_user_obj.write([user], {'email': 'new@example.com'})
+            record.timezone = 'Asia/Kolkata'
+            record.save()
+            user = self.nereid_user_obj(user.id)
+            self.assertEqual(user.email, 'new@example.com')
+            self.assertEqual(user.timezone, 'Asia/Kolkata')
+
+    def test_0170_user_status(self):
+        """
+        The user status must be served without queries, with an ETag
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(INSTRUMENTATION=True)
+
+            party, = self.party_obj.create([{'name': 'Registered user'}])
+            user, = self.nereid_user_obj.create([{
+                'party': party,
+                'display_name': 'Registered User',
+                'email': 'email@example.com',
+                'password': 'password',
+                'company': self.company,
+            }])
+
+            with app.test_client() as c:
+                response = c.get('/en_US/user_status')
+                self.assertEqual(response.status_code, 200)
+                etag = response.headers['ETag']
+
+                response = c.get(
+                    '/en_US/user_status', headers={'If-None-Match': etag}
+                )
+                self.assertEqual(response.status_code, 304)
+
+                c.post('/en_US/login', data={
+                    'email': 'email@example.com',
+                    'password': 'password',
+                })
+                response = c.get(
+                    '/en_US/user_status', headers={'If-None-Match': etag}
+                )
+                self.assertEqual(response.status_code, 200)
+                status = json.loads(response.data)['status']
+                self.assertEqual(status['name'], 'Registered User')
+                self.assertEqual(len(status['messages']), 1)
+
+                response = c.get('/en_US/user_status')
+                etag = response.headers['ETag']
+                stats = get_stats()['nereid.website.user_status']
+                self.assertEqual(stats['status']['queries'], 0)
+
+                self.nereid_user_obj.write(
+                    [user], {'display_name': 'New Name'}
+                )
+                response = c.get(
+                    '/en_US/user_status', headers={'If-None-Match': etag}
+                )
+                self.assertEqual(response.status_code, 200)
+                status = json.loads(response.data)['status']
+                self.assertEqual(status['name'], 'New Name')
+
 
 def suite():
     "Nereid test suite"
@@ -2,6 +2,7 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 import unittest
+from datetime import date, timedelta
 from decimal import Decimal
 
 import trytond.tests.test_tryton
@@ -82,7 +83,7 @@ class TestCurrency(NereidTestCase):
         self.website_currencies = [c1, c2]
         url_map, = self.url_map_obj.search([], limit=1)
         self.en_us, = self.language_obj.search([('code', '=', 'en_US')])
-        self.nereid_website_obj.create([{
+        self.website, = self.nereid_website_obj.create([{
             'name': 'localhost',
             'url_map': url_map,
             'company': self.company,
@@ -145,6 +146,57 @@ class TestCurrency(NereidTestCase):
                     self.currency_obj.convert(Decimal('100')), Decimal('3000')
                 )
 
+    def test_0030_website_currencies_cache(self):
+        """
+        The currencies of the website must be cached with their rates, and
+        the cache must be cleared when the currencies change
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            c1, c2 = self.website_currencies
+
+            website = self.nereid_website_obj(self.website.id)
+            currencies = website.get_currencies()
+            self.assertEqual(
+                [c['id'] for c in currencies], [c1.id, c2.id]
+            )
+            self.assertEqual(currencies[0]['rate'], Decimal('10'))
+            self.assertEqual(currencies[0]['digits'], c1.digits)
+            self.assertEqual(currencies[0]['rounding'], c1.rounding)
+            self.assertTrue(website.get_currencies() is currencies)
+
+            POOL.get('currency.currency.rate').write(
+                list(c1.rates), {'rate': Decimal('11')}
+            )
+            currencies = website.get_currencies()
+            self.assertEqual(currencies[0]['rate'], Decimal('11'))
+
+            self.nereid_website_obj.write(
+                [self.website], {'currencies': [('unlink', [c2.id])]}
+            )
+            website = self.nereid_website_obj(self.website.id)
+            self.assertEqual(
+                [c['id'] for c in website.get_currencies()], [c1.id]
+            )
+
+            # A rate which takes effect later is used from its date on
+            rate_obj = POOL.get('currency.currency.rate')
+            rate_obj.create([{
+                'currency': c1.id,
+                'date': date.today() + timedelta(days=1),
+                'rate': Decimal('12'),
+            }])
+            website = self.nereid_website_obj(self.website.id)
+            self.assertEqual(
+                website.get_currencies()[0]['rate'], Decimal('11')
+            )
+            with Transaction().set_context(
+                    date=date.today() + timedelta(days=1)):
+                website = self.nereid_website_obj(self.website.id)
+                self.assertEqual(
+                    website.get_currencies()[0]['rate'], Decimal('12')
+                )
+
 
 def suite():
     "Currency test suite"
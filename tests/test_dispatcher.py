@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import timeit
+import unittest
+
+from werkzeug.routing import Map, Rule
+from werkzeug.exceptions import HTTPException
+from trytond.modules.nereid.dispatcher import TrieMap, rule_segments
+
+
+class TestDispatcher(unittest.TestCase):
+    """
+    Test the trie dispatcher against the werkzeug map
+    """
+
+    def get_rules(self, count):
+        """
+        Returns a list of rules similar to the nereid rules, with `count`
+        synthetic rules
+        """
+        rules = [
+            Rule('/', endpoint='home'),
+            Rule('/<language>/', endpoint='home'),
+            Rule('/<language>/login', endpoint='login',
+                methods=['GET', 'POST']),
+            Rule('/<language>/static-file/<folder>/<name>',
+                endpoint='static_file'),
+            Rule('/<language>/activate-account/<int:active_id>/<code>',
+                endpoint='activate'),
+            Rule('/<language>/files/<path:filename>', endpoint='files'),
+            Rule('/<language>/page-<int:page>', endpoint='page'),
+            Rule('/<language>/folder/', endpoint='folder'),
+        ]
+        for i in xrange(count):
+            rules.append(
+                Rule('/<language>/section-%d/<int:id>' % i,
+                    endpoint='section-%d' % i)
+            )
+        return rules
+
+    def match(self, url_map, path, method='GET'):
+        """
+        Returns the result of the match or the class of the exception
+        """
+        adapter = url_map.bind('localhost', '/')
+        try:
+            return adapter.match(path, method)
+        except HTTPException, exc:
+            return exc.__class__
+
+    def test_0010_rule_segments(self):
+        """
+        Check the segments computed for rules
+        """
+        self.assertEqual(rule_segments('/'), [])
+        self.assertEqual(rule_segments('/<language>/login'), [None, 'login'])
+        self.assertEqual(
+            rule_segments('/<language>/page-<int:page>'), [None, None]
+        )
+        self.assertEqual(rule_segments('/<language>/<path:name>'), None)
+
+    def test_0020_same_matches(self):
+        """
+        The trie dispatcher must give the same results as the werkzeug map
+        """
+        werkzeug_map = Map(self.get_rules(100))
+        trie_map = TrieMap(self.get_rules(100))
+        paths = [
+            ('/', 'GET'),
+            ('/en_US/', 'GET'),
+            ('/en_US', 'GET'),
+            ('/en_US/login', 'POST'),
+            ('/en_US/login', 'PUT'),
+            ('/en_US/static-file/images/logo.png', 'GET'),
+            ('/en_US/activate-account/10/xyz', 'GET'),
+            ('/en_US/activate-account/abc/xyz', 'GET'),
+            ('/en_US/files/a/b/c.pdf', 'GET'),
+            ('/en_US/page-2', 'GET'),
+            ('/en_US/folder', 'GET'),
+            ('/en_US/section-99/1', 'GET'),
+            ('/en_US/section-100/1', 'GET'),
+            ('/en_US/missing', 'GET'),
+        ]
+        for path, method in paths:
+            self.assertEqual(
+                self.match(trie_map, path, method),
+                self.match(werkzeug_map, path, method),
+                path
+            )
+
+    def test_0030_benchmark(self):
+        """
+        Compare the time taken by both the dispatchers to match the paths of
+        a map with 1,000 rules
+        """
+        werkzeug_map = Map(self.get_rules(1000))
+        trie_map = TrieMap(self.get_rules(1000))
+        paths = ['/en_US/section-%d/1' % i for i in xrange(0, 1000, 50)]
+        paths.append('/en_US/static-file/images/logo.png')
+
+        def run(url_map):
+            adapter = url_map.bind('localhost', '/')
+            for path in paths:
+                adapter.match(path)
+
+        werkzeug_time = min(timeit.repeat(
+            lambda: run(werkzeug_map), repeat=3, number=5
+        ))
+        trie_time = min(timeit.repeat(
+            lambda: run(trie_map), repeat=3, number=5
+        ))
+        self.assertTrue(
+            trie_time < werkzeug_time,
+            'Trie: %.4fs, Werkzeug: %.4fs' % (trie_time, werkzeug_time)
+        )
+
+
+def suite():
+    "Dispatcher test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestDispatcher)
+        )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import asyncore
+import datetime
+import smtpd
+import threading
+import unittest
+
+from mock import patch
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from trytond.config import CONFIG
+from trytond.modules.nereid.smtp_pool import get_pool
+
+
+class SMTPStandIn(smtpd.SMTPServer):
+    """
+    A local SMTP server keeping the messages it receives, run in a thread
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.connections = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.close()
+
+
+class TestEmailQueue(unittest.TestCase):
+    """
+    Test the outbound email queue against a local SMTP server
+    """
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid')
+        self.email_queue_obj = POOL.get('nereid.email.queue')
+
+        self.smtp_config = dict(
+            (key, CONFIG.get(key)) for key in (
+                'smtp_server', 'smtp_port', 'smtp_ssl', 'smtp_tls',
+                'smtp_user', 'smtp_password',
+            )
+        )
+        self.server = SMTPStandIn()
+        self.set_config({
+            'smtp_server': '127.0.0.1',
+            'smtp_port': self.server.port,
+            'smtp_ssl': False,
+            'smtp_tls': False,
+            'smtp_user': None,
+            'smtp_password': None,
+        })
+
+    def tearDown(self):
+        get_pool().close()
+        self.server.stop()
+        self.set_config(self.smtp_config)
+
+    def set_config(self, values):
+        for key, value in values.iteritems():
+            CONFIG[key] = value
+
+    def queue(self, count=1):
+        return [
+            self.email_queue_obj.queue_mail(
+                'from@example.com', ['to%d@example.com' % i],
+                'Subject: Test %d\n\nBody' % i
+            ) for i in range(count)
+        ]
+
+    def test_0010_send_batch(self):
+        """
+        The queued messages must be sent over a single connection
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            messages = self.queue(3)
+            self.assertEqual(self.server.messages, [])
+
+            self.email_queue_obj.send_all()
+
+            self.assertEqual(self.server.connections, 1)
+            self.assertEqual(
+                [rcpttos for _, rcpttos, _ in self.server.messages],
+                [['to0@example.com'], ['to1@example.com'],
+                    ['to2@example.com']]
+            )
+            for message in self.email_queue_obj.browse(messages):
+                self.assertEqual(message.state, 'sent')
+                self.assertEqual(message.attempts, 1)
+
+            # Sent messages are not sent again
+            self.email_queue_obj.send_all()
+            self.assertEqual(len(self.server.messages), 3)
+
+    def test_0020_batch_size(self):
+        """
+        The messages must be sent in batches until none is due, unless the
+        time budget is spent
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.queue(5)
+
+            self.email_queue_obj.send_all(batch_size=2, time_budget=0)
+            self.assertEqual(len(self.server.messages), 2)
+
+            # The batches sent are committed before the next one
+            with patch.object(Transaction().cursor, 'commit') as commit:
+                self.email_queue_obj.send_all(batch_size=2)
+            self.assertEqual(len(self.server.messages), 5)
+            self.assertEqual(self.server.connections, 1)
+            self.assertEqual(commit.call_count, 1)
+
+    def test_0030_retry(self):
+        """
+        The messages which could not be sent must be tried again later, and
+        marked as failed after the last attempt
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            message, = self.queue()
+
+            # Nothing listens on the port anymore
+            self.server.stop()
+            self.email_queue_obj.send_all()
+
+            message = self.email_queue_obj(message.id)
+            self.assertEqual(message.state, 'outbox')
+            self.assertEqual(message.attempts, 1)
+            self.assertTrue(message.last_error)
+            self.assertTrue(message.next_attempt > datetime.datetime.now())
+            self.assertEqual(
+                self.email_queue_obj.get_retry_delay(2),
+                2 * self.email_queue_obj.get_retry_delay(1)
+            )
+
+            self.email_queue_obj.write([message], {
+                'attempts': 4,
+                'next_attempt': datetime.datetime.now(),
+            })
+            self.email_queue_obj.send_all()
+            message = self.email_queue_obj(message.id)
+            self.assertEqual(message.state, 'failed')
+            self.assertEqual(message.attempts, 5)
+
+            self.server = SMTPStandIn()
+
+    def test_0040_rollback(self):
+        """
+        Nothing must be sent if the transaction which queued the message is
+        rolled back
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.queue()
+            Transaction().cursor.rollback()
+
+            self.email_queue_obj.send_all()
+            self.assertEqual(self.server.messages, [])
+
+
+def suite():
+    "Email queue test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestEmailQueue)
+        )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from nereid.testing import NereidTestCase
+from trytond.modules.nereid.instrumentation import get_stats, reset_stats
+
+
+class TestInstrumentation(NereidTestCase):
+    """
+    Test the request timing instrumentation
+    """
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid')
+
+        self.nereid_website_obj = POOL.get('nereid.website')
+        self.nereid_user_obj = POOL.get('nereid.user')
+        self.nereid_permission_obj = POOL.get('nereid.permission')
+        self.url_map_obj = POOL.get('nereid.url_map')
+        self.company_obj = POOL.get('company.company')
+        self.currency_obj = POOL.get('currency.currency')
+        self.language_obj = POOL.get('ir.lang')
+        self.party_obj = POOL.get('party.party')
+        reset_stats()
+
+    def setup_defaults(self):
+        """
+        Setup the defaults
+        """
+        usd, = self.currency_obj.create([{
+            'name': 'US Dollar',
+            'code': 'USD',
+            'symbol': '$',
+        }])
+        party, = self.party_obj.create([{
+            'name': 'Openlabs',
+        }])
+        company, = self.company_obj.create([{
+            'party': party,
+            'currency': usd,
+        }])
+        guest_party, registered_party = self.party_obj.create([{
+            'name': 'Guest User',
+        }, {
+            'name': 'Registered User',
+        }])
+        guest_user, self.registered_user = self.nereid_user_obj.create([{
+            'party': guest_party,
+            'display_name': 'Guest User',
+            'email': 'guest@openlabs.co.in',
+            'password': 'password',
+            'company': company.id,
+        }, {
+            'party': registered_party,
+            'display_name': 'Registered User',
+            'email': 'email@example.com',
+            'password': 'password',
+            'company': company.id,
+        }])
+        url_map, = self.url_map_obj.search([], limit=1)
+        en_us, = self.language_obj.search([('code', '=', 'en_US')])
+        self.nereid_website_obj.create([{
+            'name': 'localhost',
+            'url_map': url_map,
+            'company': company,
+            'application_user': USER,
+            'default_language': en_us,
+            'guest_user': guest_user,
+        }])
+
+    def get_template_source(self, name):
+        """
+        Return templates
+        """
+        return {
+            'login.jinja': '{{ login_form.errors }}',
+        }.get(name)
+
+    def login(self, client):
+        response = client.post('/en_US/login', data={
+            'email': 'email@example.com',
+            'password': 'password',
+        })
+        self.assertEqual(response.status_code, 302)
+
+    def test_0010_disabled(self):
+        """
+        Requests must not be measured unless instrumentation is enabled
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                response = c.get('/en_US/login')
+                self.assertEqual(response.status_code, 200)
+                self.assertFalse('Server-Timing' in response.headers)
+            self.assertEqual(get_stats(), {})
+
+    def test_0020_server_timing(self):
+        """
+        The phases of a request must be sent in the Server-Timing header and
+        aggregated per endpoint
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(INSTRUMENTATION=True)
+
+            with app.test_client() as c:
+                response = c.get('/en_US/login')
+                self.assertEqual(response.status_code, 200)
+                phases = [
+                    timing.split(';')[0] for timing in
+                    response.headers['Server-Timing'].split(', ')
+                ]
+                self.assertEqual(phases, ['validate', 'render', 'total'])
+
+                self.login(c)
+
+            stats = get_stats()['nereid.website.login']
+            self.assertEqual(stats['total']['count'], 2)
+            self.assertEqual(stats['render']['count'], 1)
+            self.assertEqual(stats['authenticate']['count'], 1)
+            self.assertTrue(stats['authenticate']['queries'] > 0)
+
+    def test_0030_stats_endpoint(self):
+        """
+        The statistics must only be shown to users with the instrumentation
+        permission
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(INSTRUMENTATION=True)
+
+            with app.test_client() as c:
+                response = c.get('/en_US/instrumentation-stats')
+                self.assertEqual(response.status_code, 302)
+
+                self.login(c)
+                response = c.get('/en_US/instrumentation-stats')
+                self.assertEqual(response.status_code, 403)
+
+                permission, = self.nereid_permission_obj.search([
+                    ('value', '=', 'nereid.instrumentation')
+                ])
+                self.nereid_user_obj.write(
+                    [self.registered_user],
+                    {'permissions': [('add', [permission])]}
+                )
+                response = c.get('/en_US/instrumentation-stats')
+                self.assertEqual(response.status_code, 200)
+                stats = json.loads(response.data)['stats']
+                self.assertTrue('nereid.website.login' in stats)
+
+    def test_0040_slow_request_dump(self):
+        """
+        Requests slower than the threshold must be dumped to the directory
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            with Transaction().start(DB_NAME, USER, CONTEXT):
+                self.setup_defaults()
+                app = self.get_app(
+                    INSTRUMENTATION=True, SLOW_REQUEST_THRESHOLD=0,
+                    SLOW_REQUEST_DIR=directory
+                )
+
+                with app.test_client() as c:
+                    c.get('/en_US/login')
+
+            filename, = os.listdir(directory)
+            with open(os.path.join(directory, filename)) as profile:
+                profile = json.load(profile)
+            self.assertEqual(profile['endpoint'], 'nereid.website.login')
+            self.assertEqual(profile['phases'][-1]['name'], 'total')
+        finally:
+            shutil.rmtree(directory)
+
+
+def suite():
+    "Instrumentation test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestInstrumentation)
+        )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
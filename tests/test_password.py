@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import time
+import hashlib
+import unittest
+
+from trytond.config import CONFIG
+from trytond.modules.nereid import password
+from trytond.modules.nereid.password import hash_password, verify_password, \
+    needs_rehash, benchmark, PasswordPoolBusy
+
+
+class TestPassword(unittest.TestCase):
+    """
+    Test the password schemes
+    """
+
+    def setUp(self):
+        self.cost = CONFIG.get('nereid_password_cost_pbkdf2_sha256')
+        CONFIG['nereid_password_cost_pbkdf2_sha256'] = 1000
+
+    def tearDown(self):
+        CONFIG['nereid_password_cost_pbkdf2_sha256'] = self.cost
+
+    def test_0010_hash_password(self):
+        """
+        Hash and verify passwords with the configured scheme
+        """
+        hashed = hash_password(u'pass\xe9word')
+        self.assertTrue(hashed.startswith('pbkdf2_sha256$1000$'))
+        self.assertNotEqual(hash_password(u'pass\xe9word'), hashed)
+        self.assertTrue(verify_password(u'pass\xe9word', hashed))
+        self.assertTrue(verify_password(u'pass\xe9word', unicode(hashed)))
+        self.assertFalse(verify_password(u'password', hashed))
+        self.assertFalse(verify_password(u'password', None))
+        self.assertFalse(
+            verify_password(u'password', 'unknown$1$salt$digest')
+        )
+
+    def test_0020_legacy_hash(self):
+        """
+        Verify the SHA-1 hashes of the earlier versions, which must be
+        upgraded
+        """
+        hashed = hashlib.sha1('password' + 'abcd1234').hexdigest()
+        self.assertTrue(verify_password('password', hashed, 'abcd1234'))
+        self.assertFalse(verify_password('password', hashed, 'abcd4321'))
+        self.assertTrue(needs_rehash(hashed))
+
+    def test_0030_needs_rehash(self):
+        """
+        A hash must be upgraded when the scheme or the cost changes
+        """
+        hashed = hash_password('password')
+        self.assertFalse(needs_rehash(hashed))
+
+        CONFIG['nereid_password_cost_pbkdf2_sha256'] = 2000
+        self.assertTrue(needs_rehash(hashed))
+
+        CONFIG['nereid_password_scheme'] = 'sha1'
+        try:
+            self.assertTrue(needs_rehash(hashed))
+            self.assertTrue(hash_password('password').startswith('sha1$'))
+        finally:
+            CONFIG['nereid_password_scheme'] = None
+
+    def test_0040_benchmark(self):
+        """
+        A higher cost must lower the logins per second
+        """
+        fast = benchmark('pbkdf2_sha256', 100, duration=0.1)
+        slow = benchmark('pbkdf2_sha256', 10000, duration=0.1)
+        self.assertTrue(fast > slow, '%.1f <= %.1f' % (fast, slow))
+
+    def test_0045_fallbacks(self):
+        """
+        The fallbacks for the Pythons before 2.7.8 must give the same
+        results as the standard library
+        """
+        for key, salt, iterations in [
+                ('password', 'salt', 1), ('password', 'salt', 1000),
+                ('x' * 100, 'abcd1234', 10), ('', '', 2)]:
+            self.assertEqual(
+                password._pbkdf2_hmac('sha256', key, salt, iterations),
+                hashlib.pbkdf2_hmac('sha256', key, salt, iterations)
+            )
+        self.assertTrue(password._compare_digest('abc', 'abc'))
+        self.assertFalse(password._compare_digest('abc', 'abd'))
+        self.assertFalse(password._compare_digest('abc', 'abcd'))
+
+    def test_0050_worker_pool(self):
+        """
+        Passwords must be verified in the worker pool, failing fast when
+        too many are pending
+        """
+        CONFIG['nereid_password_workers'] = 1
+        CONFIG['nereid_password_queue'] = 1
+        try:
+            # The pool is not started by the requests
+            self.assertEqual(password._get_worker_pool(), None)
+
+            worker_pool = password.start_worker_pool()
+            self.assertTrue(password._get_worker_pool() is worker_pool)
+            hashed = hash_password('password')
+            self.assertTrue(verify_password('password', hashed))
+            self.assertFalse(verify_password('wrong', hashed))
+
+            worker_pool.slots.acquire()
+            try:
+                self.assertRaises(
+                    PasswordPoolBusy, verify_password, 'password', hashed
+                )
+            finally:
+                worker_pool.slots.release()
+
+            # A worker which does not answer in time
+            worker_pool.timeout = 0.1
+            self.assertRaises(
+                PasswordPoolBusy, worker_pool.run, time.sleep, (1,), True
+            )
+        finally:
+            CONFIG['nereid_password_workers'] = None
+            CONFIG['nereid_password_queue'] = None
+            password.stop_worker_pool()
+
+
+def suite():
+    "Password test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestPassword)
+        )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import hashlib
+import unittest
+
+from mock import patch
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from nereid.testing import NereidTestCase
+from trytond.modules.nereid.rate_limit import MemoryBackend, get_keys
+
+
+class TestRateLimit(NereidTestCase):
+    """
+    Test the rate limiting of the expensive handlers
+    """
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid')
+
+        self.nereid_website_obj = POOL.get('nereid.website')
+        self.nereid_user_obj = POOL.get('nereid.user')
+        self.url_map_obj = POOL.get('nereid.url_map')
+        self.company_obj = POOL.get('company.company')
+        self.currency_obj = POOL.get('currency.currency')
+        self.language_obj = POOL.get('ir.lang')
+        self.party_obj = POOL.get('party.party')
+
+    def setup_defaults(self):
+        """
+        Setup the defaults
+        """
+        usd, = self.currency_obj.create([{
+            'name': 'US Dollar',
+            'code': 'USD',
+            'symbol': '$',
+        }])
+        party, = self.party_obj.create([{
+            'name': 'Openlabs',
+        }])
+        company, = self.company_obj.create([{
+            'party': party,
+            'currency': usd,
+        }])
+        guest_party, registered_party = self.party_obj.create([{
+            'name': 'Guest User',
+        }, {
+            'name': 'Registered User',
+        }])
+        guest_user, self.registered_user = self.nereid_user_obj.create([{
+            'party': guest_party,
+            'display_name': 'Guest User',
+            'email': 'guest@openlabs.co.in',
+            'password': 'password',
+            'company': company.id,
+        }, {
+            'party': registered_party,
+            'display_name': 'Registered User',
+            'email': 'email@example.com',
+            'password': 'password',
+            'company': company.id,
+        }])
+        url_map, = self.url_map_obj.search([], limit=1)
+        en_us, = self.language_obj.search([('code', '=', 'en_US')])
+        self.nereid_website_obj.create([{
+            'name': 'localhost',
+            'url_map': url_map,
+            'company': company,
+            'application_user': USER,
+            'default_language': en_us,
+            'guest_user': guest_user,
+        }])
+
+    def get_template_source(self, name):
+        """
+        Return templates
+        """
+        return {
+            'login.jinja': '{{ login_form.errors }}',
+            'reset-password.jinja': '',
+        }.get(name)
+
+    def test_0010_memory_backend(self):
+        """
+        The hits must be counted in a sliding window
+        """
+        backend = MemoryBackend()
+        with patch('time.time', return_value=1000.0):
+            self.assertEqual(backend.hit('key', 2, 60), 0)
+        with patch('time.time', return_value=1030.0):
+            self.assertEqual(backend.hit('key', 2, 60), 0)
+            self.assertEqual(backend.hit('key', 2, 60), 30)
+            self.assertEqual(backend.hit('other', 2, 60), 0)
+        with patch('time.time', return_value=1060.5):
+            # The first hit left the window
+            self.assertEqual(backend.hit('key', 2, 60), 0)
+
+            backend.lock('other', 100)
+            self.assertEqual(backend.hit('other', 2, 60), 100)
+
+    def test_0015_memory_backend_max_keys(self):
+        """
+        The least recently hit keys must be evicted when too many keys are
+        hit within a window
+        """
+        backend = MemoryBackend(max_keys=10)
+        for i in range(100):
+            with patch('time.time', return_value=1000.0 + i):
+                backend.hit('key-%d' % i, 2, 600)
+            self.assertTrue(len(backend.hits) <= 10)
+        self.assertTrue('key-99' in backend.hits)
+        self.assertFalse('key-0' in backend.hits)
+
+    def test_0020_disabled(self):
+        """
+        Requests must not be limited unless limits are configured
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                for i in range(5):
+                    response = c.post('/en_US/login', data={
+                        'email': 'email@example.com',
+                        'password': 'wrong',
+                    })
+                    self.assertEqual(response.status_code, 200)
+
+    def test_0030_login_limit(self):
+        """
+        The logins over the limit must be rejected before the password is
+        verified, per email and per IP address
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(RATE_LIMITS={'login': (2, 60)})
+
+            with app.test_client() as c:
+                for i in range(2):
+                    response = c.post('/en_US/login', data={
+                        'email': 'email@example.com',
+                        'password': 'wrong',
+                    })
+                    self.assertEqual(response.status_code, 200)
+
+                # The form is not limited
+                response = c.get('/en_US/login')
+                self.assertEqual(response.status_code, 200)
+
+                with patch.object(
+                        self.nereid_user_obj, 'authenticate') as authenticate:
+                    response = c.post('/en_US/login', data={
+                        'email': 'email@example.com',
+                        'password': 'password',
+                    })
+                    self.assertEqual(response.status_code, 429)
+                    self.assertTrue(
+                        int(response.headers['Retry-After']) <= 61
+                    )
+                    self.assertFalse(authenticate.called)
+
+                # The other users are limited by their own address
+                response = c.post('/en_US/login', data={
+                    'email': 'other@example.com',
+                    'password': 'password',
+                }, environ_base={'REMOTE_ADDR': '10.0.0.1'})
+                self.assertEqual(response.status_code, 200)
+
+    def test_0040_lockout(self):
+        """
+        A client over the limit must be locked out for the configured
+        duration
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(
+                RATE_LIMITS={'reset_account': (1, 60)},
+                RATE_LIMIT_LOCKOUT=3600,
+            )
+
+            with app.test_client() as c:
+                response = c.post('/en_US/reset-account', data={
+                    'email': 'unknown@example.com',
+                })
+                self.assertEqual(response.status_code, 200)
+
+                response = c.post('/en_US/reset-account', data={
+                    'email': 'unknown@example.com',
+                })
+                self.assertEqual(response.status_code, 429)
+                self.assertEqual(response.headers['Retry-After'], '3601')
+
+    def test_0050_keys(self):
+        """
+        The posted email address must be hashed in the keys, which must be
+        valid memcached keys whatever is posted
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            for email in (u'email@example.com', u' Email@Example.com',
+                    u'a b\x00\r\n' * 100, u'\xe9@example.com'):
+                with app.test_request_context(
+                        '/en_US/login', method='POST',
+                        data={'email': email}):
+                    keys = get_keys('login')
+                self.assertEqual(len(keys), 2)
+                for key in keys:
+                    self.assertTrue(len(key) < 250)
+                    self.assertFalse(any(c <= ' ' for c in key))
+                self.assertFalse(email.strip() in keys[1])
+
+            with app.test_request_context(
+                    '/en_US/login', method='POST',
+                    data={'email': ' Email@Example.com '}):
+                self.assertEqual(
+                    get_keys('login')[1],
+                    'localhost:login:email:' +
+                    hashlib.sha1('email@example.com').hexdigest()
+                )
+
+
+def suite():
+    "Rate limiting test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestRateLimit)
+        )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import json
+import unittest
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from nereid import render_template, request
+from nereid.testing import NereidTestCase
+from trytond.modules.nereid.dispatcher import TrieMap
+from trytond.modules.nereid.tools import clean_record_cache
+from trytond.modules.nereid.page_cache import cache_guest_response, \
+    purge_surrogate_keys, surrogate_key
+
+
+class TestRouting(NereidTestCase):
+    """
+    Test URL Maps and Rules
+    """
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid')
+
+        self.url_map_obj = POOL.get('nereid.url_map')
+        self.url_rule_obj = POOL.get('nereid.url_rule')
+        self.url_rule_defaults_obj = POOL.get('nereid.url_rule_defaults')
+        self.nereid_website_obj = POOL.get('nereid.website')
+        self.nereid_user_obj = POOL.get('nereid.user')
+        self.company_obj = POOL.get('company.company')
+        self.currency_obj = POOL.get('currency.currency')
+        self.language_obj = POOL.get('ir.lang')
+        self.party_obj = POOL.get('party.party')
+
+    def setup_defaults(self):
+        """
+        Setup a URL map with a couple of rules
+        """
+        self.url_map, = self.url_map_obj.create([{
+            'name': 'Test Map',
+        }])
+        self.login_rule, self.page_rule = self.url_rule_obj.create([{
+            'rule': '/<language>/login',
+            'endpoint': 'nereid.website.login',
+            'sequence': 10,
+            'http_method_post': True,
+            'url_map': self.url_map,
+        }, {
+            'rule': '/<language>/page/<uri>',
+            'endpoint': 'nereid.website.home',
+            'sequence': 20,
+            'url_map': self.url_map,
+            'defaults': [('create', [{'key': 'uri', 'value': 'home'}])],
+        }])
+
+    def setup_website(self):
+        """
+        Setup a website using the default URL map
+        """
+        usd, = self.currency_obj.create([{
+            'name': 'US Dollar',
+            'code': 'USD',
+            'symbol': '$',
+        }])
+        party, = self.party_obj.create([{
+            'name': 'Openlabs',
+        }])
+        company, = self.company_obj.create([{
+            'party': party,
+            'currency': usd,
+        }])
+        guest_party, = self.party_obj.create([{
+            'name': 'Guest User',
+        }])
+        guest_user, = self.nereid_user_obj.create([{
+            'party': guest_party,
+            'display_name': 'Guest User',
+            'email': 'guest@openlabs.co.in',
+            'password': 'password',
+            'company': company.id,
+        }])
+        self.default_url_map, = self.url_map_obj.search([], limit=1)
+        en_us, = self.language_obj.search([('code', '=', 'en_US')])
+        self.website, = self.nereid_website_obj.create([{
+            'name': 'localhost',
+            'url_map': self.default_url_map,
+            'company': company,
+            'application_user': USER,
+            'default_language': en_us,
+            'guest_user': guest_user,
+        }])
+
+    def get_template_source(self, name):
+        """
+        Return templates
+        """
+        return {
+            'home.jinja': "{{ request.environ.get('HTTP_X_TEST') }}",
+        }.get(name)
+
+    def get_revision(self):
+        return self.url_map_obj(self.url_map.id).revision
+
+    def test_0010_rules_snapshot(self):
+        """
+        Writing the rules must only outdate the snapshot, which is used
+        when it is current and compiled again otherwise
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            url_map = self.url_map_obj(self.url_map.id)
+            self.assertNotEqual(url_map.snapshot_revision, url_map.revision)
+            compiled = url_map.compile_rules_arguments()
+            self.assertEqual(len(compiled), 2)
+            self.assertEqual(url_map.get_rules_arguments(), compiled)
+
+            # A current snapshot is used as it is
+            cursor = Transaction().cursor
+            cursor.execute(
+                'UPDATE "' + self.url_map_obj._table + '" '
+                'SET rules_snapshot = %s, snapshot_revision = revision '
+                'WHERE id = %s', (json.dumps(compiled[:1]), url_map.id)
+            )
+            clean_record_cache(self.url_map_obj, [url_map.id])
+            url_map = self.url_map_obj(self.url_map.id)
+            self.assertEqual(url_map.get_rules_arguments(), compiled[:1])
+
+            # A rule change outdates it without compiling anything
+            self.url_rule_obj.write(
+                [self.login_rule], {'rule': '/<language>/sign-in'}
+            )
+            url_map = self.url_map_obj(self.url_map.id)
+            self.assertEqual(
+                json.loads(url_map.rules_snapshot), compiled[:1]
+            )
+            self.assertNotEqual(url_map.snapshot_revision, url_map.revision)
+            self.assertEqual(len(url_map.get_rules_arguments()), 2)
+
+    def test_0020_revision(self):
+        """
+        Changes to rules, defaults or the map must bump the revision
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            revision = self.get_revision()
+            self.url_rule_obj.write(
+                [self.login_rule], {'rule': '/<language>/sign-in'}
+            )
+            self.assertEqual(self.get_revision(), revision + 1)
+
+            revision = self.get_revision()
+            self.url_rule_defaults_obj.write(
+                list(self.page_rule.defaults), {'value': 'index'}
+            )
+            self.assertEqual(self.get_revision(), revision + 1)
+
+            revision = self.get_revision()
+            self.url_map_obj.write([self.url_map], {'strict_slashes': True})
+            self.assertEqual(self.get_revision(), revision + 1)
+
+            revision = self.get_revision()
+            self.url_rule_obj.delete([self.login_rule])
+            self.assertEqual(self.get_revision(), revision + 1)
+
+            url_map = self.url_map_obj(self.url_map.id)
+            rules_arguments = url_map.get_rules_arguments()
+            self.assertEqual(len(rules_arguments), 1)
+            self.assertEqual(
+                rules_arguments[0]['defaults'], {'uri': 'index'}
+            )
+
+    def test_0030_bulk_rules_arguments(self):
+        """
+        The bulk rule arguments must be the same as the arguments built
+        from each rule
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            rules = self.url_rule_obj.search([])
+            self.assertEqual(
+                self.url_rule_obj.get_rules_arguments([r.id for r in rules]),
+                [r.get_rule_arguments() for r in rules]
+            )
+
+    def test_0040_refresh_url_maps(self):
+        """
+        A rule added after the application is loaded must be served once
+        the revision of the map is checked
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_website()
+            app = self.get_app(URL_MAP_CHECK_INTERVAL=0)
+
+            with app.test_client() as c:
+                response = c.get('/en_US/countries')
+                self.assertEqual(response.status_code, 200)
+                response = c.get('/en_US/country-list')
+                self.assertEqual(response.status_code, 404)
+
+                self.url_rule_obj.create([{
+                    'rule': '/<language>/country-list',
+                    'endpoint': 'nereid.website.country_list',
+                    'sequence': 10,
+                    'url_map': self.default_url_map,
+                }])
+
+                # The map is rebuilt when this request starts and is used
+                # from the next request
+                response = c.get('/en_US/countries')
+                self.assertEqual(response.status_code, 200)
+                response = c.get('/en_US/country-list')
+                self.assertEqual(response.status_code, 200)
+
+    def test_0050_trie_dispatcher(self):
+        """
+        The maps of the websites must be replaced by trie maps when the
+        trie dispatcher is enabled, even if the maps are never refreshed
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_website()
+            app = self.get_app(
+                URL_MAP_CHECK_INTERVAL=None, URL_TRIE_DISPATCHER=True
+            )
+
+            with app.test_client() as c:
+                response = c.get('/en_US/countries')
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(
+                    isinstance(app.websites['localhost']['url_map'], TrieMap)
+                )
+                response = c.get('/en_US/countries')
+                self.assertEqual(response.status_code, 200)
+                response = c.get('/en_US/subdivisions?country=0')
+                self.assertEqual(response.status_code, 404)
+
+    def test_0060_guest_page_cache(self):
+        """
+        Responses to guest users must be cached for the rules with a cache
+        timeout until their website or the records they depend on change
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_website()
+            home_rule, = self.url_rule_obj.search([
+                ('rule', '=', '/<language>/'),
+                ('url_map', '=', self.default_url_map.id),
+            ])
+            self.url_rule_obj.write([home_rule], {'cache_timeout': 60})
+            app = self.get_app()
+
+            with app.test_client() as c:
+                # Other tests patch the home page method, so the view
+                # function is decorated here
+                @cache_guest_response(
+                    lambda **kwargs: [surrogate_key('test.model', 1)]
+                )
+                def home_func():
+                    return render_template('home.jinja')
+                c.application.view_functions['nereid.website.home'] = \
+                    home_func
+
+                response = c.get('/en_US/', headers=[('X-Test', 'a')])
+                self.assertEqual(response.data, 'a')
+                response = c.get('/en_US/', headers=[('X-Test', 'b')])
+                self.assertEqual(response.data, 'a')
+
+                # Rule without a cache timeout
+                response = c.get('/', headers=[('X-Test', 'b')])
+                self.assertEqual(response.data, 'b')
+
+                # Only the keys of the website of the page purge it
+                purge_surrogate_keys([
+                    'nereid.website',
+                    surrogate_key('nereid.website', self.website.id + 1),
+                ])
+                response = c.get('/en_US/', headers=[('X-Test', 'b')])
+                self.assertEqual(response.data, 'a')
+
+                purge_surrogate_keys([surrogate_key('test.model', 1)])
+                response = c.get('/en_US/', headers=[('X-Test', 'b')])
+                self.assertEqual(response.data, 'b')
+
+                self.nereid_website_obj.write(
+                    [self.website], {'timezone': 'Asia/Kolkata'}
+                )
+                response = c.get('/en_US/', headers=[('X-Test', 'c')])
+                self.assertEqual(response.data, 'c')
+
+    def test_0070_website_descriptor(self):
+        """
+        The website descriptor must be immutable, cached and rebuilt when
+        the website changes
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_website()
+
+            descriptor = self.nereid_website_obj.get_descriptor('localhost')
+            self.assertEqual(descriptor.id, self.website.id)
+            self.assertEqual(descriptor.company, self.website.company.id)
+            self.assertEqual(descriptor.url_map, self.default_url_map.id)
+            self.assertEqual(descriptor.countries, frozenset())
+            self.assertRaises(
+                AttributeError, setattr, descriptor, 'timezone', 'UTC'
+            )
+            self.assertTrue(
+                self.nereid_website_obj.get_descriptor('localhost')
+                is descriptor
+            )
+
+            self.nereid_website_obj.write(
+                [self.website], {'timezone': 'Asia/Kolkata'}
+            )
+            descriptor = self.nereid_website_obj.get_descriptor('localhost')
+            self.assertEqual(descriptor.timezone, 'Asia/Kolkata')
+
+            self.assertRaises(
+                RuntimeError, self.nereid_website_obj.get_descriptor,
+                'example.com'
+            )
+
+    def test_0080_request_website(self):
+        """
+        The website, language and currency of the request must be set from
+        the descriptor, with their values in the read caches
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_website()
+            app = self.get_app()
+            # The languages cached by the transactions of the other tests,
+            # which were rolled back
+            self.nereid_website_obj._languages_cache.clear()
+
+            descriptor = self.nereid_website_obj.get_descriptor('localhost')
+            self.assertEqual(descriptor.default_language_code, 'en_US')
+            website = self.nereid_website_obj.from_descriptor(descriptor)
+            self.assertEqual(website, self.website)
+            self.assertEqual(
+                website._local_cache[website.id]['company'].currency,
+                self.website.company.currency
+            )
+            self.assertEqual(
+                website._cache[website.id]['timezone'], self.website.timezone
+            )
+            self.assertEqual(website.default_language.code, 'en_US')
+            self.assertEqual(website.guest_user, self.website.guest_user)
+
+            with app.test_client() as c:
+                c.get('/en_US/')
+                self.assertTrue(
+                    'url_map' in
+                    request.nereid_website._local_cache[self.website.id]
+                )
+                self.assertEqual(request.nereid_language.code, 'en_US')
+                self.assertEqual(
+                    request.nereid_currency, self.website.company.currency
+                )
+
+                # Unknown languages are left to nereid
+                c.get('/xx_XX/')
+                self.assertFalse('nereid_language' in request.__dict__)
+
+
+def suite():
+    "Routing test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestRouting)
+        )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
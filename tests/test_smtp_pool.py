@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import socket
+import unittest
+from email.mime.text import MIMEText
+
+from mock import patch
+from trytond.config import CONFIG
+from trytond.modules.nereid import smtp_pool
+from trytond.modules.nereid.smtp_pool import SMTPPool
+
+from test_email_queue import SMTPStandIn
+
+
+class TestSMTPPool(unittest.TestCase):
+    """
+    Test the SMTP connection pool against a local SMTP server
+    """
+
+    def setUp(self):
+        self.smtp_config = dict(
+            (key, CONFIG.get(key)) for key in (
+                'smtp_server', 'smtp_port', 'smtp_ssl', 'smtp_tls',
+                'smtp_user', 'smtp_password',
+            )
+        )
+        self.server = SMTPStandIn()
+        self.set_config({
+            'smtp_server': '127.0.0.1',
+            'smtp_port': self.server.port,
+            'smtp_ssl': False,
+            'smtp_tls': False,
+            'smtp_user': None,
+            'smtp_password': None,
+        })
+        self.pool = SMTPPool(size=1, idle_timeout=30)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+        self.set_config(self.smtp_config)
+
+    def set_config(self, values):
+        for key, value in values.iteritems():
+            CONFIG[key] = value
+
+    def get_messages(self, count):
+        messages = []
+        for i in range(count):
+            message = MIMEText('Body %d' % i)
+            message['Subject'] = 'Test %d' % i
+            message['From'] = 'from@example.com'
+            message['To'] = 'to%d@example.com' % i
+            messages.append(message)
+        return messages
+
+    def test_0010_send_batch(self):
+        """
+        The messages of a batch must be sent over a single connection, which
+        is reused by the next batch
+        """
+        self.assertEqual(self.pool.send_batch(self.get_messages(3)), [])
+        self.assertEqual(self.pool.send_batch(self.get_messages(2)), [])
+
+        self.assertEqual(len(self.server.messages), 5)
+        self.assertEqual(self.server.messages[0][1], ['to0@example.com'])
+        self.assertEqual(self.server.connections, 1)
+
+        metrics = self.pool.get_metrics()
+        self.assertEqual(metrics['handshakes'], 1)
+        self.assertEqual(metrics['messages'], 5)
+        self.assertEqual(metrics['failures'], 0)
+        self.assertEqual(metrics['idle'], 1)
+        self.assertTrue(metrics['messages_per_second'] > 0)
+
+    def test_0020_idle_timeout(self):
+        """
+        The connections idle for too long must not be reused
+        """
+        self.pool.idle_timeout = 0
+        self.pool.send_batch(self.get_messages(1))
+        self.pool.send_batch(self.get_messages(1))
+        self.assertEqual(self.pool.get_metrics()['handshakes'], 2)
+
+    def test_0030_health_check(self):
+        """
+        An idle connection which was closed by the server must be replaced
+        """
+        self.pool.send_batch(self.get_messages(1))
+        (connection, released), = self.pool.idle.values()[0]
+        connection.close()
+
+        with patch.object(smtp_pool, 'HEALTH_CHECK_INTERVAL', -1):
+            self.assertEqual(self.pool.send_batch(self.get_messages(1)), [])
+        self.assertEqual(self.pool.get_metrics()['handshakes'], 2)
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_0040_unreachable(self):
+        """
+        All the messages must fail at once if the server cannot be reached
+        """
+        self.server.stop()
+        failures = self.pool.send_batch(self.get_messages(3))
+        self.assertEqual([index for index, exc in failures], [0, 1, 2])
+        self.assertTrue(isinstance(failures[0][1], socket.error))
+
+
+def suite():
+    "SMTP pool test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestSMTPPool)
+        )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
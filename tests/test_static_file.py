@@ -8,16 +8,21 @@
     :copyright: (c) 2012-2013 by Openlabs Technologies & Consulting (P) LTD
     :license: GPLv3, see LICENSE for more details.
 """
+import os
 import new
+import hashlib
 import unittest
 import functools
+from StringIO import StringIO
 
+from mock import patch
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from trytond.transaction import Transaction
 from trytond.config import CONFIG
 from nereid.testing import NereidTestCase
 from nereid import render_template
+from trytond.modules.nereid import static_file as static_file_module
 
 CONFIG['smtp_server'] = 'smtpserver'
 CONFIG['smtp_user'] = 'test@xyz.com'
@@ -201,6 +206,308 @@ class TestStaticFile(NereidTestCase):
                 )
                 self.assertEqual(rv.status_code, 200)
 
+    def test_0040_static_file_index(self):
+        """
+        Static files must be served from the index, which must be refreshed
+        when the files change
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            static_file = self.create_static_file(buffer('test-content'))
+            app = self.get_app()
+
+            entry = self.static_file_obj.get_index_entry('test', 'test.png')
+            self.assertEqual(entry.id, static_file.id)
+            self.assertEqual(entry.path, static_file.file_path)
+            self.assertEqual(entry.size, len('test-content'))
+            self.assertEqual(
+                self.static_file_obj.get_index_entry('test', 'missing.png'),
+                None
+            )
+
+            # Renamed behind the back of the index
+            cursor = Transaction().cursor
+            cursor.execute(
+                'UPDATE "' + self.static_file_obj._table + '" '
+                'SET name = %s WHERE id = %s', ('other.png', static_file.id)
+            )
+            with app.test_client() as c:
+                rv = c.get('/en_US/static-file/test/test.png')
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, 'test-content')
+
+                self.static_file_obj.write(
+                    [static_file], {'name': 'renamed.png'}
+                )
+                rv = c.get('/en_US/static-file/test/test.png')
+                self.assertEqual(rv.status_code, 404)
+
+            self.static_file_obj.preload_index()
+            self.assertEqual(
+                self.static_file_obj._index_cache.get(
+                    ('test', 'renamed.png')
+                ).id, static_file.id
+            )
+
+    def test_0050_static_file_conditional_range(self):
+        """
+        Static files must be sent with an ETag and the Cache-Control of
+        their folder, answer conditional requests with a 304 and byte
+        ranges with a 206
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            static_file = self.create_static_file(buffer('0123456789'))
+            self.static_folder_obj.write(
+                [static_file.folder], {'max_age': 3600}
+            )
+            app = self.get_app()
+            url = '/en_US/static-file/test/test.png'
+
+            with app.test_client() as c:
+                rv = c.get(url)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, '0123456789')
+                self.assertEqual(rv.headers['Accept-Ranges'], 'bytes')
+                self.assertEqual(
+                    rv.headers['Cache-Control'], 'public, max-age=3600'
+                )
+                etag = rv.headers['ETag']
+                last_modified = rv.headers['Last-Modified']
+
+                # The ETag is stable
+                self.assertEqual(c.get(url).headers['ETag'], etag)
+
+                rv = c.get(url, headers=[('If-None-Match', etag)])
+                self.assertEqual(rv.status_code, 304)
+                self.assertEqual(rv.data, '')
+                self.assertEqual(rv.headers['ETag'], etag)
+
+                rv = c.get(url, headers=[('If-None-Match', '"other"')])
+                self.assertEqual(rv.status_code, 200)
+
+                rv = c.get(
+                    url, headers=[('If-Modified-Since', last_modified)]
+                )
+                self.assertEqual(rv.status_code, 304)
+
+                rv = c.get(url, headers=[('Range', 'bytes=2-5')])
+                self.assertEqual(rv.status_code, 206)
+                self.assertEqual(rv.data, '2345')
+                self.assertEqual(
+                    rv.headers['Content-Range'], 'bytes 2-5/10'
+                )
+
+                rv = c.get(url, headers=[('Range', 'bytes=-3')])
+                self.assertEqual(rv.status_code, 206)
+                self.assertEqual(rv.data, '789')
+
+                rv = c.get(url, headers=[('Range', 'bytes=20-30')])
+                self.assertEqual(rv.status_code, 416)
+                self.assertEqual(rv.headers['Content-Range'], 'bytes */10')
+
+                # Multiple and non byte ranges get the whole file
+                for value in (
+                        'bytes=0-1,5-6', 'bytes=20-30,40-50', 'items=0-1'):
+                    rv = c.get(url, headers=[('Range', value)])
+                    self.assertEqual(rv.status_code, 200)
+                    self.assertEqual(rv.data, '0123456789')
+
+                # The range is ignored if the file changed
+                rv = c.get(url, headers=[
+                    ('Range', 'bytes=2-5'), ('If-Range', '"other"'),
+                ])
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, '0123456789')
+
+            self.static_folder_obj.write(
+                [static_file.folder], {'max_age': 0}
+            )
+            with app.test_client() as c:
+                rv = c.get(url)
+                self.assertEqual(rv.headers['Cache-Control'], 'no-cache')
+
+    def test_0060_static_file_fingerprint(self):
+        """
+        The URLs of the files of a fingerprinted folder must embed the hash
+        of their content and be sent with an immutable Cache-Control
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            static_file = self.create_static_file(buffer('test-content'))
+            self.assertEqual(
+                static_file.content_hash,
+                hashlib.sha1('test-content').hexdigest()
+            )
+            app = self.get_app()
+
+            with app.test_request_context('/en_US/'):
+                self.assertEqual(
+                    static_file.url, '/en_US/static-file/test/test.png'
+                )
+                self.static_folder_obj.write(
+                    [static_file.folder], {'fingerprint_urls': True}
+                )
+                url = self.static_file_obj(static_file.id).url
+                self.assertEqual(
+                    url, '/en_US/static-file/test/%s/test.png' % (
+                        static_file.content_hash[:12],
+                    )
+                )
+
+            with app.test_client() as c:
+                rv = c.get(url)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, 'test-content')
+                self.assertEqual(
+                    rv.headers['Cache-Control'],
+                    'public, max-age=31536000, immutable'
+                )
+
+                old_entry = self.static_file_obj.get_index_entry(
+                    'test', 'test.png'
+                )
+
+                # A new content gets a new URL, the old one redirects
+                self.static_file_obj.write(
+                    [static_file], {'file_binary': buffer('new-content')}
+                )
+                rv = c.get(url)
+                self.assertEqual(rv.status_code, 302)
+                new_url = self.static_file_obj(static_file.id).url
+                self.assertNotEqual(new_url, url)
+                self.assertTrue(rv.headers['Location'].endswith(new_url))
+
+                rv = c.get(new_url)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, 'new-content')
+
+                # An index entry filled before the change was committed is
+                # reloaded instead of redirecting to the requested URL
+                self.static_file_obj._index_cache.set(
+                    ('test', 'test.png'), old_entry
+                )
+                rv = c.get(new_url)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, 'new-content')
+
+    def test_0070_static_file_write(self):
+        """
+        Files must be written atomically, and files sharing a payload must
+        be written once
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            static_file = self.create_static_file(buffer('test-content'))
+            other_file, = self.static_file_obj.create([{
+                'name': 'other.png',
+                'folder': static_file.folder,
+            }])
+            directory = os.path.dirname(static_file.file_path)
+
+            self.static_file_obj.write([static_file, other_file], {
+                'file_binary': buffer('x' * 200000),
+            })
+            static_file = self.static_file_obj(static_file.id)
+            other_file = self.static_file_obj(other_file.id)
+            self.assertEqual(other_file.file_binary, buffer('x' * 200000))
+            self.assertEqual(
+                other_file.content_hash, static_file.content_hash
+            )
+            self.assertEqual(
+                os.stat(static_file.file_path).st_ino,
+                os.stat(other_file.file_path).st_ino
+            )
+            self.assertFalse(
+                [f for f in os.listdir(directory) if f.endswith('.tmp')]
+            )
+
+            # A new content replaces the link instead of writing through it
+            self.static_file_obj.set_file_binary(
+                [static_file], 'file_binary', StringIO('streamed-content')
+            )
+            static_file = self.static_file_obj(static_file.id)
+            self.assertEqual(
+                static_file.file_binary, buffer('streamed-content')
+            )
+            self.assertEqual(
+                static_file.content_hash,
+                hashlib.sha1('streamed-content').hexdigest()
+            )
+            self.assertEqual(other_file.file_binary, buffer('x' * 200000))
+
+            # The temporary file is removed when the write fails
+            class BrokenFile(object):
+                def read(self, size):
+                    raise IOError('Broken upload')
+            self.assertRaises(
+                IOError, self.static_file_obj.set_file_binary,
+                [static_file], 'file_binary', BrokenFile()
+            )
+            self.assertFalse(
+                [f for f in os.listdir(directory) if f.endswith('.tmp')]
+            )
+            self.assertEqual(
+                static_file.file_binary, buffer('streamed-content')
+            )
+
+    def test_0080_static_file_read(self):
+        """
+        The content of the files must be read whole, or in chunks with the
+        iterator, without keeping the files open, and remote files must be
+        streamed
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            static_file = self.create_static_file(buffer('0123456789'))
+
+            fd_count = len(os.listdir('/proc/self/fd')) \
+                if os.path.isdir('/proc/self/fd') else None
+            file_binary = static_file.file_binary
+            if fd_count is not None:
+                self.assertEqual(len(os.listdir('/proc/self/fd')), fd_count)
+            self.assertTrue(isinstance(file_binary, buffer))
+            self.assertEqual(file_binary, buffer('0123456789'))
+            self.assertEqual(file_binary[2:5], '234')
+            self.assertEqual(len(file_binary), 10)
+
+            self.assertEqual(
+                list(static_file.iter_file_binary(chunk_size=4)),
+                ['0123', '4567', '89']
+            )
+
+            self.static_file_obj.write(
+                [static_file], {'file_binary': buffer('')}
+            )
+            static_file = self.static_file_obj(static_file.id)
+            self.assertEqual(static_file.file_binary, buffer(''))
+            self.assertEqual(list(static_file.iter_file_binary()), [])
+
+            # Remote files are streamed from their URL
+            self.static_file_obj.create([{
+                'name': 'remote.png',
+                'folder': static_file.folder,
+                'type': 'remote',
+                'remote_path': 'http://example.com/remote.png',
+            }])
+            remote = StringIO('remote-content')
+            app = self.get_app()
+            with patch.object(
+                    static_file_module.urllib, 'urlopen',
+                    return_value=remote) as urlopen:
+                with app.test_client() as c:
+                    rv = c.get('/en_US/static-file/test/remote.png')
+                    self.assertEqual(rv.status_code, 200)
+                    self.assertEqual(rv.data, 'remote-content')
+                    self.assertEqual(rv.mimetype, 'image/png')
+            urlopen.assert_called_once_with('http://example.com/remote.png')
+            self.assertTrue(remote.closed)
+
 
 def suite():
     "Nereid test suite"
@@ -0,0 +1,41 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import struct
+import zlib
+
+from trytond.transaction import Transaction
+
+__all__ = ['clean_record_cache', 'gzip_compress']
+
+
+def clean_record_cache(model, ids):
+    """
+    Clean the transaction caches of records updated directly in SQL
+
+    :param model: The model of the records
+    :param ids: The ids of the records
+    """
+    Transaction().counter += 1
+    for cache in Transaction().cursor.cache.itervalues():
+        if model.__name__ in cache:
+            for id_ in ids:
+                cache[model.__name__].pop(id_, None)
+
+
+def gzip_compress(data):
+    """
+    Returns the data compressed in the gzip format. The header is written
+    here with a null modification time, so that the same data always gives
+    the same bytes (`GzipFile` only accepts the time from Python 2.7).
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return ''.join([
+        # Magic, deflate method, no flags, no time, best compression, unknown
+        # operating system
+        '\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff',
+        compressor.compress(data),
+        compressor.flush(),
+        struct.pack(
+            '<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff
+        ),
+    ])